@@ -0,0 +1,177 @@
+"""
+Autenticación: contraseñas con hash y sal, índice de usuarios por nombre,
+tokens de sesión y limitador de intentos de login.
+"""
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+HASH_ALGORITHM = "pbkdf2_sha256"
+
+
+def hash_password(password: str, iterations: int, salt: Optional[bytes] = None) -> str:
+    """
+    Devuelve "pbkdf2_sha256$<iteraciones>$<sal>$<hash>" (sal y hash en base64).
+    El coste crece linealmente con `iterations`.
+    """
+    salt = salt or secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return "$".join((
+        HASH_ALGORITHM,
+        str(iterations),
+        base64.b64encode(salt).decode("ascii"),
+        base64.b64encode(digest).decode("ascii"),
+    ))
+
+
+def is_hashed(value: str) -> bool:
+    return value.startswith(HASH_ALGORITHM + "$")
+
+
+def verify_password(password: str, encoded: str) -> bool:
+    """
+    Compara en tiempo constante. hashlib libera el GIL mientras calcula, así
+    que varias verificaciones en hilos distintos corren en paralelo.
+    """
+    try:
+        algorithm, iterations, salt, expected = encoded.split("$")
+    except ValueError:
+        return False
+    if algorithm != HASH_ALGORITHM:
+        return False
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+
+
+def needs_rehash(encoded: str, iterations: int) -> bool:
+    """
+    True si el hash se generó con otro coste (p. ej. tras subir las iteraciones).
+    """
+    return not is_hashed(encoded) or encoded.split("$")[1] != str(iterations)
+
+
+class UserIndex:
+    """
+    Índice username -> user_id para que el login no recorra db_users.
+    """
+
+    def __init__(self, users: Optional[Dict[int, dict]] = None):
+        self._ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        for user_id, user in (users or {}).items():
+            self.add(user_id, user["username"])
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, user_id: int, username: str):
+        with self._lock:
+            self._ids[username] = user_id
+
+    def remove(self, username: str):
+        with self._lock:
+            self._ids.pop(username, None)
+
+    def get(self, username: str) -> Optional[int]:
+        return self._ids.get(username)
+
+
+class TokenStore:
+    """
+    Tokens de sesión opacos con expiración. Con un cliente Redis los tokens
+    se comparten entre workers; si no, viven en memoria del proceso.
+    """
+
+    def __init__(self, ttl: int = 3600, client=None, prefix: str = "inkafarma:session:", max_tokens: int = 100_000):
+        self.ttl = ttl
+        self.client = client
+        self.prefix = prefix
+        self.max_tokens = max_tokens
+        self._tokens: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, user_id: int) -> str:
+        token = secrets.token_urlsafe(32)
+        if self.client is not None:
+            self.client.setex(self.prefix + token, self.ttl, user_id)
+            return token
+        with self._lock:
+            self._tokens[token] = (user_id, time.monotonic() + self.ttl)
+            # Las sesiones más antiguas se descartan primero
+            while len(self._tokens) > self.max_tokens:
+                self._tokens.popitem(last=False)
+        return token
+
+    def validate(self, token: str) -> Optional[int]:
+        """
+        Devuelve el user_id del token, o None si no existe o venció.
+        """
+        if self.client is not None:
+            value = self.client.get(self.prefix + token)
+            return None if value is None else int(value)
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._tokens[token]
+                return None
+            return entry[0]
+
+    def revoke(self, token: str):
+        if self.client is not None:
+            self.client.delete(self.prefix + token)
+            return
+        with self._lock:
+            self._tokens.pop(token, None)
+
+
+class RateLimiter:
+    """
+    Token bucket por clave (IP o usuario): cada clave acumula `rate` fichas
+    por segundo hasta `burst`, y cada intento consume una. Se guarda a lo
+    sumo `max_keys` claves (las menos recientes se descartan).
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"allowed": 0, "limited": 0}
+
+    def acquire(self, *keys: str, now: Optional[float] = None) -> float:
+        """
+        Consume una ficha de cada clave. Devuelve 0 si se permite el intento o,
+        si alguna clave está agotada, los segundos a esperar (sin consumir nada).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = []
+            wait = 0.0
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = [float(self.burst), now]
+                else:
+                    self._buckets.move_to_end(key)
+                    bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                    bucket[1] = now
+                if bucket[0] < 1:
+                    wait = max(wait, (1 - bucket[0]) / self.rate)
+                buckets.append(bucket)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            if wait:
+                self.stats["limited"] += 1
+                return wait
+            for bucket in buckets:
+                bucket[0] -= 1
+            self.stats["allowed"] += 1
+            return 0.0
@@ -0,0 +1,1366 @@
+"""
+Benchmarks de rendimiento.
+
+Uso:
+    python benchmark.py search --sizes 20 1000 100000 1000000
+    python benchmark.py publish --orders 2000 --latency 0.005
+    python benchmark.py codec --repeat 10000
+    python benchmark.py worker --orders 20000 --prefetch 50
+    python benchmark.py inventory --locations 1000 --skus 100000
+    python benchmark.py bulk --orders 10000
+    python benchmark.py orders-stream --orders 1000000
+    python benchmark.py load --connections 1000 --requests 20000 [--url http://localhost:8000]
+    python benchmark.py storage --orders 10000 --repeat 200 [--backends memory sqlite]
+    python benchmark.py recommendations --orders 1000000 --skus 10000
+    python benchmark.py login --users 100000 --requests 200 --connections 50
+    python benchmark.py loyalty --orders 1000000 --users 1000000
+    python benchmark.py metrics --requests 5000 --repeat 100000
+    python benchmark.py render --sizes 100000 --locations 100000 --repeat 5
+    python benchmark.py import --orders 1000000 [--backends memory sqlite]
+    python benchmark.py availability --locations 5000 --skus 100000 --skus-per-location 300 --repeat 200
+    python benchmark.py idempotency --orders 500 --threads 8
+    python benchmark.py startup --sizes 20 100000 --locations 1000 --orders 10000 --repeat 5
+    python benchmark.py suite --sizes 20 1000000 --location-sizes 1 10000 --output results.json [--baseline baseline.json]
+
+main.py construye sus índices de forma diferida (ver startup.py); los
+benchmarks los completan con main.warmup.run() antes de medir, porque
+muchos usan los índices directamente, sin el middleware que los espera.
+"""
+import argparse
+import random
+import string
+import time
+
+from search import ProductSearchIndex
+
+CATEGORIES = ["Medicines", "Baby", "Supplements", "First Aid", "Personal Care", "Condoms"]
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def make_products(n: int, seed: int = 0) -> dict:
+    """
+    Genera un catálogo sintético de n productos.
+    """
+    rng = random.Random(seed)
+    products = {}
+    for product_id in range(1, n + 1):
+        words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))) for _ in range(2)]
+        products[product_id] = {
+            "name": " ".join(words).title(),
+            "price": round(rng.uniform(1, 100), 2),
+            "category": rng.choice(CATEGORIES),
+        }
+    return products
+
+
+def timeit(func, repeat: int) -> float:
+    """
+    Devuelve la latencia media en microsegundos de `repeat` llamadas.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def linear_scan(products: dict, name: str) -> list:
+    # Implementación original de /products/name, como referencia
+    return [{"id": pid, **p} for pid, p in products.items() if name.lower() in p["name"].lower()]
+
+
+@benchmark("search")
+def bench_search(args):
+    queries = ["panadol", "abc", "xyzq", "medic"]
+    print(f"{'products':>10} {'build(s)':>9} {'name(us)':>10} {'category(us)':>13} {'scan(us)':>10}")
+    for size in args.sizes:
+        products = make_products(size)
+        start = time.perf_counter()
+        index = ProductSearchIndex(products)
+        build = time.perf_counter() - start
+        name_us = sum(timeit(lambda q=q: index.search_name(q, limit=50), args.repeat) for q in queries) / len(queries)
+        category_us = timeit(lambda: index.search_category("first aid", limit=50), args.repeat)
+        scan_repeat = max(1, min(args.repeat, 100_000 // size))
+        scan_us = timeit(lambda: linear_scan(products, "xyzq"), scan_repeat)
+        print(f"{size:>10} {build:>9.2f} {name_us:>10.1f} {category_us:>13.1f} {scan_us:>10.1f}")
+
+
+@benchmark("publish")
+def bench_publish(args):
+    """
+    Throughput de /orders/create publicando de forma síncrona (un round trip
+    al broker por request, como antes) frente al publicador en lotes.
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi.testclient import TestClient
+    import main
+    from publisher import FakeBroker, OrderPublisher
+
+    main.warmup.run()
+
+    def run(label, publisher, publish):
+        main.order_publisher = publisher
+        main.publish_order = publish
+        client = TestClient(main.app)
+        orders = [{"order_id": 10**6 + i, "user_id": 1, "product_ids": [1, 2], "quantity": [1, 1], "location_id": 1}
+                  for i in range(args.orders)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(lambda o: client.post("/orders/create", json=o), orders))
+        elapsed = time.perf_counter() - start
+        publisher.stop()
+        main.db_orders.clear()
+        print(f"{label:>8} {args.orders / elapsed:>10.0f} orders/s")
+
+    original = main.publish_order
+    # Stock de sobra para que las reservas no rechacen órdenes durante la medición
+    for product_id in (1, 2):
+        main.db_stock[product_id] = {"product_id": product_id, "quantity": 10**9}
+    broker = FakeBroker(latency=args.latency)
+    channel = broker.connection().channel()
+    channel.queue_declare(queue="orders")
+    lock = threading.Lock()
+
+    def publish_sync(order_data):
+        # Canal único compartido: hay que serializar el acceso
+        with lock:
+            channel.basic_publish(exchange="", routing_key="orders", body=str(order_data).encode("utf-8"))
+
+    run("sync", OrderPublisher(broker.connection), publish_sync)
+    publisher = OrderPublisher(broker.connection, max_queue=args.orders)
+    publisher.start()
+    run("batched", publisher, original)
+
+
+@benchmark("bulk")
+def bench_bulk(args):
+    """
+    N llamadas a /orders/create + /payments/process frente a una sola llamada
+    a /orders/bulk + /payments/bulk con las mismas órdenes.
+    """
+    from fastapi.testclient import TestClient
+    import main
+    from publisher import OrderPublisher
+
+    main.warmup.run()
+    client = TestClient(main.app)
+    skus = list(main.db_stock)
+
+    def make_orders(base):
+        rng = random.Random(base)
+        return [{"order_id": base + i, "user_id": 1, "product_ids": rng.sample(skus, 3), "quantity": [1, 1, 1],
+                 "location_id": 1} for i in range(args.orders)]
+
+    for product_id in skus:
+        main.db_stock[product_id] = {"product_id": product_id, "quantity": 10**9}
+    main.order_publisher = OrderPublisher(lambda: None, max_queue=4 * args.orders)
+
+    orders = make_orders(10**7)
+    start = time.perf_counter()
+    for order in orders:
+        client.post("/orders/create", json=order)
+        client.post("/payments/process", json={"order_id": order["order_id"], "status": "Paid"})
+    single = time.perf_counter() - start
+
+    orders = make_orders(2 * 10**7)
+    start = time.perf_counter()
+    client.post("/orders/bulk", json=orders)
+    client.post("/payments/bulk", json=[{"order_id": o["order_id"], "status": "Paid"} for o in orders])
+    bulk = time.perf_counter() - start
+    print(f"{args.orders} órdenes: individual {single:.2f} s, bulk {bulk:.2f} s ({single / bulk:.0f}x)")
+
+
+@benchmark("orders-stream")
+def bench_orders_stream(args):
+    """
+    Memoria pico y tiempo hasta el primer byte de GET /orders con N órdenes:
+    lista completa (como antes) frente a streaming NDJSON.
+    """
+    import asyncio
+    import json
+    import tracemalloc
+    import main
+
+    main.warmup.run()
+    main.db_orders.clear()
+    for order_id in range(args.orders):
+        main.db_orders[order_id] = {"order_id": order_id, "user_id": order_id % 1000, "product_ids": [1, 2],
+                                    "quantity": [1, 3], "location_id": 1}
+
+    async def call(query: str):
+        # Llamada ASGI directa: se cuentan los bytes sin acumular el cuerpo
+        state = {"first": None, "bytes": 0, "received": False}
+        start = time.perf_counter()
+        done = asyncio.Event()
+
+        async def receive():
+            if state["received"]:
+                # El cliente no se desconecta hasta recibir toda la respuesta
+                await done.wait()
+                return {"type": "http.disconnect"}
+            state["received"] = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                if state["first"] is None:
+                    state["first"] = time.perf_counter() - start
+                state["bytes"] += len(message["body"])
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                done.set()
+
+        scope = {"type": "http", "method": "GET", "path": "/orders", "raw_path": b"/orders",
+                 "query_string": query.encode(), "headers": [], "http_version": "1.1", "scheme": "http",
+                 "server": ("test", 80), "client": ("test", 1), "root_path": ""}
+        await main.app(scope, receive, send)
+        return state["first"], time.perf_counter() - start, state["bytes"]
+
+    def legacy():
+        # Implementación anterior: todas las órdenes como modelos y luego JSON
+        start = time.perf_counter()
+        body = json.dumps([main.Order(**o).model_dump() for o in main.db_orders.values()]).encode()
+        elapsed = time.perf_counter() - start
+        return elapsed, elapsed, len(body)
+
+    print(f"{args.orders} órdenes")
+    for label, run in (("lista", legacy), ("ndjson", lambda: asyncio.run(call("format=ndjson"))),
+                       ("página", lambda: asyncio.run(call("limit=100")))):
+        tracemalloc.start()
+        first, total, size = run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:>7}: primer byte {first * 1000:8.1f} ms, total {total:7.2f} s, "
+              f"{size / 2**20:7.1f} MiB enviados, memoria pico {peak / 2**20:7.1f} MiB")
+
+
+def _sync_baseline_app():
+    """
+    App con los handlers originales (def, pasan por el threadpool) para comparar.
+    """
+    from fastapi import FastAPI, HTTPException
+    import main
+
+    main.warmup.run()
+    baseline = FastAPI()
+
+    @baseline.get("/stock/{product_id}/quantity")
+    def stock_quantity(product_id: int):
+        stock = main.db_stock.get(product_id)
+        if not stock:
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        return {"product_id": product_id, "quantity": stock["quantity"]}
+
+    @baseline.get("/locations/{location_id}/stock/{product_id}/quantity")
+    def location_stock_quantity(location_id: int, product_id: int):
+        quantity = main.location_stock.get(location_id, product_id)
+        if quantity is None:
+            raise HTTPException(status_code=404, detail="Producto no encontrado en la ubicación")
+        return {"product_id": product_id, "quantity": quantity}
+
+    @baseline.get("/loyalty/{user_id}")
+    def loyalty(user_id: int):
+        return {"user_id": user_id, "points": main.db_loyalty.get(user_id, 0)}
+
+    return baseline
+
+
+@benchmark("load")
+def bench_load(args):
+    """
+    Latencia p50/p99 y requests/s de los GET calientes con `--connections`
+    clientes concurrentes. Sin --url se mide en proceso (ASGI) la versión
+    sync anterior frente a la async; con --url se mide un servidor real.
+    """
+    import asyncio
+    import statistics
+    import httpx
+    import main
+
+    main.warmup.run()
+    paths = ["/stock/2/quantity", "/locations/1/stock/2/quantity", "/loyalty/1"]
+
+    async def run(transport, base_url):
+        latencies = []
+        semaphore = asyncio.Semaphore(args.connections)
+        limits = httpx.Limits(max_connections=args.connections)
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, limits=limits) as http:
+            async def one(i):
+                async with semaphore:
+                    start = time.perf_counter()
+                    await http.get(paths[i % len(paths)])
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(args.requests)))
+            elapsed = time.perf_counter() - start
+        quantiles = statistics.quantiles(latencies, n=100)
+        return quantiles[49] * 1000, quantiles[98] * 1000, args.requests / elapsed
+
+    if args.url:
+        targets = [("servidor", None, args.url)]
+    else:
+        targets = [("sync", httpx.ASGITransport(app=_sync_baseline_app()), "http://test"),
+                   ("async", httpx.ASGITransport(app=main.app), "http://test")]
+    print(f"{args.requests} requests, {args.connections} conexiones concurrentes")
+    for label, transport, base_url in targets:
+        p50, p99, rps = asyncio.run(run(transport, base_url))
+        print(f"{label:>8}: p50 {p50:7.2f} ms, p99 {p99:7.2f} ms, {rps:8.0f} req/s")
+
+
+@benchmark("recommendations")
+def bench_recommendations(args):
+    """
+    Tiempo de construcción del índice de recomendaciones a partir de N
+    órdenes, coste de sumar órdenes nuevas y latencia de consulta frente al
+    recorrido completo del catálogo que hacía el endpoint antes.
+    """
+    from recommend import RecommendationIndex
+
+    products = make_products(args.skus)
+    rng = random.Random(1)
+    # Algunos productos se venden mucho más que otros, como en un catálogo real
+    weights = [1 / (rank + 1) for rank in range(args.skus)]
+    product_ids = list(products)
+    orders = [{"product_ids": rng.choices(product_ids, weights, k=rng.randint(1, 5))} for _ in range(args.orders)]
+
+    start = time.perf_counter()
+    index = RecommendationIndex(products, orders, top_k=20)
+    build = time.perf_counter() - start
+
+    extra = orders[:10_000]
+    start = time.perf_counter()
+    for order in extra:
+        index.add_order(order)
+    add_us = (time.perf_counter() - start) / len(extra) * 1e6
+
+    def legacy(product_id):
+        category = products[product_id]["category"].lower()
+        return [{"id": pid, **p} for pid, p in products.items() if p["category"].lower() == category]
+
+    lookup_us = timeit(lambda: index.recommend(rng.randint(1, args.skus), limit=10), args.repeat)
+    legacy_us = timeit(lambda: legacy(rng.randint(1, args.skus)), max(1, args.repeat // 10))
+    print(f"{args.orders} órdenes, {args.skus} productos")
+    print(f"construcción {build:.2f} s, add_order {add_us:.1f} us, "
+          f"consulta {lookup_us:.1f} us (antes {legacy_us:.0f} us)")
+
+
+@benchmark("login")
+def bench_login(args):
+    """
+    Login: búsqueda del usuario (recorrido de db_users frente al índice),
+    logins/s con el hash en el pool y latencia de usuarios legítimos
+    mientras una IP envía una ráfaga de contraseñas incorrectas, con y sin
+    limitador.
+    """
+    import asyncio
+    import statistics
+    import httpx
+    import main
+    from auth import RateLimiter
+
+    main.warmup.run()
+    # Todos los usuarios sintéticos comparten contraseña y hash: el coste por login es el mismo
+    encoded = main.db_users[1]["password"]
+    users = {user_id: {"username": f"user{user_id}", "password": encoded} for user_id in range(10, 10 + args.users)}
+    main.db_users.put_many(users.items())
+    for user_id, user in users.items():
+        main.user_index.add(user_id, user["username"])
+    target = f"user{9 + args.users}"
+    scan_us = timeit(lambda: next(uid for uid, u in main.db_users.items() if u["username"] == target), max(1, args.repeat // 20))
+    index_us = timeit(lambda: main.user_index.get(target), args.repeat)
+    print(f"{args.users} usuarios: búsqueda recorriendo db_users {scan_us:.0f} us, con índice {index_us:.2f} us")
+
+    def transport(ip):
+        return httpx.ASGITransport(app=main.app, client=(ip, 1000))
+
+    async def logins(http, count, password, concurrency):
+        latencies, codes = [], []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await http.post("/auth/login", json={"username": f"user{10 + i % args.users}", "password": password, "user_id": 0})
+                latencies.append(time.perf_counter() - start)
+                codes.append(response.status_code)
+
+        await asyncio.gather(*(one(i) for i in range(count)))
+        return latencies, codes
+
+    async def throughput():
+        main.login_limiter = RateLimiter(rate=1e9, burst=10**9)
+        async with httpx.AsyncClient(transport=transport("10.0.0.1"), base_url="http://test") as http:
+            start = time.perf_counter()
+            _, codes = await logins(http, args.requests, "password123", args.connections)
+            elapsed = time.perf_counter() - start
+        print(f"login válido: {args.requests / elapsed:.0f} logins/s ({codes.count(200)} OK, {args.connections} concurrentes)")
+
+    async def flood(limiter, label):
+        main.login_limiter = limiter
+        async with httpx.AsyncClient(transport=transport("10.0.0.66"), base_url="http://test") as attacker, \
+                httpx.AsyncClient(transport=transport("10.0.0.1"), base_url="http://test") as legit:
+            attack = asyncio.ensure_future(logins(attacker, args.requests * 5, "incorrecta", args.connections))
+            latencies, codes = await logins(legit, args.requests // 5 or 1, "password123", 4)
+            _, attack_codes = await attack
+        p50 = statistics.median(latencies) * 1000
+        print(f"{label:>13}: legítimos p50 {p50:7.1f} ms, máx {max(latencies) * 1000:7.1f} ms, "
+              f"{codes.count(200)}/{len(codes)} OK; ataque: {attack_codes.count(429)} rechazados sin hash "
+              f"de {len(attack_codes)}")
+
+    asyncio.run(throughput())
+    asyncio.run(flood(RateLimiter(rate=1e9, burst=10**9), "sin limitador"))
+    asyncio.run(flood(RateLimiter(rate=main.LOGIN_RATE, burst=main.LOGIN_BURST), "con limitador"))
+
+
+@benchmark("loyalty")
+def bench_loyalty(args):
+    """
+    Ingesta del ledger de fidelidad (pagos/s con escritura en lote al diario
+    y a los saldos), tiempo de reconstrucción de saldos al arrancar y
+    latencia de lectura de un saldo con `--users` usuarios.
+    """
+    import os
+    import tempfile
+    from loyalty import LoyaltyEngine
+    from pagination import KeysetTable
+
+    rng = random.Random(2)
+    payments = [(rng.randint(1, args.users), order_id, rng.uniform(5, 200)) for order_id in range(args.orders)]
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = os.path.join(tmp, "loyalty.ledger")
+        engine = LoyaltyEngine(KeysetTable(), journal_path=journal, batch_size=1000)
+        engine.load()
+        start = time.perf_counter()
+        for payment in payments:
+            engine.record_payment(*payment)
+        engine.flush()
+        single = time.perf_counter() - start
+
+        engine = LoyaltyEngine(KeysetTable(), journal_path=os.path.join(tmp, "bulk.ledger"), batch_size=10_000)
+        engine.load()
+        start = time.perf_counter()
+        for i in range(0, len(payments), 10_000):
+            engine.record_many(payments[i:i + 10_000])
+        engine.flush()
+        bulk = time.perf_counter() - start
+
+        replayed = LoyaltyEngine(KeysetTable(), journal_path=journal)
+        start = time.perf_counter()
+        replayed.load()
+        rebuild = time.perf_counter() - start
+        size = os.path.getsize(journal)
+    read_us = timeit(lambda: replayed.balance(rng.randint(1, args.users)), args.repeat)
+    print(f"{args.orders} pagos, {args.users} usuarios, diario {size / 2**20:.1f} MiB")
+    print(f"ingesta {args.orders / single:.0f} pagos/s (de a uno), {args.orders / bulk:.0f} pagos/s (lotes de 10000)")
+    print(f"reconstrucción {rebuild:.2f} s, lectura de saldo {read_us:.2f} us")
+
+
+STORAGE_BACKENDS = {"memory": "memory", "sqlite": "sqlite:///{tmp}/benchmark.db"}
+
+
+@benchmark("storage")
+def bench_storage(args):
+    """
+    Latencia por endpoint con cada backend de almacenamiento. Cada backend
+    se mide en un proceso aparte porque main.py lo elige al importarse.
+    """
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    for backend in args.backends:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {**os.environ, "STORAGE_URL": STORAGE_BACKENDS[backend].format(tmp=tmp)}
+            print(f"== {backend}")
+            subprocess.run(
+                [sys.executable, __file__, "storage-endpoints", "--orders", str(args.orders), "--repeat", str(args.repeat)],
+                env=env, check=True,
+            )
+
+
+@benchmark("storage-endpoints")
+def bench_storage_endpoints(args):
+    """
+    Mide los endpoints contra el backend de STORAGE_URL (lo invoca `storage`).
+    La caché de lectura se desactiva para medir el acceso a los datos.
+    """
+    from fastapi.testclient import TestClient
+    import main
+    from cache import MemoryCache
+    from publisher import OrderPublisher
+
+    main.warmup.run()
+    main.cache.local = MemoryCache(max_entries=0)
+    main.order_publisher = OrderPublisher(lambda: None, max_queue=10 * args.repeat + 10)
+    for product_id in list(main.db_stock):
+        main.db_stock[product_id] = {"product_id": product_id, "quantity": 10**9}
+    main.db_orders.put_many(
+        (order_id, {"order_id": order_id, "user_id": order_id % 100, "product_ids": [1, 2], "quantity": [1, 1], "location_id": 1})
+        for order_id in range(1, args.orders + 1)
+    )
+    client = TestClient(main.app)
+    next_id = iter(range(10**8, 2 * 10**8))
+    created = []
+
+    def create():
+        order_id = next(next_id)
+        created.append(order_id)
+        client.post("/orders/create", json={"order_id": order_id, "user_id": 1, "product_ids": [1, 2], "quantity": [1, 1], "location_id": 1})
+
+    def pay():
+        client.post("/payments/process", json={"order_id": created.pop(), "status": "Paid"})
+
+    middle = args.orders // 2
+    endpoints = [
+        ("GET /stock/{id}", lambda: client.get("/stock/2")),
+        ("GET /products/category/{c}/id/{id}", lambda: client.get("/products/category/Baby/id/3")),
+        ("GET /locations/{id}", lambda: client.get("/locations/1")),
+        ("GET /orders?limit=100", lambda: client.get(f"/orders?after_id={middle}&limit=100")),
+        ("GET /loyalty/{id}", lambda: client.get("/loyalty/1")),
+        ("POST /orders/create", create),
+        ("POST /payments/process", pay),
+    ]
+    print(f"{'endpoint':>36} {'latencia(us)':>13}")
+    for label, call in endpoints:
+        print(f"{label:>36} {timeit(call, args.repeat):>13.0f}")
+
+
+@benchmark("codec")
+def bench_codec(args):
+    """
+    Coste de codificar/decodificar una orden y tamaño del mensaje según el formato.
+    """
+    from codec import decode_order, encode_order
+
+    print(f"{'items':>6} {'codec':>7} {'bytes':>7} {'encode(us)':>11} {'decode(us)':>11}")
+    for items in (1, 10, 100):
+        order = {"order_id": 123456, "user_id": 42, "product_ids": list(range(1000, 1000 + items)),
+                 "quantity": [i % 7 + 1 for i in range(items)], "location_id": 3}
+        legacy = str(order).encode("utf-8")
+        encode_us = timeit(lambda: str(order).encode("utf-8"), args.repeat)
+        decode_us = timeit(lambda: decode_order(legacy), args.repeat)
+        print(f"{items:>6} {'repr':>7} {len(legacy):>7} {encode_us:>11.2f} {decode_us:>11.2f}")
+        for codec in ("json", "binary"):
+            body, content_type = encode_order(order, codec)
+            encode_us = timeit(lambda: encode_order(order, codec), args.repeat)
+            decode_us = timeit(lambda: decode_order(body, content_type), args.repeat)
+            print(f"{items:>6} {codec:>7} {len(body):>7} {encode_us:>11.2f} {decode_us:>11.2f}")
+
+
+@benchmark("inventory")
+def bench_inventory(args):
+    """
+    Lectura, actualización en bloque y memoria del índice de stock por locación
+    frente a la representación anterior (lista de diccionarios por locación).
+    Cada locación vende `--skus-per-location` SKUs al azar de un catálogo de
+    `--skus`, así que la memoria debe seguir al surtido y no al catálogo.
+    """
+    import tracemalloc
+    from inventory import LocationStockIndex
+
+    rng = random.Random(0)
+    locations, skus = args.locations, args.skus
+    per_location = min(args.skus_per_location, skus)
+    print(f"{locations} locaciones x {per_location} SKUs de un catálogo de {skus}")
+    assortments = [sorted(rng.sample(range(skus), per_location)) for _ in range(locations)]
+
+    tracemalloc.start()
+    index = LocationStockIndex()
+    for location_id, product_ids in enumerate(assortments):
+        index.update(location_id, dict.fromkeys(product_ids, 100))
+    index_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    # Se mide una locación con listas de dicts y se extrapola al total
+    legacy = [{"product_id": product_id, "quantity": 100} for product_id in assortments[0]]
+    legacy_bytes = tracemalloc.get_traced_memory()[0] * locations
+    tracemalloc.stop()
+
+    probes = [(location_id, rng.choice(assortments[location_id]))
+              for location_id in (rng.randrange(locations) for _ in range(1000))]
+    lookup_us = timeit(lambda: [index.get(loc, pid) for loc, pid in probes], args.repeat) / len(probes)
+    scan_probes = assortments[0][:100]
+    scan_us = timeit(lambda: [next(s for s in legacy if s["product_id"] == pid) for pid in scan_probes], 3) / len(scan_probes)
+
+    order = {product_id: rng.randint(0, 100) for product_id in rng.sample(assortments[0], min(10, per_location))}
+    update_us = timeit(lambda: index.update(0, order), args.repeat)
+    rebuild_us = timeit(lambda: [{"product_id": s["product_id"], "quantity": s["quantity"]} for s in legacy], 3)
+
+    print(f"lookup:  índice {lookup_us:.3f} us, lista {scan_us:.1f} us")
+    print(f"update ({len(order)} SKUs): índice {update_us:.1f} us, reconstrucción de lista {rebuild_us:.1f} us")
+    print(f"memoria: índice {index_bytes / 2**20:.1f} MiB (arrays {index.nbytes / 2**20:.1f} MiB), "
+          f"listas de dicts ~{legacy_bytes / 2**20:.1f} MiB")
+
+
+def _consume_worker(inbox, results, work_us):
+    # Proceso consumidor: cada lote del inbox equivale a una ventana de prefetch
+    from types import SimpleNamespace
+    from publisher import FakeBroker
+    from worker import OrderConsumer
+
+    def handler(order):
+        # Simula el trabajo de CPU por orden (reserva de stock, pago, ...)
+        deadline = time.perf_counter() + work_us / 1e6
+        while time.perf_counter() < deadline:
+            pass
+
+    channel = FakeBroker().connection().channel()
+    consumer = OrderConsumer(handler)
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            break
+        for tag, (body, content_type) in enumerate(batch):
+            properties = SimpleNamespace(content_type=content_type, headers=None)
+            consumer.on_message(channel, SimpleNamespace(delivery_tag=tag), properties, body)
+    results.put(consumer.stats["processed"])
+
+
+@benchmark("worker")
+def bench_worker(args):
+    """
+    Órdenes por segundo del worker según el número de procesos, usando una
+    multiprocessing.Queue como sustituto del broker.
+    """
+    import multiprocessing
+    import os
+    from codec import encode_order
+
+    messages = [encode_order({"order_id": i, "user_id": 1, "product_ids": [1, 2, 3], "quantity": [1, 2, 1],
+                              "location_id": 1}, "binary") for i in range(args.orders)]
+    batches = [messages[i:i + args.prefetch] for i in range(0, len(messages), args.prefetch)]
+    cpus = os.cpu_count() or 1
+    counts = sorted({1, 2, 4, cpus} & set(range(1, cpus + 1)))
+    print(f"{'processes':>9} {'orders/s':>10}")
+    for processes in counts:
+        inbox, results = multiprocessing.Queue(), multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_consume_worker, args=(inbox, results, args.work_us))
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        start = time.perf_counter()
+        for batch in batches:
+            inbox.put(batch)
+        for _ in workers:
+            inbox.put(None)
+        processed = sum(results.get() for _ in workers)
+        elapsed = time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+        print(f"{processes:>9} {processed / elapsed:>10.0f}")
+
+
+@benchmark("metrics")
+def bench_metrics(args):
+    """
+    Coste de la instrumentación: middleware de métricas por request,
+    temporizadores del camino caliente y muestreo de logs repetidos.
+    """
+    import asyncio
+    import logging
+    import os
+    import httpx
+    import main
+    from metrics import MetricsMiddleware, SampledLogFilter
+    from publisher import OrderPublisher
+
+    main.warmup.run()
+
+    async def requests_us(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            await http.get("/stock/2/quantity")
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                await http.get("/stock/2/quantity")
+            return (time.perf_counter() - start) / args.requests * 1e6
+
+    def app_with(metrics: bool):
+        # La pila de middlewares se arma en la primera request: basta con vaciarla
+        main.app.user_middleware = [m for m in middleware if metrics or m.cls is not MetricsMiddleware]
+        main.app.middleware_stack = None
+        return main.app
+
+    middleware = list(main.app.user_middleware)
+    bare = asyncio.run(requests_us(app_with(False)))
+    measured = asyncio.run(requests_us(app_with(True)))
+    print(f"{'GET /stock/{id}/quantity':>28}: sin métricas {bare:7.1f} us, con métricas {measured:7.1f} us "
+          f"(+{measured - bare:.1f} us)")
+
+    main.order_publisher = OrderPublisher(lambda: None, max_queue=2 * args.repeat + 10)
+    order = {"order_id": 1, "user_id": 1, "product_ids": [1, 2], "quantity": [1, 1], "location_id": 1}
+    for label, func, args_ in (("publish_order", main.publish_order, (order,)),
+                               ("update_location_stock", main.update_location_stock, (1, [1, 2]))):
+        plain = timeit(lambda: func.__wrapped__(*args_), args.repeat)
+        timed = timeit(lambda: func(*args_), args.repeat)
+        print(f"{label:>28}: sin temporizador {plain:7.2f} us, con temporizador {timed:7.2f} us (+{timed - plain:.2f} us)")
+
+    def block():
+        with main.hot_path.time("benchmark"):
+            pass
+    print(f"{'hot_path.time() vacío':>28}: {timeit(block, args.repeat):7.2f} us")
+
+    logger = logging.getLogger("benchmark.metrics")
+    logger.propagate = False
+    with open(os.devnull, "w") as devnull:
+        handler = logging.StreamHandler(devnull)
+        logger.addHandler(handler)
+        emit = lambda: logger.warning("Reintentando orden %s (%d/%d): %s", 123, 1, 5, "timeout")
+        unsampled = timeit(emit, args.repeat)
+        handler.addFilter(SampledLogFilter(per_second=10))
+        sampled = timeit(emit, args.repeat)
+        logger.removeHandler(handler)
+    print(f"{'logging.warning repetido':>28}: sin muestreo {unsampled:7.2f} us, con muestreo {sampled:7.2f} us")
+
+
+@benchmark("render")
+def bench_render(args):
+    """
+    Throughput de /products y /locations recorriendo el listado completo en
+    páginas de 1000: antes (valor en caché, validado contra response_model y
+    serializado en cada request), con los bytes pre-serializados en caché y
+    con GET condicional (If-None-Match -> 304).
+    """
+    import asyncio
+    from typing import List, Optional
+    import httpx
+    from fastapi import FastAPI, Query
+    import main
+
+    main.warmup.run()
+    load_dataset(main, args.sizes[-1], args.locations, 5)
+    baseline = FastAPI()
+
+    @baseline.get("/products", response_model=List[main.Product])
+    @main.cache.cached("products")
+    async def products(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1)):
+        return await main.list_response(main.db_products, lambda product_id, product: {"id": product_id, **product},
+                                        after_id, limit, "json")
+
+    @baseline.get("/locations", response_model=List[main.location])
+    @main.cache.cached("locations")
+    async def locations(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1)):
+        row = lambda location_id, location: {"id": location_id, **location, "stock": main.location_stock_list(location_id)}
+        return await main.list_response(main.db_location, row, after_id, limit, "json")
+
+    async def run(app, path, total, conditional):
+        pages = [f"{path}?limit=1000" + (f"&after_id={after}" if after else "") for after in range(0, total, 1000)]
+        etags = {}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            # Primera pasada: llena la caché
+            for page in pages:
+                etags[page] = (await http.get(page)).headers.get("etag")
+            sent = 0
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                for page in pages:
+                    headers = {"If-None-Match": etags[page]} if conditional else {}
+                    sent += len((await http.get(page, headers=headers)).content)
+            elapsed = time.perf_counter() - start
+        requests = args.repeat * len(pages)
+        return requests / elapsed, args.repeat * total / elapsed, sent / requests
+
+    print(f"{'endpoint':>10} {'modo':>16} {'páginas/s':>10} {'items/s':>12} {'bytes/página':>13}")
+    for path, total in (("/products", args.sizes[-1]), ("/locations", args.locations)):
+        for label, app, conditional in (("antes", baseline, False), ("pre-serializado", main.app, False),
+                                        ("If-None-Match", main.app, True)):
+            pages_s, items_s, page_bytes = asyncio.run(run(app, path, total, conditional))
+            print(f"{path:>10} {label:>16} {pages_s:>10.0f} {items_s:>12.0f} {page_bytes:>13.0f}")
+
+
+@benchmark("import")
+def bench_import(args):
+    """
+    Importación de un archivo de stock de `--orders` filas (CSV y NDJSON,
+    comprimidos con gzip) hacia cada backend: filas/s y memoria pico
+    (tracemalloc) del importador en streaming frente a cargar el archivo
+    entero y validar y escribir fila por fila. Al final, exportación a CSV.
+    """
+    import csv
+    import gzip
+    import json
+    import os
+    import tempfile
+    import tracemalloc
+    from dataio import StockRow, encode_rows, export_rows, import_rows, read_rows
+    from pagination import KeysetTable
+    from storage import SQLiteStorage
+
+    rng = random.Random(5)
+    quantities = [rng.randint(0, 500) for _ in range(args.orders)]
+
+    def naive(path, fmt, table):
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as stream:
+            rows = list(csv.DictReader(stream)) if fmt == "csv" else [json.loads(line) for line in stream]
+        for row in rows:
+            row = StockRow.model_validate(row)
+            table[row.product_id] = {"product_id": row.product_id, "quantity": row.quantity}
+
+    def streaming(path, fmt, table):
+        with gzip.open(path, "rb") as stream:
+            import_rows("stock", table, read_rows(stream, fmt))
+
+    def measure(func, *func_args):
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(*func_args)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return elapsed, peak
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {"csv": os.path.join(tmp, "stock.csv.gz"), "ndjson": os.path.join(tmp, "stock.ndjson.gz")}
+        with gzip.open(paths["csv"], "wt", encoding="utf-8", newline="") as out:
+            out.write("product_id,quantity\n")
+            out.writelines(f"{product_id},{quantity}\n" for product_id, quantity in enumerate(quantities, 1))
+        with gzip.open(paths["ndjson"], "wt", encoding="utf-8") as out:
+            out.writelines(json.dumps({"product_id": product_id, "quantity": quantity}) + "\n"
+                           for product_id, quantity in enumerate(quantities, 1))
+
+        backends = {"memory": KeysetTable, "sqlite": lambda: SQLiteStorage(os.path.join(tmp, f"{time.monotonic_ns()}.db")).table("stock")}
+        print(f"{args.orders} filas de stock (tracemalloc activo: los tiempos incluyen su costo)")
+        print(f"{'formato':>8} {'backend':>8} {'modo':>10} {'filas/s':>10} {'pico MiB':>9}")
+        for fmt, path in paths.items():
+            for backend in args.backends:
+                for label, func in (("por fila", naive), ("streaming", streaming)):
+                    table = backends[backend]()
+                    elapsed, peak = measure(func, path, fmt, table)
+                    assert len(table) == args.orders
+                    print(f"{fmt:>8} {backend:>8} {label:>10} {args.orders / elapsed:>10.0f} {peak / 2**20:>9.1f}")
+
+        def export(table):
+            with open(os.devnull, "wb") as out:
+                for chunk in encode_rows(export_rows("stock", table), "csv", StockRow.model_fields):
+                    out.write(chunk)
+
+        for backend in args.backends:
+            table = backends[backend]()
+            streaming(paths["csv"], "csv", table)
+            elapsed, peak = measure(export, table)
+            print(f"exportación CSV {backend}: {args.orders / elapsed:.0f} filas/s, pico {peak / 2**20:.1f} MiB")
+
+
+@benchmark("availability")
+def bench_availability(args):
+    """
+    Búsqueda de locaciones que surten una canasta con `--locations` locales
+    agrupados alrededor de varias ciudades y un catálogo de `--skus` SKUs.
+    Cada local vende `--skus-per-location` SKUs elegidos con popularidad
+    sesgada (Zipf), como las canastas. Compara recorrer cada locación (lo
+    que hacía un cliente llamando a /locations/{id}/stock/{product_id} por
+    local) con el índice invertido producto -> locaciones más el espacial.
+    """
+    import itertools
+    import main
+    from geo import SpatialIndex, haversine_km
+    from inventory import LocationStockIndex
+
+    main.warmup.run()
+    rng = random.Random(11)
+    cities = [(-12.05, -77.04), (-16.40, -71.54), (-8.11, -79.03), (-6.77, -79.84), (-3.75, -73.25), (-13.53, -71.97)]
+    cum_weights = list(itertools.accumulate(1 / rank ** 0.8 for rank in range(1, args.skus + 1)))
+    popular = lambda k: rng.choices(range(1, args.skus + 1), cum_weights=cum_weights, k=k)
+
+    start = time.perf_counter()
+    stock_index, points, positions = LocationStockIndex(), SpatialIndex(), {}
+    for location_id in range(1, args.locations + 1):
+        lat, lon = rng.choice(cities)
+        positions[location_id] = (rng.gauss(lat, 0.2), rng.gauss(lon, 0.2))
+        points.add(location_id, *positions[location_id])
+        stock_index.update(location_id, {product_id: rng.randint(0, 20) for product_id in popular(args.skus_per_location)})
+    build = time.perf_counter() - start
+    main.location_stock, main.location_points = stock_index, points
+    print(f"{args.locations} locales x {args.skus} SKUs ({args.skus_per_location} por local), índices en {build:.1f} s")
+
+    def per_location(items, lat, lon, limit):
+        # Antes: una consulta de stock por locación y SKU, y ordenar todas por distancia
+        found = [
+            (haversine_km(lat, lon, *positions[location_id]), location_id)
+            for location_id in stock_index.locations()
+            if all((stock_index.get(location_id, product_id) or 0) >= quantity for product_id, quantity in items.items())
+        ]
+        return [location_id for _, location_id in sorted(found)[:limit]]
+
+    print(f"{'canasta':>8} {'por locación(us)':>17} {'distance(us)':>13} {'coverage(us)':>13} {'candidatos':>11}")
+    for size in (1, 3, 5, 10):
+        queries = []
+        for _ in range(50):
+            lat, lon = rng.choice(cities)
+            queries.append(({product_id: rng.randint(1, 3) for product_id in popular(size)}, rng.gauss(lat, 0.1), rng.gauss(lon, 0.1)))
+        for items, lat, lon in queries:
+            assert [row[0] for row in main.rank_locations(items, lat, lon, "distance", 10)] == per_location(items, lat, lon, 10)
+        cycle = itertools.cycle(queries)
+
+        def run(func):
+            return timeit(lambda: func(*next(cycle)), args.repeat)
+
+        naive_us = run(lambda items, lat, lon: per_location(items, lat, lon, 10))
+        distance_us = run(lambda items, lat, lon: main.rank_locations(items, lat, lon, "distance", 10))
+        coverage_us = run(lambda items, lat, lon: main.rank_locations(items, lat, lon, "coverage", 10))
+        candidates = sum(len(main.basket_coverage(stock_index, items)) for items, _, _ in queries) / len(queries)
+        print(f"{size:>8} {naive_us:>17.0f} {distance_us:>13.1f} {coverage_us:>13.1f} {candidates:>11.0f}")
+
+
+@benchmark("idempotency")
+def bench_idempotency(args):
+    """
+    Reintentos concurrentes: cada una de `--orders` órdenes se crea y se paga
+    `--threads` veces en paralelo con la misma Idempotency-Key. Verifica que
+    cada orden se publique, descuente stock y acumule puntos una sola vez, y
+    mide el costo de la cabecera frente a las mismas requests sin ella.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi.testclient import TestClient
+    import main
+    from publisher import OrderPublisher
+
+    main.warmup.run()
+    client = TestClient(main.app)
+    skus = list(main.db_stock)[:20]
+    for product_id in skus:
+        main.db_stock[product_id] = {"product_id": product_id, "quantity": 10**9}
+    main.order_publisher = OrderPublisher(lambda: None, max_queue=10 * args.orders + 10)
+    rng = random.Random(5)
+
+    def make_orders(base):
+        return [{"order_id": base + i, "user_id": 1, "product_ids": rng.sample(skus, 2), "quantity": [1, 2],
+                 "location_id": 1} for i in range(args.orders)]
+
+    def sequential(orders, keyed):
+        start = time.perf_counter()
+        for order in orders:
+            headers = {"Idempotency-Key": f"b-{order['order_id']}"} if keyed else None
+            client.post("/orders/create", json=order, headers=headers)
+            client.post("/payments/process", json={"order_id": order["order_id"], "status": "Paid"}, headers=headers)
+        return (time.perf_counter() - start) / (2 * len(orders)) * 1e6
+
+    plain = sequential(make_orders(3 * 10**7), False)
+    keyed = sequential(make_orders(4 * 10**7), True)
+    print(f"{args.orders} órdenes en serie: sin clave {plain:.0f} us/request, con clave {keyed:.0f} us/request "
+          f"(+{keyed - plain:.0f} us)")
+
+    orders = make_orders(5 * 10**7)
+    stock_before = sum(main.db_stock[product_id]["quantity"] for product_id in skus)
+    points_before = main.loyalty.balance(1)
+    enqueued = main.order_publisher.stats["enqueued"]
+    attempts = [order for order in orders for _ in range(args.threads)]
+    rng.shuffle(attempts)
+
+    def create(order):
+        return client.post("/orders/create", json=order, headers={"Idempotency-Key": f"c-{order['order_id']}"}).status_code
+
+    def pay(order):
+        payment = {"order_id": order["order_id"], "status": "Paid"}
+        return client.post("/payments/process", json=payment, headers={"Idempotency-Key": f"p-{order['order_id']}"}).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        statuses = list(pool.map(create, attempts)) + list(pool.map(pay, attempts))
+    elapsed = time.perf_counter() - start
+
+    expected_points = sum(main.loyalty.points_for(main.order_amount(order)) for order in orders)
+    checks = {
+        "respuestas 200": statuses.count(200) == len(statuses),
+        "publicadas una vez": main.order_publisher.stats["enqueued"] - enqueued == len(orders),
+        "stock descontado una vez": stock_before - sum(main.db_stock[product_id]["quantity"] for product_id in skus)
+        == 3 * len(orders),
+        "puntos acumulados una vez": main.loyalty.balance(1) - points_before == expected_points,
+    }
+    print(f"{len(statuses)} intentos ({args.threads} por orden y operación) en {elapsed:.2f} s, "
+          f"{len(statuses) / elapsed:.0f} requests/s")
+    for label, ok in checks.items():
+        print(f"{label:>28}: {'ok' if ok else 'FALLA'}")
+
+
+def populate_storage(url: str, products: int, locations: int, orders: int, seed: int = 0):
+    """
+    Escribe un catálogo sintético en el almacenamiento de `url` (stock,
+    locaciones con 50 SKUs cada una y órdenes), para que main.py lo cargue
+    al arrancar en lugar de los datos iniciales.
+    """
+    from storage import open_storage
+
+    rng = random.Random(seed)
+    catalog = make_products(products, seed)
+    skus = list(catalog)
+    storage = open_storage(url)
+    storage.table("products").put_many(catalog.items())
+    storage.table("stock").put_many((product_id, {"product_id": product_id, "quantity": 10**6}) for product_id in skus)
+    storage.table("location").put_many(
+        (location_id, {"location_id": location_id, "location_name": f"Local {location_id}",
+                       "latitude": rng.uniform(-18, -3), "longitude": rng.uniform(-81, -69)})
+        for location_id in range(1, locations + 1)
+    )
+    storage.table("location_products").put_many(
+        (location_id, sorted(rng.sample(skus, min(50, len(skus))))) for location_id in range(1, locations + 1)
+    )
+    storage.table("orders").put_many(
+        (order_id, {"order_id": order_id, "user_id": order_id % 100, "product_ids": rng.sample(skus, min(3, len(skus))),
+                    "quantity": [1] * min(3, len(skus)), "location_id": 1})
+        for order_id in range(1, orders + 1)
+    )
+    storage.close()
+
+
+@benchmark("startup")
+def bench_startup(args):
+    """
+    Arranque en frío con `--sizes` productos en SQLite y un broker que no
+    responde (RABBITMQ_HOST apunta a una dirección sin destino). Cada medición
+    corre en un proceso nuevo (`startup-probe`): importación de main.py,
+    primera respuesta de /health/live, primera request de catálogo, readiness
+    y calentamiento completo. "eager" construye todo antes de atender, como
+    antes de la inicialización diferida.
+    """
+    import json
+    import os
+    import subprocess
+    import sys
+    import tempfile
+    from statistics import median
+
+    columns = ("import_ms", "live_ms", "first_request_ms", "ready_ms", "warm_ms", "process_ms")
+    print(f"{'productos':>10} {'modo':>6} " + " ".join(f"{column:>16}" for column in columns))
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite:///{tmp}/startup.db"
+            populate_storage(url, size, args.locations, args.orders)
+            env = {**os.environ, "STORAGE_URL": url, "RABBITMQ_HOST": "10.255.255.1"}
+            for mode in ("eager", "lazy"):
+                runs = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    output = subprocess.run(
+                        [sys.executable, __file__, "startup-probe", "--mode", mode],
+                        env=env, check=True, capture_output=True, text=True,
+                    ).stdout
+                    result = json.loads(output.strip().splitlines()[-1])
+                    result["process_ms"] = (time.perf_counter() - start) * 1000
+                    runs.append(result)
+                print(f"{size:>10} {mode:>6} " + " ".join(f"{median(run[column] for run in runs):>16.1f}" for column in columns))
+
+
+@benchmark("startup-probe")
+def bench_startup_probe(args):
+    """
+    Lo invoca `startup` en un proceso nuevo: milisegundos desde antes de
+    importar main.py hasta cada hito del arranque, en JSON por stdout.
+    """
+    import json
+    import os
+    import sys
+
+    start = time.perf_counter()
+    import main
+    if args.mode == "eager":
+        # Como antes: índices, saldos y hashes listos antes de atender requests
+        main.warmup.run()
+    result = {"import_ms": (time.perf_counter() - start) * 1000}
+    mark = time.perf_counter()
+    from fastapi.testclient import TestClient
+    # Importar el cliente de pruebas no es parte del arranque
+    offset = time.perf_counter() - mark
+    elapsed = lambda: (time.perf_counter() - start - offset) * 1000
+
+    client = TestClient(main.app)
+    client.__enter__()
+    assert client.get("/health/live").status_code == 200
+    result["live_ms"] = elapsed()
+    assert client.get("/products/name/ab").status_code == 200
+    result["first_request_ms"] = elapsed()
+    while client.get("/health/ready").status_code != 200:
+        time.sleep(0.001)
+    result["ready_ms"] = elapsed()
+    main.warmup.run()
+    result["warm_ms"] = elapsed()
+    print(json.dumps(result))
+    sys.stdout.flush()
+    # Sin apagar la app: los hilos del publicador siguen esperando al broker
+    os._exit(0)
+
+
+SUITE_SCENARIOS = ("browse", "checkout", "pos-sync")
+# Métricas donde un valor más alto es mejor; en las demás (latencias) es al revés
+HIGHER_IS_BETTER = {"rps"}
+
+
+def suite_scales(args) -> list:
+    """
+    Pares (productos, locaciones) a medir: --sizes y --location-sizes se
+    recorren en paralelo y la lista más corta repite su último valor.
+    """
+    count = max(len(args.sizes), len(args.location_sizes))
+    return [(args.sizes[min(i, len(args.sizes) - 1)], args.location_sizes[min(i, len(args.location_sizes) - 1)])
+            for i in range(count)]
+
+
+def load_dataset(main, products: int, locations: int, skus_per_location: int, seed: int = 0):
+    """
+    Reemplaza el catálogo, el stock y las locaciones de main.py por datos
+    sintéticos de la escala indicada. Cada locación vende `skus_per_location`
+    SKUs al azar (todos si el catálogo es más chico).
+    """
+    from geo import SpatialIndex
+    from inventory import LocationStockIndex, StockEngine
+    from publisher import OrderPublisher
+
+    # Antes de reemplazar los índices: el calentamiento no debe pisarlos después
+    main.warmup.run()
+    rng = random.Random(seed)
+    catalog = make_products(products, seed)
+    for table in (main.db_orders, main.db_payments, main.db_products, main.db_stock, main.db_location, main.db_location_products):
+        table.clear()
+    main.db_products.put_many(catalog.items())
+    main.product_index.build(catalog)
+    main.recommendation_index.build(catalog, ())
+    # Stock de sobra para que las reservas no rechacen órdenes durante la medición
+    main.db_stock.put_many((product_id, {"product_id": product_id, "quantity": 10**9}) for product_id in catalog)
+    main.stock_engine = StockEngine(main.db_stock, reservation_ttl=main.RESERVATION_TTL)
+    skus = list(catalog)
+    per_location = min(skus_per_location, len(skus))
+    assortments = [(location_id, sorted(rng.sample(skus, per_location))) for location_id in range(1, locations + 1)]
+    main.db_location.put_many((location_id, {"location_id": location_id, "location_name": f"Local {location_id}"})
+                              for location_id, _ in assortments)
+    main.db_location_products.put_many(assortments)
+    main.location_stock = LocationStockIndex()
+    main.location_points = SpatialIndex()
+    for location_id, product_ids in assortments:
+        main.location_stock.add_location(location_id)
+        main.location_stock.update(location_id, {product_id: 10**9 for product_id in product_ids})
+    # Sin broker: los mensajes quedan en la cola de salida del publicador
+    main.order_publisher = OrderPublisher(lambda: None, max_queue=10**7)
+    main.cache.clear()
+    return assortments
+
+
+def suite_micro(main, args, assortments) -> dict:
+    """
+    Latencia media (us) de los handlers llamados directamente, sin HTTP ni
+    caché de lectura (se usa la función original bajo el decorador).
+    """
+    import asyncio
+
+    rng = random.Random(1)
+    skus = list(main.product_index.products)
+    location_id, location_skus = assortments[0]
+    order = {"order_id": 1, "user_id": 1, "product_ids": rng.sample(skus, min(5, len(skus))), "quantity": [1] * 5,
+             "location_id": location_id}
+    order["quantity"] = order["quantity"][:len(order["product_ids"])]
+    product_id = skus[len(skus) // 2]
+    stock_quantity = main.get_stock_product_quantity.__wrapped__
+
+    async def stock_lookups():
+        for _ in range(args.repeat):
+            await stock_quantity(product_id)
+
+    def stock_lookup():
+        start = time.perf_counter()
+        asyncio.run(stock_lookups())
+        return (time.perf_counter() - start) / args.repeat * 1e6
+
+    results = {
+        "search_name": timeit(lambda: main.get_products_name.__wrapped__("medic", limit=50, offset=0), args.repeat),
+        "search_category": timeit(lambda: main.get_products_category.__wrapped__("first aid", limit=50, offset=0), args.repeat),
+        "stock_lookup": stock_lookup(),
+        "update_location_stock": timeit(lambda: main.update_location_stock(location_id, order["product_ids"]), args.repeat),
+        "update_location_stock_full": timeit(lambda: main.update_location_stock(location_id),
+                                             max(1, min(args.repeat, 100_000 // max(1, len(location_skus))))),
+        "publish_order": timeit(lambda: main.publish_order(order), args.repeat),
+        "order_validation": timeit(lambda: main.Order.model_validate(order), args.repeat),
+    }
+    return {name: {"us": value} for name, value in results.items()}
+
+
+def suite_sessions(scenario: str, rng: random.Random, skus: list, assortments: list, order_ids) -> list:
+    """
+    Requests de una sesión de usuario (se ejecutan en orden). browse:
+    catálogo, búsquedas, recomendaciones y stock; checkout: crear orden,
+    pagar y consultar puntos; pos-sync: un punto de venta sube su lote de
+    ventas y vuelve a bajar su stock.
+    """
+    location_id, location_skus = rng.choice(assortments)
+    if scenario == "browse":
+        product_id = rng.choice(skus)
+        return [
+            ("GET", f"/products?after_id={rng.choice(skus) - 1}&limit=50", None),
+            ("GET", f"/products/name/{rng.choice(['medic', 'ab', 'xyzq', 'pan'])}", None),
+            ("GET", f"/products/category/{rng.choice(CATEGORIES)}", None),
+            ("GET", f"/products/recomendations/{product_id}", None),
+            ("GET", f"/stock/{product_id}/quantity", None),
+            ("GET", f"/locations/{location_id}/stock/{rng.choice(location_skus)}/quantity", None),
+        ]
+    if scenario == "checkout":
+        order_id = next(order_ids)
+        product_ids = rng.sample(location_skus, min(3, len(location_skus)))
+        user_id = rng.randint(1, 1000)
+        return [
+            ("POST", "/orders/create", {"order_id": order_id, "user_id": user_id, "product_ids": product_ids,
+                                        "quantity": [1] * len(product_ids), "location_id": location_id}),
+            ("POST", "/payments/process", {"order_id": order_id, "status": "Paid"}),
+            ("GET", f"/loyalty/{user_id}", None),
+        ]
+    orders = []
+    for _ in range(50):
+        product_ids = rng.sample(location_skus, min(3, len(location_skus)))
+        orders.append({"order_id": next(order_ids), "user_id": rng.randint(1, 1000), "product_ids": product_ids,
+                       "quantity": [1] * len(product_ids), "location_id": location_id})
+    return [
+        ("POST", "/orders/bulk", orders),
+        ("POST", "/payments/bulk", [{"order_id": order["order_id"], "status": "Paid"} for order in orders]),
+        ("GET", f"/locations/{location_id}/stock", None),
+    ]
+
+
+def suite_macro(main, args, assortments, order_ids) -> dict:
+    """
+    Mezclas de carga contra la app ASGI en proceso: `--connections` sesiones
+    concurrentes hasta completar unas `--requests` requests por escenario.
+    """
+    import asyncio
+    import statistics
+    import httpx
+
+    skus = list(main.product_index.products)
+
+    async def run(scenario):
+        rng = random.Random(scenario)
+        latencies = []
+        errors = 0
+        sessions = []
+        while sum(len(session) for session in sessions) < args.requests:
+            sessions.append(suite_sessions(scenario, rng, skus, assortments, order_ids))
+        semaphore = asyncio.Semaphore(args.connections)
+        limits = httpx.Limits(max_connections=args.connections)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", limits=limits, timeout=None) as http:
+            async def one(session):
+                nonlocal errors
+                async with semaphore:
+                    for method, path, body in session:
+                        start = time.perf_counter()
+                        response = await http.request(method, path, json=body)
+                        latencies.append(time.perf_counter() - start)
+                        errors += response.status_code >= 400
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one(session) for session in sessions))
+            elapsed = time.perf_counter() - start
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return {"p50_ms": quantiles[49] * 1000, "p99_ms": quantiles[98] * 1000,
+                "rps": len(latencies) / elapsed, "errors": errors}
+
+    return {scenario: asyncio.run(run(scenario)) for scenario in args.scenarios}
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Métricas que empeoraron más de `tolerance` (fracción) respecto de la
+    línea base. Devuelve (resultado, métrica, base, actual, cambio).
+    """
+    regressions = []
+    for key, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(key, {}).get(metric)
+            if not base or metric == "errors":
+                continue
+            change = value / base - 1
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append((key, metric, base, value, change))
+    return regressions
+
+
+@benchmark("suite")
+def bench_suite(args):
+    """
+    Suite completa: microbenchmarks de los handlers y escenarios de carga
+    por cada escala de datos. Con --output guarda los resultados en JSON y
+    con --baseline los compara contra una corrida anterior (sale con código
+    1 si alguna métrica empeora más de --tolerance).
+    """
+    import itertools
+    import json
+    import platform
+    import subprocess
+    import sys
+    import main
+
+    results = {}
+    order_ids = itertools.count(10**9)
+    for products, locations in suite_scales(args):
+        label = f"products={products},locations={locations}"
+        start = time.perf_counter()
+        assortments = load_dataset(main, products, locations, args.skus_per_location)
+        print(f"== {label} (carga {time.perf_counter() - start:.1f} s)")
+        measured = {f"micro.{name}": value for name, value in suite_micro(main, args, assortments).items()}
+        if args.scenarios:
+            measured.update({f"macro.{name}": value for name, value in suite_macro(main, args, assortments, order_ids).items()})
+        for name, metrics in measured.items():
+            results[f"{name}[{label}]"] = metrics
+            print(f"{name:>34} " + "  ".join(f"{metric} {value:,.2f}" for metric, value in metrics.items()))
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "commit": commit,
+                 "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat": args.repeat, "requests": args.requests,
+                 "connections": args.connections},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Resultados guardados en {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_results(results, baseline, args.tolerance)
+        print(f"Comparación con {args.baseline} (tolerancia {args.tolerance:.0%}): {len(regressions)} regresiones")
+        for key, metric, base, value, change in regressions:
+            print(f"  {key} {metric}: {base:,.2f} -> {value:,.2f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 1_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--locations", type=int, default=1000)
+    parser.add_argument("--skus", type=int, default=10_000)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--prefetch", type=int, default=50)
+    parser.add_argument("--work-us", type=float, default=200, help="trabajo de CPU simulado por orden (us)")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--url", help="servidor real a medir en lugar de la app en proceso")
+    parser.add_argument("--backends", nargs="+", choices=sorted(STORAGE_BACKENDS), default=sorted(STORAGE_BACKENDS))
+    parser.add_argument("--latency", type=float, default=0.005, help="round trip simulado del broker (s)")
+    parser.add_argument("--location-sizes", type=int, nargs="+", default=[1, 100, 1_000, 10_000])
+    parser.add_argument("--skus-per-location", type=int, default=200)
+    parser.add_argument("--scenarios", nargs="*", choices=SUITE_SCENARIOS, default=list(SUITE_SCENARIOS))
+    parser.add_argument("--output", help="archivo JSON donde guardar los resultados de la suite")
+    parser.add_argument("--baseline", help="resultados JSON de una corrida anterior para comparar")
+    parser.add_argument("--mode", choices=("eager", "lazy"), default="lazy", help="arranque que mide startup-probe")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="empeoramiento admitido frente a la línea base")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
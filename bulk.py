@@ -0,0 +1,64 @@
+"""
+Utilidades para los endpoints masivos (/orders/bulk, /payments/bulk).
+"""
+import json
+from functools import lru_cache
+from typing import Any, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+class BulkPayloadError(ValueError):
+    """
+    El cuerpo no es un arreglo JSON ni un stream NDJSON válido.
+    """
+
+
+def parse_bulk_body(body: bytes, content_type: Optional[str], max_items: int) -> List[Any]:
+    """
+    Convierte el cuerpo en una lista de objetos. Acepta un arreglo JSON o,
+    si el content-type es NDJSON, un objeto JSON por línea.
+    """
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    try:
+        if media_type in NDJSON_CONTENT_TYPES:
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except ValueError as e:
+        raise BulkPayloadError(f"JSON inválido: {e}")
+    if not isinstance(items, list):
+        raise BulkPayloadError("Se esperaba un arreglo JSON o NDJSON")
+    if len(items) > max_items:
+        raise BulkPayloadError(f"Se admiten como máximo {max_items} elementos por llamada")
+    return items
+
+
+@lru_cache(maxsize=None)
+def _list_adapter(model: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+
+def validate_batch(model: Type[BaseModel], items: List[Any], batch_size: int = 1000) -> List[Tuple[Optional[BaseModel], Optional[str]]]:
+    """
+    Valida los elementos por lotes con un único TypeAdapter. Solo si un lote
+    falla se valida elemento a elemento para obtener el error de cada uno.
+    Devuelve, por elemento, (modelo, None) o (None, mensaje de error).
+    """
+    adapter = _list_adapter(model)
+    results: List[Tuple[Optional[BaseModel], Optional[str]]] = []
+    for start in range(0, len(items), batch_size):
+        chunk = items[start:start + batch_size]
+        try:
+            results.extend((value, None) for value in adapter.validate_python(chunk))
+            continue
+        except ValidationError:
+            pass
+        for item in chunk:
+            try:
+                results.append((model.model_validate(item), None))
+            except ValidationError as e:
+                results.append((None, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())))
+    return results
@@ -0,0 +1,421 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import Header
+from fastapi.responses import Response
+from pydantic import TypeAdapter
+
+
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    True si algún ETag de la cabecera If-None-Match coincide (o es "*").
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def rendered_response(rendered: Tuple[bytes, str], if_none_match: Optional[str]) -> Response:
+    body, etag = rendered
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+class MemoryCache:
+    """
+    Caché en proceso con política LRU y expiración por TTL.
+    """
+
+    def __init__(self, max_entries: int = 10_000, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class FakeRedis:
+    """
+    Sustituto mínimo de redis.Redis (get/setex/incr/flushdb) para pruebas sin servidor.
+    """
+
+    def __init__(self):
+        self._data: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def setex(self, key: str, ttl: int, value):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            entry = self._data.get(key)
+            value = int(entry[1]) + 1 if entry is not None else 1
+            self._data[key] = (float("inf"), str(value).encode("utf-8"))
+            return value
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """
+    Segundo nivel de caché sobre Redis. Los valores se guardan como JSON.
+    Los errores de Redis se registran y se tratan como un fallo de caché.
+    """
+
+    def __init__(self, client, ttl: int = 300, prefix: str = "inkafarma:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except Exception as e:
+            logging.error("Error leyendo de Redis: %s", e)
+            return None
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        try:
+            self.client.setex(self.prefix + key, int(ttl or self.ttl), json.dumps(value))
+        except Exception as e:
+            logging.error("Error escribiendo en Redis: %s", e)
+
+    def version(self, namespace: str) -> Optional[int]:
+        """
+        Versión compartida del espacio de nombres, o None si Redis no responde.
+        """
+        try:
+            raw = self.client.get(f"{self.prefix}version:{namespace}")
+        except Exception as e:
+            logging.error("Error leyendo de Redis: %s", e)
+            return None
+        return int(raw or 0)
+
+    def bump(self, namespace: str) -> Optional[int]:
+        """
+        Incrementa la versión compartida y devuelve la nueva, o None si Redis no responde.
+        """
+        try:
+            return int(self.client.incr(f"{self.prefix}version:{namespace}"))
+        except Exception as e:
+            logging.error("Error escribiendo en Redis: %s", e)
+            return None
+
+
+class CacheLayer:
+    """
+    Caché de lectura en dos niveles (memoria + Redis opcional) con
+    invalidación por espacio de nombres y contadores de aciertos/fallos.
+
+    Cada espacio de nombres ("products", "stock", "locations") tiene una
+    versión que forma parte de la clave; invalidar consiste en incrementarla,
+    de modo que las entradas anteriores dejan de ser alcanzables y expiran solas.
+    Con Redis la versión vive allí (INCR) y la comparten todos los procesos:
+    un contador propio de cada proceso, que además vuelve a 0 al reiniciar,
+    repetiría claves de Redis para datos distintos.
+    """
+
+    def __init__(self, local: Optional[MemoryCache] = None, remote: Optional[RedisCache] = None):
+        self.local = local if local is not None else MemoryCache()
+        self.remote = remote
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, namespace: str, field: str):
+        with self._lock:
+            counters = self.stats.setdefault(namespace, {"hits": 0, "misses": 0, "invalidations": 0})
+            counters[field] += 1
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{namespace}:{self._versions.get(namespace, 0)}:{key}"
+
+    def _advance(self, namespace: str, version: int):
+        with self._lock:
+            if version > self._versions.get(namespace, 0):
+                self._versions[namespace] = version
+
+    def _remote_key(self, namespace: str, key: str) -> Optional[str]:
+        """
+        Clave en Redis con la versión compartida del espacio de nombres (None
+        si Redis no responde). Si otro proceso invalidó, la versión local se
+        adelanta y las entradas en memoria anteriores dejan de valer.
+        """
+        version = self.remote.version(namespace)
+        if version is None:
+            return None
+        self._advance(namespace, version)
+        return f"{namespace}:{version}:{key}"
+
+    def _fetch_remote(self, namespace: str, key: str) -> Tuple[Optional[str], Any]:
+        remote_key = self._remote_key(namespace, key)
+        return remote_key, (self.remote.get(remote_key) if remote_key is not None else None)
+
+    def get(self, namespace: str, key: str):
+        value = self.local.get(self._key(namespace, key))
+        if value is None and self.remote is not None:
+            _, value = self._fetch_remote(namespace, key)
+            if value is not None:
+                self.local.set(self._key(namespace, key), value)
+        self._count(namespace, "misses" if value is None else "hits")
+        return value
+
+    def set(self, namespace: str, key: str, value: Any):
+        remote_key = self._remote_key(namespace, key) if self.remote is not None else None
+        self.local.set(self._key(namespace, key), value)
+        if remote_key is not None:
+            self.remote.set(remote_key, value)
+
+    async def aget(self, namespace: str, key: str):
+        """
+        Versión para handlers async: el nivel en memoria se consulta en el
+        event loop y Redis, que es bloqueante, en un hilo aparte.
+        """
+        value = self.local.get(self._key(namespace, key))
+        if value is None and self.remote is not None:
+            _, value = await asyncio.to_thread(self._fetch_remote, namespace, key)
+            if value is not None:
+                self.local.set(self._key(namespace, key), value)
+        self._count(namespace, "misses" if value is None else "hits")
+        return value
+
+    async def aset(self, namespace: str, key: str, value: Any):
+        remote_key = await asyncio.to_thread(self._remote_key, namespace, key) if self.remote is not None else None
+        self.local.set(self._key(namespace, key), value)
+        if remote_key is not None:
+            await asyncio.to_thread(self.remote.set, remote_key, value)
+
+    def invalidate(self, *namespaces: str) -> Dict[str, int]:
+        """
+        Invalida los espacios de nombres y devuelve sus versiones nuevas.
+        """
+        versions = {}
+        for namespace in namespaces:
+            shared = self.remote.bump(namespace) if self.remote is not None else None
+            with self._lock:
+                version = self._versions.get(namespace, 0) + 1
+                self._versions[namespace] = versions[namespace] = version if shared is None else max(version, shared)
+                counters = self.stats.setdefault(namespace, {"hits": 0, "misses": 0, "invalidations": 0})
+                counters["invalidations"] += 1
+        return versions
+
+    def invalidated_elsewhere(self, versions: Dict[str, int]):
+        """
+        Aplica la invalidación que hizo otro proceso (aviso por pub/sub) con
+        las versiones que devolvió su `invalidate`. Con Redis son las
+        compartidas y basta con adoptarlas: volver a incrementarlas dejaría
+        inalcanzables las entradas que los demás ya guardaron con la versión
+        nueva. Sin Redis cada proceso tiene las suyas y se incrementan (igual
+        que si el aviso no trae la versión).
+        """
+        for namespace, version in versions.items():
+            if self.remote is None or version is None:
+                self.invalidate(namespace)
+            else:
+                self._advance(namespace, int(version))
+                self._count(namespace, "invalidations")
+
+    def clear(self):
+        self.local.clear()
+        with self._lock:
+            self._versions.clear()
+            self.stats.clear()
+
+    def cached(self, namespace: str):
+        """
+        Decorador para endpoints de lectura. La clave se arma con el nombre
+        de la función y sus argumentos; las excepciones (p. ej. 404) y las
+        respuestas que no son listas o diccionarios (p. ej. streaming) no se cachean.
+        Admite funciones sync y async.
+
+        Las claves se fijan antes de llamar a la función: si otra request
+        invalida mientras tanto, el valor queda bajo la versión anterior.
+        """
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    key = f"{func.__name__}:{args}:{sorted(kwargs.items())}"
+                    full_key = self._key(namespace, key)
+                    value = self.local.get(full_key)
+                    if value is None:
+                        remote_key = None
+                        if self.remote is not None:
+                            remote_key, value = await asyncio.to_thread(self._fetch_remote, namespace, key)
+                            full_key = self._key(namespace, key)
+                        if value is None:
+                            self._count(namespace, "misses")
+                            value = await func(*args, **kwargs)
+                            if not isinstance(value, (list, dict)):
+                                return value
+                            if remote_key is not None:
+                                await asyncio.to_thread(self.remote.set, remote_key, value)
+                        else:
+                            self._count(namespace, "hits")
+                        self.local.set(full_key, value)
+                    else:
+                        self._count(namespace, "hits")
+                    return value
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                key = f"{func.__name__}:{args}:{sorted(kwargs.items())}"
+                full_key = self._key(namespace, key)
+                value = self.local.get(full_key)
+                if value is None:
+                    remote_key = None
+                    if self.remote is not None:
+                        remote_key, value = self._fetch_remote(namespace, key)
+                        full_key = self._key(namespace, key)
+                    if value is None:
+                        self._count(namespace, "misses")
+                        value = func(*args, **kwargs)
+                        if not isinstance(value, (list, dict)):
+                            return value
+                        if remote_key is not None:
+                            self.remote.set(remote_key, value)
+                    else:
+                        self._count(namespace, "hits")
+                    self.local.set(full_key, value)
+                else:
+                    self._count(namespace, "hits")
+                return value
+            return wrapper
+        return decorator
+
+    def cached_response(self, namespace: str, response_model):
+        """
+        Como `cached`, pero en memoria guarda la respuesta ya validada contra
+        `response_model` y codificada a JSON (bytes, con el codificador de
+        pydantic-core) junto con su ETag: se valida y serializa una vez por
+        versión del espacio de nombres, no por request. Un acierto devuelve
+        los bytes tal cual y, si el cliente envía If-None-Match con el mismo
+        ETag, un 304 sin cuerpo. Redis, si está configurado, sigue guardando
+        el valor para compartirlo entre workers.
+        """
+        adapter = TypeAdapter(response_model)
+
+        def render(value) -> Tuple[bytes, str]:
+            body = adapter.dump_json(adapter.validate_python(value))
+            return body, etag_for(body)
+
+        def decorator(func):
+            # La cabecera se agrega a la firma para que FastAPI la inyecte
+            parameters = list(inspect.signature(func).parameters.values())
+            parameters.append(inspect.Parameter(
+                "if_none_match", inspect.Parameter.KEYWORD_ONLY, default=Header(None), annotation=Optional[str],
+            ))
+            signature = inspect.signature(func).replace(parameters=parameters)
+
+            if inspect.iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, if_none_match: Optional[str] = None, **kwargs):
+                    key = f"{func.__name__}:{args}:{sorted(kwargs.items())}"
+                    full_key = self._key(namespace, key)
+                    rendered = self.local.get(full_key)
+                    if rendered is None:
+                        value, remote_key = None, None
+                        if self.remote is not None:
+                            remote_key, value = await asyncio.to_thread(self._fetch_remote, namespace, key)
+                            full_key = self._key(namespace, key)
+                        if value is None:
+                            value = await func(*args, **kwargs)
+                            if not isinstance(value, (list, dict)):
+                                return value
+                            if remote_key is not None:
+                                await asyncio.to_thread(self.remote.set, remote_key, value)
+                        rendered = render(value)
+                        self.local.set(full_key, rendered)
+                        self._count(namespace, "misses")
+                    else:
+                        self._count(namespace, "hits")
+                    return rendered_response(rendered, if_none_match)
+                async_wrapper.__signature__ = signature
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, if_none_match: Optional[str] = None, **kwargs):
+                key = f"{func.__name__}:{args}:{sorted(kwargs.items())}"
+                full_key = self._key(namespace, key)
+                rendered = self.local.get(full_key)
+                if rendered is None:
+                    value, remote_key = None, None
+                    if self.remote is not None:
+                        remote_key, value = self._fetch_remote(namespace, key)
+                        full_key = self._key(namespace, key)
+                    if value is None:
+                        value = func(*args, **kwargs)
+                        if not isinstance(value, (list, dict)):
+                            return value
+                        if remote_key is not None:
+                            self.remote.set(remote_key, value)
+                    rendered = render(value)
+                    self.local.set(full_key, rendered)
+                    self._count(namespace, "misses")
+                else:
+                    self._count(namespace, "hits")
+                return rendered_response(rendered, if_none_match)
+            wrapper.__signature__ = signature
+            return wrapper
+        return decorator
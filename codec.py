@@ -0,0 +1,164 @@
+"""
+Formato de mensajes de órdenes para la cola 'orders'.
+
+Cada mensaje lleva su content_type y la versión del esquema en las
+propiedades AMQP, de modo que los consumidores eligen el decodificador con
+`decode_order(body, content_type)` sin recurrir a eval/literal_eval.
+
+Formatos soportados:
+- application/json: JSON compacto (orjson si está instalado).
+- application/x-order-bin: binario empaquetado con struct; los arreglos
+  product_ids/quantity usan el entero más angosto que admita sus valores.
+"""
+import ast
+import json
+import struct
+from typing import Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional
+    orjson = None
+
+SCHEMA_VERSION = 1
+JSON_CONTENT_TYPE = "application/json"
+BINARY_CONTENT_TYPE = "application/x-order-bin"
+SCHEMA_HEADER = "x-schema-version"
+
+# Cabecera binaria: versión (B), order_id, user_id, location_id (q), número de
+# líneas (I) y el tipo struct usado para product_ids y para quantity (c)
+_HEADER = struct.Struct("<BqqqIcc")
+
+# Los arreglos se empaquetan con el entero más angosto que admita sus valores
+_WIDTHS = ((0xFF, b"B"), (0xFFFF, b"H"), (0xFFFFFFFF, b"I"))
+
+
+def _width(values: list) -> bytes:
+    if not values:
+        return b"B"
+    if min(values) < 0:
+        return b"q"
+    largest = max(values)
+    for limit, code in _WIDTHS:
+        if largest <= limit:
+            return code
+    return b"Q"
+
+
+class CodecError(ValueError):
+    """
+    El mensaje no se puede codificar o decodificar con el formato indicado.
+    """
+
+
+def _order_fields(order_data: dict) -> dict:
+    return {
+        "order_id": order_data["order_id"],
+        "user_id": order_data["user_id"],
+        "product_ids": list(order_data["product_ids"]),
+        "quantity": list(order_data["quantity"]),
+        "location_id": order_data["location_id"],
+    }
+
+
+def encode_json(order_data: dict) -> bytes:
+    message = {"v": SCHEMA_VERSION, **_order_fields(order_data)}
+    if orjson is not None:
+        try:
+            return orjson.dumps(message)
+        except TypeError as e:  # orjson.JSONEncodeError, p. ej. un entero de más de 64 bits
+            raise CodecError(f"No se puede codificar la orden: {e}")
+    return json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+
+def decode_json(body: bytes) -> dict:
+    message = orjson.loads(body) if orjson is not None else json.loads(body)
+    version = message.pop("v", None)
+    if version != SCHEMA_VERSION:
+        raise CodecError(f"Versión de esquema no soportada: {version}")
+    return message
+
+
+def encode_binary(order_data: dict) -> bytes:
+    order = _order_fields(order_data)
+    count = len(order["product_ids"])
+    if len(order["quantity"]) != count:
+        raise CodecError("product_ids y quantity deben tener la misma longitud")
+    ids_code = _width(order["product_ids"])
+    qty_code = _width(order["quantity"])
+    try:
+        header = _HEADER.pack(
+            SCHEMA_VERSION, order["order_id"], order["user_id"], order["location_id"], count, ids_code, qty_code
+        )
+        return (
+            header
+            + struct.pack(f"<{count}{ids_code.decode()}", *order["product_ids"])
+            + struct.pack(f"<{count}{qty_code.decode()}", *order["quantity"])
+        )
+    except struct.error as e:
+        # Enteros que no entran en 64 bits
+        raise CodecError(f"No se puede codificar la orden: {e}")
+
+
+def decode_binary(body: bytes) -> dict:
+    try:
+        version, order_id, user_id, location_id, count, ids_code, qty_code = _HEADER.unpack_from(body)
+    except struct.error as e:
+        raise CodecError(f"Mensaje binario inválido: {e}")
+    if version != SCHEMA_VERSION:
+        raise CodecError(f"Versión de esquema no soportada: {version}")
+    try:
+        ids_format = struct.Struct(f"<{count}{ids_code.decode()}")
+        product_ids = ids_format.unpack_from(body, _HEADER.size)
+        quantity = struct.unpack_from(f"<{count}{qty_code.decode()}", body, _HEADER.size + ids_format.size)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise CodecError(f"Mensaje binario inválido: {e}")
+    return {
+        "order_id": order_id,
+        "user_id": user_id,
+        "product_ids": list(product_ids),
+        "quantity": list(quantity),
+        "location_id": location_id,
+    }
+
+
+def decode_legacy(body: bytes) -> dict:
+    """
+    Mensajes antiguos publicados como str(dict), sin content_type.
+    """
+    return ast.literal_eval(body.decode("utf-8"))
+
+
+CODECS = {
+    "json": (JSON_CONTENT_TYPE, encode_json),
+    "binary": (BINARY_CONTENT_TYPE, encode_binary),
+}
+
+DECODERS = {
+    JSON_CONTENT_TYPE: decode_json,
+    BINARY_CONTENT_TYPE: decode_binary,
+}
+
+
+def encode_order(order_data: dict, codec: str = "json") -> Tuple[bytes, str]:
+    """
+    Codifica una orden y devuelve (body, content_type).
+    """
+    try:
+        content_type, encoder = CODECS[codec]
+    except KeyError:
+        raise CodecError(f"Codec desconocido: {codec}")
+    return encoder(order_data), content_type
+
+
+def decode_order(body: bytes, content_type: Optional[str] = None) -> dict:
+    """
+    Decodifica una orden según el content_type de las propiedades del mensaje.
+    """
+    if content_type is None:
+        return decode_legacy(body)
+    try:
+        decoder = DECODERS[content_type]
+    except KeyError:
+        raise CodecError(f"content_type no soportado: {content_type}")
+    return decoder(body)
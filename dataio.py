@@ -0,0 +1,380 @@
+"""
+Importación y exportación masiva del catálogo y el inventario.
+
+Los archivos se leen en streaming (CSV, NDJSON o, si pyarrow está
+instalado, Parquet; los .gz se descomprimen al vuelo) y se procesan por
+bloques de `chunk_size` filas: cada bloque se valida con un único
+TypeAdapter (bulk.validate_batch) y se escribe con un put_many (una
+transacción en los backends SQL). Los índices en memoria (búsqueda, stock
+por locación) no se tocan por fila: el importador devuelve las claves
+afectadas y main.py los actualiza una sola vez al final. Los datasets
+agrupados (location_products) se escriben grupo a grupo, al cambiar la
+clave, por lo que conviene que el archivo venga ordenado por ella.
+
+Modos de importación:
+- delta: inserta o actualiza las filas del archivo.
+- full: el archivo es la foto completa; se eliminan las claves que no trae.
+- delete: elimina las claves del archivo (solo se valida la columna clave).
+
+Uso, contra el STORAGE_URL configurado:
+    python dataio.py import products catalogo.csv --mode full
+    python dataio.py import stock stock-local-12.ndjson.gz
+    python dataio.py export stock stock.csv.gz
+"""
+import argparse
+import csv
+import gzip
+import importlib
+import io
+import json
+import sys
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type
+
+from pydantic import BaseModel, Field, create_model
+
+from bulk import validate_batch
+from pagination import iter_rows, ndjson_lines
+
+FORMATS = ("csv", "ndjson", "parquet")
+MODES = ("delta", "full", "delete")
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+class DataFormatError(ValueError):
+    """
+    Formato de archivo desconocido o no disponible.
+    """
+
+
+class RowError(str):
+    """
+    Fila que no se pudo leer del archivo (p. ej. una línea CSV con más o
+    menos columnas que el encabezado). import_rows la rechaza con este
+    mensaje sin pasarla por la validación.
+    """
+
+
+class ProductRow(BaseModel):
+    id: int
+    name: str
+    price: float
+    # Vacío si el archivo no la trae: el listado exige una cadena
+    category: str = ""
+
+
+class StockRow(BaseModel):
+    product_id: int
+    quantity: int
+
+
+class LocationRow(BaseModel):
+    location_id: int
+    location_name: str
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+
+class LocationProductRow(BaseModel):
+    location_id: int
+    product_id: int
+
+
+@dataclass(frozen=True)
+class Dataset:
+    model: Type[BaseModel]
+    key: str
+    columns: Tuple[str, ...]
+    # Fila validada -> valor guardado en la tabla
+    value: Callable[[BaseModel], Any]
+    # (clave, valor) de la tabla -> filas exportadas
+    rows: Callable[[Any, Any], Iterable[dict]]
+    # Varias filas del archivo forman el valor de una misma clave (una lista)
+    grouped: bool = False
+    # (columna, dataset): la columna debe ser una clave existente de ese dataset
+    references: Tuple[Tuple[str, str], ...] = ()
+
+    @property
+    def key_model(self) -> Type[BaseModel]:
+        return _key_model(self.model.__name__, self.key)
+
+
+@lru_cache(maxsize=None)
+def _key_model(name: str, key: str) -> Type[BaseModel]:
+    return create_model(name + "Key", **{key: (int, ...)})
+
+
+DATASETS: Dict[str, Dataset] = {
+    "products": Dataset(
+        ProductRow, "id", ("id", "name", "price", "category"),
+        lambda row: {"name": row.name, "price": row.price, "category": row.category},
+        lambda key, value: [{"id": key, **value}],
+    ),
+    "stock": Dataset(
+        StockRow, "product_id", ("product_id", "quantity"),
+        lambda row: {"product_id": row.product_id, "quantity": row.quantity},
+        lambda key, value: [{"product_id": key, "quantity": value["quantity"]}],
+    ),
+    "locations": Dataset(
+        LocationRow, "location_id", ("location_id", "location_name", "latitude", "longitude"),
+        lambda row: row.model_dump(),
+        lambda key, value: [{"location_id": key, "location_name": value["location_name"],
+                             "latitude": value.get("latitude"), "longitude": value.get("longitude")}],
+    ),
+    "location_products": Dataset(
+        LocationProductRow, "location_id", ("location_id", "product_id"),
+        lambda row: row.product_id,
+        lambda key, value: ({"location_id": key, "product_id": product_id} for product_id in value),
+        grouped=True,
+        # Un SKU sin stock no se puede ofrecer en una locación
+        references=(("product_id", "stock"),),
+    ),
+}
+
+
+def detect_format(name: str) -> str:
+    """
+    Formato según la extensión del archivo (sin contar un .gz final).
+    """
+    name = name.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    if name.endswith(".parquet"):
+        return "parquet"
+    raise DataFormatError(f"No se reconoce el formato de {name!r} (use .csv, .ndjson o .parquet)")
+
+
+def open_file(path: str, mode: str = "rb"):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+def read_rows(stream: BinaryIO, format: str) -> Iterator[Any]:
+    """
+    Recorre las filas del archivo sin cargarlo entero. En CSV los campos
+    vacíos se tratan como ausentes y una línea con otra cantidad de columnas
+    que el encabezado se entrega como RowError; una línea NDJSON inválida se
+    entrega tal cual. Así se rechazan sin cortar la importación.
+    """
+    if format == "csv":
+        text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+        try:
+            # csv.reader + zip: DictReader cuesta el doble por fila
+            reader = csv.reader(text)
+            header = next(reader, [])
+            for values in reader:
+                if not values:
+                    continue
+                if len(values) != len(header):
+                    yield RowError(f"línea {reader.line_num}: {len(values)} columnas, se esperaban {len(header)}")
+                elif "" in values:
+                    yield {column: value for column, value in zip(header, values) if value != ""}
+                else:
+                    yield dict(zip(header, values))
+        except csv.Error as e:
+            raise DataFormatError(f"CSV inválido: {e}")
+    elif format == "ndjson":
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield line.decode("utf-8", "replace").strip()
+    elif format == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise DataFormatError("Leer Parquet requiere pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(stream).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        raise DataFormatError(f"Formato desconocido: {format!r}")
+
+
+def chunked(rows: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_rows(
+    dataset: str,
+    table,
+    rows: Iterable[Any],
+    mode: str = "delta",
+    chunk_size: int = 10_000,
+    max_errors: int = 100,
+    tables: Optional[Callable[[str], Any]] = None,
+) -> Tuple[dict, Set]:
+    """
+    Importa las filas en `table` por bloques. Devuelve el reporte (filas
+    leídas, importadas, eliminadas, rechazadas y los primeros `max_errors`
+    errores con su número de fila) y el conjunto de claves afectadas, para
+    que quien llama actualice sus índices una sola vez. Con `tables`
+    (dataset -> tabla) se rechazan, salvo en delete, las filas cuyas
+    referencias (Dataset.references) no existen.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Modo desconocido: {mode!r}")
+    spec = DATASETS[dataset]
+    model = spec.key_model if mode == "delete" and not spec.grouped else spec.model
+    report = {"dataset": dataset, "mode": mode, "rows": 0, "imported": 0, "deleted": 0, "rejected": 0, "errors": []}
+    touched: Set = set()
+    references = spec.references if tables is not None and mode != "delete" else ()
+    # Claves referenciadas ya encontradas: cada una se consulta una sola vez
+    found: Dict[str, Set] = {dataset: set() for _, dataset in references}
+    # Grupo en curso y grupos cerrados que faltan escribir en este bloque
+    group_key, members = None, set()
+    pending: Dict[Any, List] = {}
+    start = time.perf_counter()
+    for chunk in chunked(rows, chunk_size):
+        items = []
+        results = iter(validate_batch(model, [row for row in chunk if not isinstance(row, RowError)], batch_size=chunk_size))
+        for row in chunk:
+            value, error = (None, str(row)) if isinstance(row, RowError) else next(results)
+            if error is None and references:
+                error = _missing_reference(value, references, tables, found)
+            report["rows"] += 1
+            if error is not None:
+                report["rejected"] += 1
+                if len(report["errors"]) < max_errors:
+                    report["errors"].append({"row": report["rows"], "detail": error})
+                continue
+            key = getattr(value, spec.key)
+            if spec.grouped:
+                if key != group_key and members:
+                    _close_group(table, group_key, members, mode, pending, touched, report)
+                    members = set()
+                group_key = key
+                members.add(spec.value(value))
+            else:
+                items.append((key, value))
+        if spec.grouped:
+            if pending:
+                table.put_many(pending.items())
+                pending.clear()
+            continue
+        keys = [key for key, _ in items]
+        if mode == "delete":
+            table.delete_many(keys)
+            report["deleted"] += len(keys)
+        else:
+            table.put_many((key, spec.value(value)) for key, value in items)
+            report["imported"] += len(items)
+        touched.update(keys)
+
+    if members:
+        _close_group(table, group_key, members, mode, pending, touched, report)
+        table.put_many(pending.items())
+    if mode == "full":
+        # Lo que no vino en la foto completa se elimina
+        stale = [key for key in table if key not in touched]
+        table.delete_many(stale)
+        report["deleted"] += len(stale)
+        touched.update(stale)
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report, touched
+
+
+def _missing_reference(value: BaseModel, references, tables: Callable[[str], Any], found: Dict[str, Set]) -> Optional[str]:
+    for column, dataset in references:
+        key = getattr(value, column)
+        if key in found[dataset]:
+            continue
+        if key not in tables(dataset):
+            return f"{column}: {key} no existe en {dataset}"
+        found[dataset].add(key)
+    return None
+
+
+def _close_group(table, key, members: Set, mode: str, pending: Dict[Any, List], touched: Set, report: dict):
+    """
+    Cierra el grupo de `key` (location_id -> lista de product_id) y deja su
+    valor en `pending` para escribirlo al final del bloque. Con el archivo
+    ordenado por clave solo hay un grupo abierto a la vez. En delta se
+    agregan a la lista existente, en delete se quitan de ella y en full la
+    reemplazan; si la clave vuelve a aparecer más adelante (archivo sin
+    ordenar), se agrega a lo que ya se importó.
+    """
+    if key in pending:
+        current = set(pending[key])
+    elif mode == "full" and key not in touched:
+        current = set()
+    else:
+        current = set(table.get(key, ()))
+    value = current - members if mode == "delete" else current | members
+    pending[key] = sorted(value)
+    touched.add(key)
+    report["deleted" if mode == "delete" else "imported"] += len(members)
+
+
+def export_rows(dataset: str, table) -> Iterator[dict]:
+    """
+    Recorre la tabla por keyset (bloques de 1000 claves) y devuelve las
+    filas con las columnas del dataset.
+    """
+    spec = DATASETS[dataset]
+    for key, value in iter_rows(table, lambda key, value: (key, value)):
+        yield from spec.rows(key, value)
+
+
+def encode_rows(rows: Iterator[dict], format: str, columns: Tuple[str, ...], rows_per_chunk: int = 1000) -> Iterator[bytes]:
+    """
+    Serializa las filas en bloques de bytes (CSV con cabecera o NDJSON).
+    """
+    if format == "ndjson":
+        yield from ndjson_lines(rows, rows_per_chunk)
+        return
+    if format != "csv":
+        raise DataFormatError(f"No se puede exportar en formato {format!r}")
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore", lineterminator="\n")
+    writer.writeheader()
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("path")
+    parser.add_argument("--mode", choices=MODES, default="delta")
+    parser.add_argument("--format", choices=FORMATS, help="por defecto, según la extensión del archivo")
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    fmt = args.format or detect_format(args.path)
+    # main.py abre el almacenamiento de STORAGE_URL y sabe qué índices reconstruir
+    app = importlib.import_module("main")
+    app.warmup.ensure()
+    if args.action == "import":
+        with open_file(args.path) as stream:
+            report = app.import_dataset(args.dataset, read_rows(stream, fmt), args.mode, args.chunk_size)
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        return
+    with open_file(args.path, "wb") as out:
+        rows = export_rows(args.dataset, app.dataset_table(args.dataset))
+        for chunk in encode_rows(rows, fmt, DATASETS[args.dataset].columns):
+            out.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Avisos entre workers por pub/sub de Redis.
+
+Con varios procesos cada uno mantiene sus índices en memoria (stock por
+locación, caché de lectura). Cuando un proceso cambia el stock publica las
+cantidades nuevas y los demás actualizan sus vistas locales.
+"""
+import json
+import logging
+import threading
+import uuid
+from typing import Callable, Optional
+
+
+class EventBus:
+    """
+    Canal pub/sub de Redis. `publish` envía un evento (diccionario JSON) y
+    un hilo de fondo entrega al handler los eventos de los demás procesos;
+    los propios se descartan mediante el campo `origin`.
+    """
+
+    def __init__(self, client, channel: str = "inkafarma:events", poll_interval: float = 0.5):
+        self.client = client
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.origin = uuid.uuid4().hex
+        self.stats = {"published": 0, "received": 0, "errors": 0}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    def publish(self, event: dict):
+        try:
+            self.client.publish(self.channel, json.dumps({**event, "origin": self.origin}))
+            self.stats["published"] += 1
+        except Exception as e:
+            # Un aviso perdido solo retrasa la actualización de las vistas remotas
+            self.stats["errors"] += 1
+            logging.error("Error publicando evento en Redis: %s", e)
+
+    def start(self, handler: Callable[[dict], None]):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._listen, args=(handler,), name="event-bus", daemon=True)
+        self._thread.start()
+        # Los eventos publicados antes de suscribirse se perderían
+        self._ready.wait(timeout=5)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _listen(self, handler: Callable[[dict], None]):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.channel)
+            self._ready.set()
+            while not self._stop.is_set():
+                try:
+                    message = pubsub.get_message(timeout=self.poll_interval)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logging.error("Error leyendo eventos de Redis: %s", e)
+                    self._stop.wait(self.poll_interval)
+                    continue
+                if message is None:
+                    continue
+                event = json.loads(message["data"])
+                if event.get("origin") == self.origin:
+                    continue
+                self.stats["received"] += 1
+                try:
+                    handler(event)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logging.error("Error aplicando evento %s: %s", event, e)
+        finally:
+            self._ready.set()
+            pubsub.close()
@@ -0,0 +1,164 @@
+"""
+Índice espacial de las locaciones: búsqueda de las más cercanas a un punto.
+"""
+import heapq
+import math
+from typing import Collection, Dict, Hashable, Iterator, List, Optional, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Con pocos candidatos es más barato medir la distancia a cada uno que
+# recorrer celdas de la grilla
+BRUTE_FORCE_CANDIDATES = 256
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Distancia de círculo máximo en kilómetros.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex:
+    """
+    Grilla de celdas de `cell_degrees` grados (0.05° ~ 5.5 km); cada celda
+    guarda las claves de los puntos que caen en ella.
+
+    `nearest` recorre anillos de celdas alrededor del punto consultado y se
+    detiene cuando ningún punto fuera de los anillos recorridos puede estar
+    más cerca que los ya encontrados, así que el costo depende de la
+    densidad de locaciones alrededor del punto y no del total. No contempla
+    el salto de longitud en ±180°.
+    """
+
+    __slots__ = ("cell_degrees", "_cells", "_points", "_bounds", "_max_abs_lat")
+
+    def __init__(self, cell_degrees: float = 0.05):
+        self.cell_degrees = cell_degrees
+        self._cells: Dict[Tuple[int, int], set] = {}
+        self._points: Dict[Hashable, Tuple[float, float, Tuple[int, int]]] = {}
+        # Celdas extremas ocupadas (no se achican al eliminar: la cota sigue siendo válida)
+        self._bounds: Optional[List[int]] = None
+        self._max_abs_lat = 0.0
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, key) -> bool:
+        return key in self._points
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def add(self, key, latitude: float, longitude: float):
+        self.remove(key)
+        cell = self._cell(latitude, longitude)
+        self._cells.setdefault(cell, set()).add(key)
+        self._points[key] = (latitude, longitude, cell)
+        self._max_abs_lat = max(self._max_abs_lat, abs(latitude))
+        i, j = cell
+        if self._bounds is None:
+            self._bounds = [i, i, j, j]
+        else:
+            bounds = self._bounds
+            bounds[0], bounds[1] = min(bounds[0], i), max(bounds[1], i)
+            bounds[2], bounds[3] = min(bounds[2], j), max(bounds[3], j)
+
+    def remove(self, key):
+        point = self._points.pop(key, None)
+        if point is None:
+            return
+        keys = self._cells[point[2]]
+        keys.discard(key)
+        if not keys:
+            del self._cells[point[2]]
+
+    def position(self, key) -> Optional[Tuple[float, float]]:
+        point = self._points.get(key)
+        return None if point is None else point[:2]
+
+    def distance(self, key, latitude: float, longitude: float) -> Optional[float]:
+        """
+        Kilómetros desde el punto hasta la clave, o None si no tiene coordenadas.
+        """
+        point = self._points.get(key)
+        return None if point is None else haversine_km(latitude, longitude, point[0], point[1])
+
+    def _ring(self, ci: int, cj: int, r: int) -> Iterator[Tuple[int, int]]:
+        """
+        Celdas ocupables a distancia de Chebyshev exactamente `r` de (ci, cj).
+        """
+        min_i, max_i, min_j, max_j = self._bounds
+        if r == 0:
+            yield ci, cj
+            return
+        for i in (ci - r, ci + r):
+            if min_i <= i <= max_i:
+                for j in range(max(cj - r, min_j), min(cj + r, max_j) + 1):
+                    yield i, j
+        for j in (cj - r, cj + r):
+            if min_j <= j <= max_j:
+                for i in range(max(ci - r + 1, min_i), min(ci + r - 1, max_i) + 1):
+                    yield i, j
+
+    def nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        limit: int = 10,
+        accept: Optional[Collection] = None,
+        max_km: Optional[float] = None,
+    ) -> List[Tuple[Hashable, float]]:
+        """
+        Hasta `limit` pares (clave, km) ordenados por distancia. Con `accept`
+        solo se consideran esas claves; con `max_km`, las que están a esa
+        distancia o menos.
+        """
+        if limit <= 0 or not self._points:
+            return []
+        if accept is not None and len(accept) <= BRUTE_FORCE_CANDIDATES:
+            found = []
+            for key in accept:
+                point = self._points.get(key)
+                if point is None:
+                    continue
+                km = haversine_km(latitude, longitude, point[0], point[1])
+                if max_km is None or km <= max_km:
+                    found.append((km, key))
+            return [(key, km) for km, key in heapq.nsmallest(limit, found)]
+
+        ci, cj = self._cell(latitude, longitude)
+        min_i, max_i, min_j, max_j = self._bounds
+        # Anillos que no tocan la zona ocupada no tienen nada que revisar
+        first = max(0, min_i - ci, ci - max_i, min_j - cj, cj - max_j)
+        last = max(ci - min_i, max_i - ci, cj - min_j, max_j - cj)
+        # Ancho mínimo de una celda en km (la longitud se acorta con la latitud)
+        cell_km = self.cell_degrees * KM_PER_DEGREE * math.cos(math.radians(min(89.0, max(self._max_abs_lat, abs(latitude)))))
+        heap: List[Tuple[float, Hashable]] = []
+        for r in range(first, last + 1):
+            for cell in self._ring(ci, cj, r):
+                keys = self._cells.get(cell)
+                if not keys:
+                    continue
+                for key in keys:
+                    if accept is not None and key not in accept:
+                        continue
+                    lat, lon, _ = self._points[key]
+                    km = haversine_km(latitude, longitude, lat, lon)
+                    if max_km is not None and km > max_km:
+                        continue
+                    if len(heap) < limit:
+                        heapq.heappush(heap, (-km, key))
+                    elif km < -heap[0][0]:
+                        heapq.heapreplace(heap, (-km, key))
+            # Todo punto fuera de los anillos 0..r está al menos a r celdas
+            bound = r * cell_km
+            if len(heap) >= limit and -heap[0][0] <= bound:
+                break
+            if max_km is not None and bound > max_km:
+                break
+        return sorted(((key, -km) for km, key in heap), key=lambda item: (item[1], item[0]))
@@ -0,0 +1,270 @@
+"""
+Idempotencia de las escrituras: cabecera Idempotency-Key, almacén de
+deduplicación con TTL (en memoria o en Redis) y reproducción de la
+respuesta guardada ante un reintento.
+
+El almacén guarda, por clave, la huella del cuerpo de la request y la
+respuesta (None mientras la request original sigue en curso). El mismo
+almacén sirve para deduplicar mensajes por message_id en el worker.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+from metrics import Counter
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+REPLAYED_HEADER = b"idempotent-replayed"
+
+# (status, headers, body) de una respuesta guardada
+StoredResponse = Tuple[int, List[Tuple[bytes, bytes]], bytes]
+# (huella del cuerpo, respuesta o None si sigue en curso)
+Record = Tuple[str, Optional[StoredResponse]]
+
+
+def fingerprint(*parts: bytes) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class MemoryIdempotencyStore:
+    """
+    Claves con TTL en un OrderedDict acotado a `max_keys` (al llenarse se
+    descartan las más antiguas). Una clave reservada que no se completa
+    (p. ej. el proceso cayó a mitad de la request) vence a los
+    `pending_ttl` segundos para que un reintento pueda volver a ejecutarla.
+    """
+
+    remote = False
+
+    def __init__(self, ttl: float = 86400, max_keys: int = 100_000, pending_ttl: float = 30.0):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.pending_ttl = pending_ttl
+        # clave -> (vencimiento, huella, respuesta)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def claim(self, key: str, fingerprint: str) -> Optional[Record]:
+        """
+        Reserva la clave para quien llama y devuelve None, o devuelve el
+        registro existente (huella, respuesta) si ya estaba reservada.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1], entry[2]
+            self._entries[key] = (now + self.pending_ttl, fingerprint, None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        return None
+
+    def get(self, key: str) -> Optional[Record]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1], entry[2]
+
+    def complete(self, key: str, fingerprint: str, response: Optional[StoredResponse] = None):
+        """
+        Guarda la respuesta de la clave reservada por `ttl` segundos.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, fingerprint, response or (0, [], b""))
+            self._entries.move_to_end(key)
+
+    def release(self, key: str):
+        """
+        Libera una clave reservada sin respuesta (la request falló y un
+        reintento debe volver a ejecutarla).
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisIdempotencyStore:
+    """
+    Misma interfaz sobre Redis, compartida entre workers: la reserva es un
+    SET NX con vencimiento, así que solo un proceso ejecuta cada clave.
+    """
+
+    remote = True
+
+    def __init__(self, client, ttl: float = 86400, pending_ttl: float = 30.0, prefix: str = "inkafarma:idempotency:"):
+        self.client = client
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.prefix = prefix
+
+    @staticmethod
+    def _encode(fingerprint: str, response: Optional[StoredResponse]) -> str:
+        if response is not None:
+            status, headers, body = response
+            response = [
+                status,
+                [[name.decode("latin-1"), value.decode("latin-1")] for name, value in headers],
+                base64.b64encode(body).decode("ascii"),
+            ]
+        return json.dumps([fingerprint, response])
+
+    @staticmethod
+    def _decode(raw) -> Record:
+        fingerprint, response = json.loads(raw)
+        if response is not None:
+            status, headers, body = response
+            response = (
+                status,
+                [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+                base64.b64decode(body),
+            )
+        return fingerprint, response
+
+    def claim(self, key: str, fingerprint: str) -> Optional[Record]:
+        full_key = self.prefix + key
+        for _ in range(2):
+            if self.client.set(full_key, self._encode(fingerprint, None), nx=True, px=int(self.pending_ttl * 1000)):
+                return None
+            raw = self.client.get(full_key)
+            # Si venció entre el SET y el GET, se vuelve a intentar la reserva
+            if raw is not None:
+                return self._decode(raw)
+        return None
+
+    def get(self, key: str) -> Optional[Record]:
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else self._decode(raw)
+
+    def complete(self, key: str, fingerprint: str, response: Optional[StoredResponse] = None):
+        self.client.set(self.prefix + key, self._encode(fingerprint, response or (0, [], b"")), px=int(self.ttl * 1000))
+
+    def release(self, key: str):
+        self.client.delete(self.prefix + key)
+
+
+class IdempotencyMiddleware:
+    """
+    Middleware ASGI para las escrituras de `paths` que traen la cabecera
+    Idempotency-Key:
+
+    - La primera request con una clave se ejecuta y su respuesta se guarda
+      (salvo un 5xx, que libera la clave para que el reintento se ejecute).
+    - Un reintento con la misma clave y el mismo cuerpo recibe la respuesta
+      guardada, con `Idempotent-Replayed: true`, sin volver a ejecutar el
+      handler. Si la original sigue en curso, espera hasta `wait_timeout`
+      segundos y, si no termina, responde 409.
+    - La misma clave con otro cuerpo responde 422.
+
+    Con `registry` (metrics.MetricsRegistry) cuenta las requests por resultado.
+    """
+
+    def __init__(self, app, store, paths: Iterable[str], registry=None, wait_timeout: float = 5.0, poll_interval: float = 0.005):
+        self.app = app
+        self.store = store
+        self.paths = frozenset(paths)
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        args = ("idempotent_requests_total", "Requests con Idempotency-Key por resultado", ("outcome",))
+        self.requests = registry.counter(*args) if registry is not None else Counter(*args)
+
+    async def _call(self, func, *args):
+        # Redis se consulta desde un hilo para no bloquear el event loop
+        if self.store.remote:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        header = next((value for name, value in scope["headers"] if name == IDEMPOTENCY_HEADER), None)
+        if header is None:
+            await self.app(scope, receive, send)
+            return
+
+        # El cuerpo se lee completo para calcular su huella y luego se entrega al handler
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        key = scope["path"] + ":" + header.decode("latin-1")
+        digest = fingerprint(scope.get("query_string", b""), body)
+
+        record = await self._call(self.store.claim, key, digest)
+        deadline = time.monotonic() + self.wait_timeout
+        while record is not None and record[1] is None and time.monotonic() < deadline:
+            # La request original sigue en curso: se espera su respuesta
+            await asyncio.sleep(self.poll_interval)
+            record = await self._call(self.store.get, key)
+            if record is None:
+                # La original falló y liberó la clave: este reintento la ejecuta
+                record = await self._call(self.store.claim, key, digest)
+        if record is not None:
+            stored_digest, response = record
+            if stored_digest != digest:
+                self.requests.inc("conflict")
+                await self._error(send, 422, "Idempotency-Key reutilizada con otro cuerpo")
+            elif response is None:
+                self.requests.inc("in_progress")
+                await self._error(send, 409, "Una request con esta Idempotency-Key sigue en curso")
+            else:
+                self.requests.inc("replayed")
+                status, headers, response_body = response
+                await send({"type": "http.response.start", "status": status, "headers": headers + [(REPLAYED_HEADER, b"true")]})
+                await send({"type": "http.response.body", "body": response_body})
+            return
+
+        sent = False
+
+        async def replay_receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        status = 500
+        headers: List[Tuple[bytes, bytes]] = []
+        response_chunks: List[bytes] = []
+
+        async def capture_send(message):
+            nonlocal status, headers
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                response_chunks.append(message.get("body", b""))
+            await send(message)
+
+        self.requests.inc("executed")
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except BaseException:
+            await self._call(self.store.release, key)
+            raise
+        if status >= 500:
+            await self._call(self.store.release, key)
+        else:
+            await self._call(self.store.complete, key, digest, (status, headers, b"".join(response_chunks)))
+
+    async def _error(self, send, status: int, detail: str):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,669 @@
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+EMPTY_SET: Set[int] = frozenset()
+
+
+class LocationStockIndex:
+    """
+    Índice (location_id, product_id) -> cantidad para el stock por locación.
+
+    Cada locación guarda su surtido en dos arrays paralelos ordenados por
+    product_id: array('q') con los SKUs y array('q') con las cantidades (16
+    bytes por SKU que vende; las cantidades aceptan cualquier entero de 64
+    bits, como db_stock), en lugar de una lista de diccionarios. La
+    memoria crece con el surtido real de cada locación, no con el tamaño del
+    catálogo. Leer una cantidad es una búsqueda binaria y una actualización
+    solo toca los SKUs indicados.
+
+    Además lleva el índice invertido product_id -> locaciones que lo venden,
+    para responder "quién tiene este producto" sin recorrer cada locación.
+    """
+
+    __slots__ = ("_rows", "_carriers")
+
+    def __init__(self):
+        self._rows: Dict[int, Tuple[array, array]] = {}
+        self._carriers: Dict[int, Set[int]] = {}
+
+    def __contains__(self, location_id: int) -> bool:
+        return location_id in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add_location(self, location_id: int):
+        self._rows.setdefault(location_id, (array("q"), array("q")))
+
+    def remove_location(self, location_id: int):
+        for product_id in list(self.product_ids(location_id)):
+            self._carriers[product_id].discard(location_id)
+        self._rows.pop(location_id, None)
+
+    def set(self, location_id: int, product_id: int, quantity: int):
+        self.update(location_id, {product_id: quantity})
+
+    def update(self, location_id: int, quantities: Dict[int, int]):
+        """
+        Actualiza solo los SKUs indicados de una locación. Los que ya vende se
+        escriben en su lugar; los nuevos se intercalan en una sola pasada.
+        """
+        product_ids, row = self._rows.setdefault(location_id, (array("q"), array("q")))
+        added = []
+        for product_id, quantity in quantities.items():
+            i = bisect_left(product_ids, product_id)
+            if i < len(product_ids) and product_ids[i] == product_id:
+                row[i] = quantity
+            else:
+                added.append((product_id, quantity))
+        if not added:
+            return
+        for product_id, _ in added:
+            self._carriers.setdefault(product_id, set()).add(location_id)
+        if len(added) == 1:
+            product_id, quantity = added[0]
+            i = bisect_left(product_ids, product_id)
+            product_ids.insert(i, product_id)
+            row.insert(i, quantity)
+            return
+        merged = sorted([*zip(product_ids, row), *added])
+        self._rows[location_id] = (array("q", [p for p, _ in merged]), array("q", [q for _, q in merged]))
+
+    def remove(self, location_id: int, product_id: int):
+        entry = self._rows.get(location_id)
+        if entry is None:
+            return
+        product_ids, row = entry
+        i = bisect_left(product_ids, product_id)
+        if i < len(product_ids) and product_ids[i] == product_id:
+            del product_ids[i]
+            del row[i]
+            self._carriers[product_id].discard(location_id)
+
+    def get(self, location_id: int, product_id: int) -> Optional[int]:
+        """
+        Cantidad del producto en la locación, o None si no lo vende.
+        """
+        entry = self._rows.get(location_id)
+        if entry is None:
+            return None
+        product_ids, row = entry
+        i = bisect_left(product_ids, product_id)
+        if i < len(product_ids) and product_ids[i] == product_id:
+            return row[i]
+        return None
+
+    def locations(self) -> Iterable[int]:
+        return self._rows.keys()
+
+    def carriers(self, product_id: int) -> Set[int]:
+        """
+        Locaciones que venden el producto (no modificar el conjunto devuelto).
+        """
+        return self._carriers.get(product_id, EMPTY_SET)
+
+    def product_ids(self, location_id: int) -> Iterable[int]:
+        entry = self._rows.get(location_id)
+        return iter(entry[0]) if entry is not None else iter(())
+
+    def items(self, location_id: int) -> Iterator[Tuple[int, int]]:
+        """
+        Recorre los pares (product_id, cantidad) que vende la locación, por product_id.
+        """
+        entry = self._rows.get(location_id)
+        return zip(*entry) if entry is not None else iter(())
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memoria ocupada por los arrays de SKUs y cantidades.
+        """
+        return sum(
+            product_ids.itemsize * len(product_ids) + row.itemsize * len(row)
+            for product_ids, row in self._rows.values()
+        )
+
+
+def basket_coverage(index: LocationStockIndex, items: Dict[int, int], complete: bool = True) -> Dict[int, int]:
+    """
+    Locaciones que pueden surtir las líneas de `items` (product_id ->
+    cantidad), con el número de líneas que surte cada una. Con `complete`
+    solo se devuelven las que surten todas: se intersecan los conjuntos del
+    índice invertido empezando por el producto que menos locaciones venden,
+    así que el costo lo fija el SKU más raro de la canasta y no el total de
+    locaciones.
+    """
+    if not items:
+        return {}
+    if not complete:
+        counts: Dict[int, int] = {}
+        for product_id, quantity in items.items():
+            for location_id in index.carriers(product_id):
+                if index.get(location_id, product_id) >= quantity:
+                    counts[location_id] = counts.get(location_id, 0) + 1
+        return counts
+    candidates: Optional[Set[int]] = None
+    for product_id in sorted(items, key=lambda product_id: len(index.carriers(product_id))):
+        quantity = items[product_id]
+        carriers = index.carriers(product_id)
+        pool = carriers if candidates is None else candidates
+        candidates = {
+            location_id for location_id in pool
+            if location_id in carriers and index.get(location_id, product_id) >= quantity
+        }
+        if not candidates:
+            return {}
+    return dict.fromkeys(candidates, len(items))
+
+
+class StockError(Exception):
+    """
+    Error base del motor de inventario.
+    """
+
+
+class InsufficientStock(StockError):
+    def __init__(self, product_id: int, requested: int, available: int):
+        super().__init__(f"Stock insuficiente para el producto {product_id}: pedido {requested}, disponible {available}")
+        self.product_id = product_id
+        self.requested = requested
+        self.available = available
+
+
+class UnknownProduct(StockError):
+    def __init__(self, product_id: int):
+        super().__init__(f"Producto {product_id} no existe")
+        self.product_id = product_id
+
+
+class InvalidQuantity(StockError):
+    def __init__(self, product_id: int, quantity: int):
+        super().__init__(f"Cantidad inválida para el producto {product_id}: {quantity} (debe ser mayor que 0)")
+        self.product_id = product_id
+        self.quantity = quantity
+
+
+class AlreadyCommitted(StockError):
+    def __init__(self, order_id: int):
+        super().__init__(f"La orden {order_id} ya fue pagada")
+        self.order_id = order_id
+
+
+def order_items(product_ids: List[int], quantities: List[int]) -> Dict[int, int]:
+    """
+    Agrupa las líneas de una orden en product_id -> cantidad total.
+    """
+    items: Dict[int, int] = {}
+    for product_id, quantity in zip(product_ids, quantities):
+        items[product_id] = items.get(product_id, 0) + quantity
+    return items
+
+
+class StockEngine:
+    """
+    Motor de inventario atómico sobre db_stock.
+
+    Todas las líneas de una orden se aplican o ninguna. Cada SKU se protege
+    con uno de `shards` locks (product_id % shards); una operación toma solo
+    los locks de sus SKUs, siempre en orden creciente para evitar deadlocks,
+    así que órdenes con productos distintos no compiten entre sí.
+
+    Flujo: reserve (al crear la orden) -> commit (al pagar) o release (al
+    cancelar o vencer el TTL de la reserva). El stock disponible es
+    quantity - reservado.
+    """
+
+    def __init__(self, stock: Dict[int, dict], shards: int = 64, reservation_ttl: float = 900.0):
+        self.stock = stock
+        self.reservation_ttl = reservation_ttl
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._reserved: Dict[int, int] = {}
+        # order_id -> (items, expires_at); el heap permite vencer reservas en O(log n)
+        self._reservations: Dict[int, Tuple[Dict[int, int], float]] = {}
+        self._expirations: List[Tuple[float, int]] = []
+        self._committed: Set[int] = set()
+        self._orders_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self, product_ids: Iterable[int]):
+        shards = sorted({product_id % len(self._locks) for product_id in product_ids})
+        for shard in shards:
+            self._locks[shard].acquire()
+        try:
+            yield
+        finally:
+            for shard in reversed(shards):
+                self._locks[shard].release()
+
+    def available(self, product_id: int) -> int:
+        entry = self.stock.get(product_id)
+        if entry is None:
+            raise UnknownProduct(product_id)
+        return entry["quantity"] - self._reserved.get(product_id, 0)
+
+    def _check(self, items: Dict[int, int], pending: Optional[Dict[int, int]] = None):
+        # `pending` son cantidades ya comprometidas por órdenes anteriores del mismo lote.
+        # Una cantidad negativa sumaría stock al descontarla
+        for product_id, quantity in items.items():
+            if quantity <= 0:
+                raise InvalidQuantity(product_id, quantity)
+            available = self.available(product_id) - (pending.get(product_id, 0) if pending else 0)
+            if quantity > available:
+                raise InsufficientStock(product_id, quantity, available)
+
+    def reserve(self, order_id: int, items: Dict[int, int], ttl: Optional[float] = None):
+        """
+        Reserva el stock de una orden. Si la orden ya tenía una reserva, se reemplaza.
+        """
+        error = self.reserve_many([(order_id, items)], ttl)[0]
+        if error is not None:
+            raise error
+
+    def reserve_many(self, orders: List[Tuple[int, Dict[int, int]]], ttl: Optional[float] = None) -> List[Optional[StockError]]:
+        """
+        Reserva un lote de órdenes (con order_id distintos) tomando los locks
+        una sola vez y aplicando un único incremento de reserva por SKU.
+        Devuelve, por orden, None si se reservó o el error que lo impidió.
+        """
+        self.expire()
+        results: List[Optional[StockError]] = [None] * len(orders)
+        for order_id, _ in orders:
+            self.release(order_id)
+        with self._orders_lock:
+            for i, (order_id, _) in enumerate(orders):
+                if order_id in self._committed:
+                    results[i] = AlreadyCommitted(order_id)
+        products = {product_id for _, items in orders for product_id in items}
+        with self._locked(products):
+            pending: Dict[int, int] = {}
+            for i, (_, items) in enumerate(orders):
+                if results[i] is not None:
+                    continue
+                try:
+                    self._check(items, pending)
+                except StockError as e:
+                    results[i] = e
+                    continue
+                for product_id, quantity in items.items():
+                    pending[product_id] = pending.get(product_id, 0) + quantity
+            for product_id, quantity in pending.items():
+                self._reserved[product_id] = self._reserved.get(product_id, 0) + quantity
+        expires_at = time.monotonic() + (self.reservation_ttl if ttl is None else ttl)
+        with self._orders_lock:
+            for (order_id, items), error in zip(orders, results):
+                if error is None:
+                    self._reservations[order_id] = (items, expires_at)
+                    heapq.heappush(self._expirations, (expires_at, order_id))
+        return results
+
+    def release(self, order_id: int) -> bool:
+        """
+        Libera la reserva de una orden. Devuelve False si no había reserva.
+        """
+        with self._orders_lock:
+            reservation = self._reservations.pop(order_id, None)
+        if reservation is None:
+            return False
+        items, _ = reservation
+        with self._locked(items):
+            self._unreserve(items)
+        return True
+
+    def _unreserve(self, items: Dict[int, int]):
+        for product_id, quantity in items.items():
+            remaining = self._reserved.get(product_id, 0) - quantity
+            if remaining > 0:
+                self._reserved[product_id] = remaining
+            else:
+                self._reserved.pop(product_id, None)
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """
+        Libera las reservas vencidas y devuelve cuántas se liberaron.
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._orders_lock:
+            while self._expirations and self._expirations[0][0] <= now:
+                expires_at, order_id = heapq.heappop(self._expirations)
+                reservation = self._reservations.get(order_id)
+                # Las entradas del heap de reservas reemplazadas o ya pagadas se ignoran
+                if reservation is not None and reservation[1] == expires_at:
+                    del self._reservations[order_id]
+                    expired.append(reservation[0])
+        for items in expired:
+            with self._locked(items):
+                self._unreserve(items)
+        return len(expired)
+
+    def commit(self, order_id: int, items: Dict[int, int]):
+        """
+        Descuenta el stock de una orden pagada, consumiendo su reserva si la
+        tiene. Una orden solo se puede confirmar una vez.
+        """
+        error = self.commit_many([(order_id, items)])[0]
+        if error is not None:
+            raise error
+
+    def commit_many(self, orders: List[Tuple[int, Dict[int, int]]]) -> List[Optional[StockError]]:
+        """
+        Confirma un lote de órdenes tomando los locks una sola vez y aplicando
+        un único descuento por SKU. Cada orden se aplica completa o no se
+        aplica; devuelve, por orden, None o el error correspondiente.
+        """
+        results: List[Optional[StockError]] = [None] * len(orders)
+        reservations: List[Optional[Tuple[Dict[int, int], float]]] = [None] * len(orders)
+        with self._orders_lock:
+            for i, (order_id, _) in enumerate(orders):
+                if order_id in self._committed:
+                    results[i] = AlreadyCommitted(order_id)
+                    continue
+                self._committed.add(order_id)
+                reservations[i] = self._reservations.pop(order_id, None)
+        products = {product_id for _, items in orders for product_id in items}
+        products.update(product_id for r in reservations if r is not None for product_id in r[0])
+        with self._locked(products):
+            decrement: Dict[int, int] = {}
+            for i, (_, items) in enumerate(orders):
+                if results[i] is not None:
+                    continue
+                # Solo la reserva de esta orden pasa a ser stock disponible para ella;
+                # las del resto del lote siguen reservadas mientras se comprueba
+                reservation = reservations[i]
+                if reservation is not None:
+                    self._unreserve(reservation[0])
+                try:
+                    self._check(items, decrement)
+                except StockError as e:
+                    results[i] = e
+                    # La orden rechazada conserva su reserva
+                    if reservation is not None:
+                        for product_id, quantity in reservation[0].items():
+                            self._reserved[product_id] = self._reserved.get(product_id, 0) + quantity
+                    continue
+                for product_id, quantity in items.items():
+                    decrement[product_id] = decrement.get(product_id, 0) + quantity
+            self._apply(decrement)
+        with self._orders_lock:
+            for (order_id, _), reservation, error in zip(orders, reservations, results):
+                if error is not None and not isinstance(error, AlreadyCommitted):
+                    self._committed.discard(order_id)
+                    if reservation is not None:
+                        self._reservations[order_id] = reservation
+        return results
+
+    def _apply(self, items: Dict[int, int]):
+        for product_id, quantity in items.items():
+            # Se reasigna la entrada para que los backends persistentes registren el cambio
+            entry = self.stock[product_id]
+            self.stock[product_id] = {**entry, "quantity": entry["quantity"] - quantity}
+
+    def is_committed(self, order_id: int) -> bool:
+        return order_id in self._committed
+
+    def mark_committed(self, order_ids: Iterable[int]):
+        """
+        Registra órdenes ya pagadas en una ejecución anterior (p. ej. las de
+        db_payments al arrancar) para que no se puedan confirmar de nuevo.
+        """
+        with self._orders_lock:
+            self._committed.update(order_ids)
+
+
+# Scripts Lua del motor compartido. Redis ejecuta cada script de forma
+# atómica, así que comprobar y descontar varios SKUs no necesita locks.
+# Las claves se arman dentro del script a partir del prefijo (ARGV[1]), por
+# lo que no sirven para Redis Cluster; basta con una instancia o réplica.
+_LUA_HELPERS = """
+local function unreserve(p, order)
+  local rkey = p .. 'reservation:' .. order
+  local own = redis.call('HGETALL', rkey)
+  for i = 1, #own, 2 do
+    if redis.call('DECRBY', p .. 'reserved:' .. own[i], own[i + 1]) <= 0 then
+      redis.call('DEL', p .. 'reserved:' .. own[i])
+    end
+  end
+  redis.call('DEL', rkey)
+  redis.call('ZREM', p .. 'expirations', order)
+  return #own > 0
+end
+
+local function check(p, args, first, last, own)
+  for j = first, last, 2 do
+    if tonumber(args[j + 1]) <= 0 then
+      return {'invalid', args[j], args[j + 1]}
+    end
+    local stock = redis.call('GET', p .. 'stock:' .. args[j])
+    if not stock then
+      return {'unknown', args[j]}
+    end
+    local reserved = tonumber(redis.call('GET', p .. 'reserved:' .. args[j]) or '0')
+    local available = tonumber(stock) - reserved + (own[args[j]] or 0)
+    if tonumber(args[j + 1]) > available then
+      return {'insufficient', args[j], args[j + 1], available}
+    end
+  end
+  return 0
+end
+
+local function own_items(p, order)
+  local own = {}
+  local flat = redis.call('HGETALL', p .. 'reservation:' .. order)
+  for i = 1, #flat, 2 do
+    own[flat[i]] = tonumber(flat[i + 1])
+  end
+  return own
+end
+"""
+
+# ARGV: prefijo, vencimiento y, por orden: order_id, n, pid1, q1, ..., pidn, qn
+_LUA_RESERVE = _LUA_HELPERS + """
+local p, expires_at = ARGV[1], ARGV[2]
+local results = {}
+local i = 3
+while i <= #ARGV do
+  local order, n = ARGV[i], tonumber(ARGV[i + 1])
+  local first, last = i + 2, i + 1 + 2 * n
+  i = last + 1
+  local result
+  if redis.call('SISMEMBER', p .. 'committed', order) == 1 then
+    result = {'committed'}
+  else
+    unreserve(p, order)
+    result = check(p, ARGV, first, last, {})
+    if result == 0 then
+      for j = first, last, 2 do
+        redis.call('INCRBY', p .. 'reserved:' .. ARGV[j], ARGV[j + 1])
+        redis.call('HSET', p .. 'reservation:' .. order, ARGV[j], ARGV[j + 1])
+      end
+      redis.call('ZADD', p .. 'expirations', expires_at, order)
+    end
+  end
+  results[#results + 1] = result
+end
+return results
+"""
+
+# ARGV: prefijo y, por orden: order_id, n, pid1, q1, ..., pidn, qn.
+# Devuelve {resultados, {pid, cantidad nueva, ...}}
+_LUA_COMMIT = _LUA_HELPERS + """
+local p = ARGV[1]
+local results, touched = {}, {}
+local i = 2
+while i <= #ARGV do
+  local order, n = ARGV[i], tonumber(ARGV[i + 1])
+  local first, last = i + 2, i + 1 + 2 * n
+  i = last + 1
+  local result
+  if redis.call('SISMEMBER', p .. 'committed', order) == 1 then
+    result = {'committed'}
+  else
+    -- La reserva de la propia orden cuenta como stock disponible para ella
+    result = check(p, ARGV, first, last, own_items(p, order))
+    if result == 0 then
+      unreserve(p, order)
+      for j = first, last, 2 do
+        touched[ARGV[j]] = redis.call('DECRBY', p .. 'stock:' .. ARGV[j], ARGV[j + 1])
+      end
+      redis.call('SADD', p .. 'committed', order)
+    end
+  end
+  results[#results + 1] = result
+end
+local quantities = {}
+for pid, quantity in pairs(touched) do
+  quantities[#quantities + 1] = pid
+  quantities[#quantities + 1] = quantity
+end
+return {results, quantities}
+"""
+
+_LUA_RELEASE = _LUA_HELPERS + """
+return unreserve(ARGV[1], ARGV[2]) and 1 or 0
+"""
+
+_LUA_EXPIRE = _LUA_HELPERS + """
+local expired = redis.call('ZRANGEBYSCORE', ARGV[1] .. 'expirations', '-inf', ARGV[2])
+for _, order in ipairs(expired) do
+  unreserve(ARGV[1], order)
+end
+return #expired
+"""
+
+
+class RedisStockEngine:
+    """
+    Motor de inventario compartido por varios procesos (workers de uvicorn o
+    del consumidor de órdenes) sobre Redis, con la misma interfaz que
+    StockEngine. Cantidades, reservas y órdenes pagadas viven en Redis; cada
+    operación por lotes es un único script Lua, atómico frente a los demás
+    procesos, así que no puede haber sobreventa.
+
+    `stock` (db_stock) queda como copia de lectura: tras cada commit se le
+    escriben las cantidades nuevas que devuelve Redis. Los vencimientos usan
+    la hora del sistema porque se comparan entre procesos.
+    """
+
+    def __init__(self, client, stock: Dict[int, dict], reservation_ttl: float = 900.0, prefix: str = "inkafarma:inventory:"):
+        self.client = client
+        self.stock = stock
+        self.reservation_ttl = reservation_ttl
+        self.prefix = prefix
+        self._reserve = client.register_script(_LUA_RESERVE)
+        self._commit = client.register_script(_LUA_COMMIT)
+        self._release = client.register_script(_LUA_RELEASE)
+        self._expire = client.register_script(_LUA_EXPIRE)
+
+    def _stock_key(self, product_id: int) -> str:
+        return f"{self.prefix}stock:{product_id}"
+
+    def load(self, overwrite: bool = False, product_ids: Optional[Iterable[int]] = None):
+        """
+        Publica en Redis las cantidades de `stock` (todas, o solo las de
+        `product_ids`). Sin `overwrite` solo se crean los SKUs que aún no
+        existen (el primer worker en arrancar carga el inventario) y después
+        la copia local se alinea con Redis.
+        """
+        if product_ids is None:
+            entries = self.stock.items()
+        else:
+            product_ids = [product_id for product_id in product_ids if product_id in self.stock]
+            entries = ((product_id, self.stock[product_id]) for product_id in product_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for product_id, entry in entries:
+            pipe.set(self._stock_key(product_id), entry["quantity"], nx=not overwrite)
+        pipe.execute()
+        self.sync(product_ids)
+
+    def sync(self, product_ids: Optional[Iterable[int]] = None) -> Dict[int, int]:
+        """
+        Copia a `stock` las cantidades actuales en Redis y las devuelve.
+        """
+        product_ids = list(self.stock) if product_ids is None else list(product_ids)
+        if not product_ids:
+            return {}
+        values = self.client.mget([self._stock_key(product_id) for product_id in product_ids])
+        quantities = {product_id: int(value) for product_id, value in zip(product_ids, values) if value is not None}
+        self._store(quantities)
+        return quantities
+
+    def _store(self, quantities: Dict[int, int]):
+        for product_id, quantity in quantities.items():
+            entry = self.stock.get(product_id) or {"product_id": product_id}
+            self.stock[product_id] = {**entry, "quantity": quantity}
+
+    def available(self, product_id: int) -> int:
+        stock, reserved = self.client.mget([self._stock_key(product_id), f"{self.prefix}reserved:{product_id}"])
+        if stock is None:
+            raise UnknownProduct(product_id)
+        return int(stock) - int(reserved or 0)
+
+    @staticmethod
+    def _args(orders: List[Tuple[int, Dict[int, int]]]) -> list:
+        args = []
+        for order_id, items in orders:
+            args += [order_id, len(items)]
+            for product_id, quantity in items.items():
+                args += [product_id, quantity]
+        return args
+
+    @staticmethod
+    def _error(order_id: int, result) -> Optional[StockError]:
+        if not isinstance(result, list):
+            return None
+        kind = result[0].decode() if isinstance(result[0], bytes) else result[0]
+        if kind == "committed":
+            return AlreadyCommitted(order_id)
+        if kind == "unknown":
+            return UnknownProduct(int(result[1]))
+        if kind == "invalid":
+            return InvalidQuantity(int(result[1]), int(result[2]))
+        return InsufficientStock(int(result[1]), int(result[2]), int(result[3]))
+
+    def reserve(self, order_id: int, items: Dict[int, int], ttl: Optional[float] = None):
+        error = self.reserve_many([(order_id, items)], ttl)[0]
+        if error is not None:
+            raise error
+
+    def reserve_many(self, orders: List[Tuple[int, Dict[int, int]]], ttl: Optional[float] = None) -> List[Optional[StockError]]:
+        if not orders:
+            return []
+        self.expire()
+        expires_at = time.time() + (self.reservation_ttl if ttl is None else ttl)
+        results = self._reserve(args=[self.prefix, expires_at] + self._args(orders))
+        return [self._error(order_id, result) for (order_id, _), result in zip(orders, results)]
+
+    def release(self, order_id: int) -> bool:
+        return bool(self._release(args=[self.prefix, order_id]))
+
+    def expire(self, now: Optional[float] = None) -> int:
+        return int(self._expire(args=[self.prefix, time.time() if now is None else now]))
+
+    def commit(self, order_id: int, items: Dict[int, int]):
+        error = self.commit_many([(order_id, items)])[0]
+        if error is not None:
+            raise error
+
+    def commit_many(self, orders: List[Tuple[int, Dict[int, int]]]) -> List[Optional[StockError]]:
+        if not orders:
+            return []
+        results, flat = self._commit(args=[self.prefix] + self._args(orders))
+        self._store({int(flat[i]): int(flat[i + 1]) for i in range(0, len(flat), 2)})
+        return [self._error(order_id, result) for (order_id, _), result in zip(orders, results)]
+
+    def is_committed(self, order_id: int) -> bool:
+        return bool(self.client.sismember(f"{self.prefix}committed", order_id))
+
+    def mark_committed(self, order_ids: Iterable[int], chunk: int = 10_000):
+        order_ids = iter(order_ids)
+        while True:
+            batch = list(islice(order_ids, chunk))
+            if not batch:
+                return
+            self.client.sadd(f"{self.prefix}committed", *batch)
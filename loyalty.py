@@ -0,0 +1,233 @@
+"""
+Puntos de fidelidad con un libro (ledger) de movimientos de solo anexado.
+
+Cada pago agrega un movimiento (user_id, order_id, puntos) y suma los puntos
+al saldo del usuario en memoria, así que leer un saldo es O(1). Los
+movimientos pendientes se escriben en lote: al diario en disco (opcional) y
+los saldos afectados a db_loyalty en una sola escritura. Los saldos se
+pueden reconstruir en cualquier momento reproduciendo el ledger.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, Iterator, List, MutableMapping, Optional, Tuple
+
+# user_id, order_id, puntos, timestamp
+RECORD = struct.Struct("<qqqd")
+
+
+class LoyaltyLedger:
+    """
+    Movimientos en columnas array('q'): 24 bytes por movimiento en memoria,
+    sin un objeto Python por fila.
+    """
+
+    __slots__ = ("user_ids", "order_ids", "points")
+
+    def __init__(self):
+        self.user_ids = array("q")
+        self.order_ids = array("q")
+        self.points = array("q")
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def append(self, user_id: int, order_id: int, points: int):
+        self.user_ids.append(user_id)
+        self.order_ids.append(order_id)
+        self.points.append(points)
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        return zip(self.user_ids, self.order_ids, self.points)
+
+
+class LoyaltyEngine:
+    """
+    Acumula puntos por pago (`points_per_unit` puntos por sol gastado).
+
+    - `record_payment` / `record_many`: agregan movimientos y actualizan saldos.
+    - `flush`: escribe en lote los movimientos pendientes al diario y los
+      saldos modificados a `balances` (db_loyalty). Se llama solo al juntar
+      `batch_size` movimientos y cada `flush_interval` segundos desde `start`.
+    - `rebuild`: recalcula todos los saldos desde el ledger.
+    - `load`: al arrancar, recupera el ledger del diario y reconstruye.
+
+    Con `shared` (una tabla de saldos compartida por la API y los workers)
+    el flush suma a cada saldo los puntos acumulados desde el anterior
+    (`balances.add_many`) en lugar de escribir el saldo de este proceso, y
+    `balance` lee el saldo guardado más lo que falta escribir.
+    """
+
+    def __init__(
+        self,
+        balances: MutableMapping[int, int],
+        journal_path: Optional[str] = None,
+        points_per_unit: float = 1.0,
+        batch_size: int = 1000,
+        flush_interval: float = 1.0,
+        shared: bool = False,
+    ):
+        self.balances = balances
+        self.journal_path = journal_path
+        self.points_per_unit = points_per_unit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.ledger = LoyaltyLedger()
+        self._balances: Dict[int, int] = {}
+        # Saldos de apertura (tomados de `balances` cuando no hay diario)
+        self._opening: Dict[int, int] = {}
+        self._pending: List[Tuple[int, int, int, float]] = []
+        self._dirty: Dict[int, None] = {}
+        # Puntos por usuario todavía no escritos (solo con `shared`)
+        self._unflushed: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"entries": 0, "flushes": 0, "errors": 0}
+
+    def points_for(self, amount: float) -> int:
+        return int(amount * self.points_per_unit)
+
+    def balance(self, user_id: int) -> int:
+        if not self.shared:
+            return self._balances.get(user_id, 0)
+        # Sin flush en curso, cada punto está o en la tabla o en _unflushed
+        with self._flush_lock:
+            stored = self.balances.get(user_id, 0)
+            with self._lock:
+                return stored + self._unflushed.get(user_id, 0)
+
+    def record_payment(self, user_id: int, order_id: int, amount: float) -> int:
+        """
+        Registra los puntos de un pago y devuelve cuántos se acumularon.
+        """
+        return self.record_many([(user_id, order_id, amount)])[0]
+
+    def record_many(self, payments: Iterable[Tuple[int, int, float]]) -> List[int]:
+        now = time.time()
+        earned = []
+        with self._lock:
+            for user_id, order_id, amount in payments:
+                points = self.points_for(amount)
+                earned.append(points)
+                if points <= 0:
+                    continue
+                self.ledger.append(user_id, order_id, points)
+                self._balances[user_id] = self._balances.get(user_id, 0) + points
+                self._pending.append((user_id, order_id, points, now))
+                self._dirty[user_id] = None
+                if self.shared:
+                    self._unflushed[user_id] = self._unflushed.get(user_id, 0) + points
+                self.stats["entries"] += 1
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+        return earned
+
+    def flush(self) -> int:
+        """
+        Escribe los movimientos pendientes y los saldos modificados. Devuelve
+        cuántos movimientos se escribieron.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                dirty, self._dirty = self._dirty, {}
+                unflushed, self._unflushed = self._unflushed, {}
+                balances = [(user_id, self._balances[user_id]) for user_id in dirty]
+            if not pending and not balances:
+                return 0
+            try:
+                if self.journal_path is not None:
+                    with open(self.journal_path, "ab") as journal:
+                        journal.write(b"".join(RECORD.pack(*entry) for entry in pending))
+                        journal.flush()
+                        os.fsync(journal.fileno())
+                if self.shared:
+                    self.balances.add_many(sorted(unflushed.items()))
+                else:
+                    self.balances.put_many(balances)
+            except Exception as e:
+                # Se reintenta en el siguiente flush; el saldo en memoria ya es correcto
+                self.stats["errors"] += 1
+                logging.error("Error escribiendo el ledger de fidelidad: %s", e)
+                with self._lock:
+                    self._pending[:0] = pending
+                    for user_id in dirty:
+                        self._dirty[user_id] = None
+                    for user_id, points in unflushed.items():
+                        self._unflushed[user_id] = self._unflushed.get(user_id, 0) + points
+                return 0
+            self.stats["flushes"] += 1
+            return len(pending)
+
+    def read_journal(self) -> Iterator[Tuple[int, int, int]]:
+        if self.journal_path is None or not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb") as journal:
+            data = journal.read()
+        # Un registro incompleto al final (corte durante la escritura) se descarta
+        usable = len(data) - len(data) % RECORD.size
+        for user_id, order_id, points, _ in RECORD.iter_unpack(memoryview(data)[:usable]):
+            yield user_id, order_id, points
+
+    def load(self):
+        """
+        Recupera el ledger desde el diario y reconstruye los saldos. Sin
+        diario, los saldos guardados en `balances` pasan a ser los de apertura.
+        """
+        if self.journal_path is None or not os.path.exists(self.journal_path):
+            with self._lock:
+                self._opening = dict(self.balances.items())
+                self._balances = dict(self._opening)
+            return
+        ledger = LoyaltyLedger()
+        for user_id, order_id, points in self.read_journal():
+            ledger.append(user_id, order_id, points)
+        with self._lock:
+            self.ledger = ledger
+            self._pending = []
+        self.rebuild()
+
+    def rebuild(self) -> int:
+        """
+        Recalcula todos los saldos reproduciendo el ledger sobre los saldos
+        de apertura y los escribe en `balances`. Devuelve el número de
+        usuarios con saldo.
+        """
+        with self._flush_lock:
+            with self._lock:
+                balances = dict(self._opening)
+                for user_id, _, points in self.ledger:
+                    balances[user_id] = balances.get(user_id, 0) + points
+                self._balances = balances
+                self._dirty = {}
+                # El snapshot ya incluye los puntos sin escribir
+                self._unflushed = {}
+                # En orden de user_id: las tablas ordenadas insertan al final
+                snapshot = sorted(balances.items())
+            self.balances.put_many(snapshot)
+        return len(snapshot)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="loyalty-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
@@ -1,90 +1,241 @@
+import os
 import ssl
 import sys
-import redis
-import pika
+import gzip
+import math
+import time
+import tempfile
+import threading
+import asyncio
+import secrets
 import logging
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List
-from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+import anyio.to_thread
+from pydantic import BaseModel, Field, conint
+from typing import Dict, List, Optional, Tuple
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from middleware import ConcurrencyLimitMiddleware
+from metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, OPERATION_BUCKETS, MetricsMiddleware, MetricsRegistry, SampledLogFilter,
+    configure_logging,
+)
+from auth import RateLimiter, TokenStore, UserIndex, hash_password, is_hashed, needs_rehash, verify_password
+from search import ProductSearchIndex
+from recommend import RecommendationIndex
+from loyalty import LoyaltyEngine
+from cache import CacheLayer, MemoryCache, RedisCache
+from publisher import OrderPublisher, PublisherBusy
+from pagination import iter_rows, ndjson_lines
+from storage import open_storage
+from bulk import NDJSON_CONTENT_TYPES, BulkPayloadError, parse_bulk_body, validate_batch
+from codec import SCHEMA_HEADER, SCHEMA_VERSION, CodecError, encode_order
+from events import EventBus
+from idempotency import IdempotencyMiddleware, MemoryIdempotencyStore, RedisIdempotencyStore
+from dataio import DATASETS, MEDIA_TYPES, DataFormatError, encode_rows, export_rows, import_rows, read_rows
+from inventory import (
+    InvalidQuantity, LocationStockIndex, RedisStockEngine, StockEngine, StockError, UnknownProduct, basket_coverage,
+    order_items,
+)
+from geo import SpatialIndex
+from startup import Warmup, WarmupMiddleware
 
-# Configurar logging para ver mensajes en la consola
-logging.basicConfig(level=logging.INFO)
+# Los mensajes repetidos se muestrean (LOG_SAMPLE_PER_SECOND por mensaje) y
+# con LOG_ASYNC=1 se escriben desde un hilo aparte para no bloquear a los
+# handlers. El logging global se configura al arrancar el servidor (ver
+# setup_logging), no al importar el módulo
+log_sampler = SampledLogFilter(float(os.getenv("LOG_SAMPLE_PER_SECOND", "10")))
+log_listener = None
+log_listener_running = False
+logging_configured = False
 
-# Verificar si el módulo SSL está disponible
+def setup_logging():
+    """
+    Configura el logging para ver mensajes en la consola. Solo la primera vez;
+    en los arranques siguientes solo se vuelve a iniciar el listener asíncrono.
+    """
+    global log_listener, log_listener_running, logging_configured
+    if not logging_configured:
+        logging_configured = True
+        logging.basicConfig(level=logging.INFO)
+        log_listener = configure_logging(log_sampler, async_queue_size=10_000 if os.getenv("LOG_ASYNC") == "1" else 0)
+    elif log_listener is not None and not log_listener_running:
+        log_listener.start()
+    log_listener_running = log_listener is not None
+
+def shutdown_logging():
+    """
+    Detiene el listener asíncrono después de escribir los registros que siguen en la cola.
+    """
+    global log_listener_running
+    if log_listener is not None and log_listener_running:
+        log_listener.stop()
+        log_listener_running = False
+
+# Métricas expuestas en /metrics (formato Prometheus)
+metrics = MetricsRegistry()
+hot_path = metrics.histogram(
+    "operation_duration_seconds", "Duración de las operaciones del camino caliente", ("operation",), OPERATION_BUCKETS,
+)
+
+# Inicialización diferida de índices y saldos (ver startup.py): la importación
+# no los construye; un hilo de fondo los calienta al arrancar y las requests
+# que llegan antes esperan a que estén listos
+warmup = Warmup()
+STARTED_AT = time.time()
+
+# Verificar si el módulo SSL está disponible (se llama al arrancar el servidor)
 def check_ssl():
     if "ssl" not in sys.modules:
         raise ModuleNotFoundError("El módulo 'ssl' no está disponible en el entorno actual.")
 
-check_ssl()
+def redis_client(url: str):
+    # redis solo se importa si se configura (REDIS_URL o SHARED_STATE_URL)
+    import redis
+    return redis.Redis.from_url(url)
 
-# Configuración de Redis para caché
-#cache = redis.Redis(host='localhost', port=6379, db=0)
+# Configuración de caché: nivel en memoria (LRU/TTL) y Redis opcional
+# como segundo nivel si se define REDIS_URL (p. ej. redis://localhost:6379/0)
+REDIS_URL = os.getenv("REDIS_URL")
+cache = CacheLayer(
+    local=MemoryCache(max_entries=10_000, ttl=60),
+    remote=RedisCache(redis_client(REDIS_URL)) if REDIS_URL else None,
+)
 
-# Configuración de RabbitMQ
-rabbitmq_params = pika.ConnectionParameters('localhost')
-rabbit_connection = None
-rabbit_channel = None
+# Almacenamiento de las tablas db_*: "memory" (por defecto),
+# "sqlite:///inkafarma.db" o "<driver>+<dsn>" para otro motor SQL (ver storage.py)
+STORAGE_URL = os.getenv("STORAGE_URL", "memory")
+storage = open_storage(STORAGE_URL, pool_size=int(os.getenv("STORAGE_POOL_SIZE", "8")))
 
-def init_rabbitmq():
-    global rabbit_connection, rabbit_channel
-    try:
-        rabbit_connection = pika.BlockingConnection(rabbitmq_params)
-        rabbit_channel = rabbit_connection.channel()
-        rabbit_channel.queue_declare(queue='orders')
-        logging.info("Conexión a RabbitMQ establecida")
-    except Exception as e:
-        logging.error("Error conectando a RabbitMQ: %s", e)
-        rabbit_connection = None
-        rabbit_channel = None
+# Modo multi-worker: con SHARED_STATE_URL (p. ej. redis://localhost:6379/1) el
+# inventario vive en Redis y los workers se avisan los cambios de stock por
+# pub/sub. Las órdenes se comparten con un STORAGE_URL persistente.
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL")
+shared_redis = redis_client(SHARED_STATE_URL) if SHARED_STATE_URL else None
+stock_events = EventBus(shared_redis) if shared_redis is not None else None
+
+# Configuración de RabbitMQ. La conexión la abren los hilos del publicador,
+# con reintentos, así que un broker lento o caído no demora el arranque
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "localhost")
+
+def rabbitmq_connection():
+    import pika
+    return pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
+
+# Formato de los mensajes de órdenes: "json" o "binary" (ver codec.py)
+ORDER_CODEC = os.getenv("ORDER_CODEC", "json")
+
+# Los handlers solo encolan; hilos de fondo con su propia conexión publican en lotes
+order_publisher = OrderPublisher(
+    rabbitmq_connection,
+    queue_name='orders',
+    max_queue=int(os.getenv("ORDER_OUTBOX_SIZE", "10000")),
+    batch_size=100,
+    channels=2,
+)
+
+# Idempotency-Key: las respuestas de las escrituras se guardan IDEMPOTENCY_TTL
+# segundos para reproducirlas ante un reintento (en Redis si hay SHARED_STATE_URL)
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENT_PATHS = ("/orders/create", "/payments/process", "/orders/bulk", "/payments/bulk")
+if shared_redis is not None:
+    idempotency_store = RedisIdempotencyStore(shared_redis, ttl=IDEMPOTENCY_TTL)
+else:
+    idempotency_store = MemoryIdempotencyStore(ttl=IDEMPOTENCY_TTL, max_keys=int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000")))
+
+# Límites de concurrencia: hilos para los handlers sync (los GET simples son
+# async y no pasan por el threadpool) y requests en curso por worker
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "0"))
+CONCURRENCY_QUEUE_TIMEOUT = float(os.getenv("CONCURRENCY_QUEUE_TIMEOUT", "1.0"))
+
+# Autenticación: coste del hash (iteraciones PBKDF2), duración de las sesiones
+# y límite de intentos de login por IP y por usuario (token bucket)
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", "200000"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+LOGIN_RATE = float(os.getenv("LOGIN_RATE", "1"))
+LOGIN_BURST = int(os.getenv("LOGIN_BURST", "10"))
+# Pool propio para los hashes: no compiten con el threadpool de los handlers
+password_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1))),
+    thread_name_prefix="password-hash",
+)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    init_rabbitmq()
+    setup_logging()
+    check_ssl()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Ninguno de los dos bloquea: el servidor acepta requests de inmediato
+    warmup.start()
+    order_publisher.start()
+    if stock_events is not None:
+        stock_events.start(on_stock_event)
+    loyalty.start()
     yield
-    if rabbit_connection:
-        rabbit_connection.close()
-        logging.info("Conexión a RabbitMQ cerrada")
+    loyalty.stop()
+    if stock_events is not None:
+        stock_events.stop()
+    order_publisher.stop()
+    logging.info("Publicador de RabbitMQ detenido")
+    storage.close()
+    # Al final, para que también se escriban los mensajes del apagado
+    shutdown_logging()
 
 app = FastAPI(lifespan=lifespan)
+# Las sondas y /metrics responden aunque los índices sigan construyéndose
+HEALTH_PATHS = ("/health/live", "/health/ready", "/metrics")
+app.add_middleware(WarmupMiddleware, warmup=warmup, exempt=HEALTH_PATHS)
+app.add_middleware(IdempotencyMiddleware, store=idempotency_store, paths=IDEMPOTENT_PATHS, registry=metrics)
+app.add_middleware(ConcurrencyLimitMiddleware, limit=MAX_CONCURRENCY, queue_timeout=CONCURRENCY_QUEUE_TIMEOUT)
+# Por fuera del límite de concurrencia: también mide las requests rechazadas con 503
+app.add_middleware(MetricsMiddleware, registry=metrics)
 
+@hot_path.timed("publish_order")
 def publish_order(order_data: dict):
     """
-    Publica el mensaje de la orden en la cola 'orders'.
+    Encola el mensaje de la orden para publicarlo en la cola 'orders'.
+    Lanza PublisherBusy si la cola de salida está llena y CodecError si la
+    orden no se puede codificar con ORDER_CODEC.
     """
-    if rabbit_channel is None:
-        logging.error("RabbitMQ channel no está disponible. No se puede publicar el mensaje.")
-        return
-    message = str(order_data).encode('utf-8')
-    try:
-        rabbit_channel.basic_publish(
-            exchange='',
-            routing_key='orders',
-            body=message
-        )
-        logging.info("Orden publicada en RabbitMQ: %s", order_data)
-    except Exception as e:
-        logging.error("Error publicando en RabbitMQ: %s", e)
+    import pika
+
+    message, content_type = encode_order(order_data, ORDER_CODEC)
+    # Un id por orden: el publicador y el worker descartan las copias repetidas
+    message_id = f"order-{order_data['order_id']}"
+    properties = pika.BasicProperties(
+        content_type=content_type,
+        message_id=message_id,
+        headers={SCHEMA_HEADER: SCHEMA_VERSION},
+    )
+    order_publisher.publish(message, properties, message_id=message_id)
 
-def update_location_stock(location_id: int):
+@hot_path.timed("update_location_stock")
+def update_location_stock(location_id: int, product_ids: Optional[List[int]] = None):
     """
     Función observer que actualiza el stock de una locación
-    tomando los valores actuales en db_stock.
+    tomando los valores actuales en db_stock. Si se indican product_ids
+    solo se tocan esos SKUs; si no, todos los que vende la locación.
     """
-    location = db_location.get(location_id)
-    if not location:
+    if location_id not in location_stock:
         return
-    updated_stock = []
-    for stock_item in location["stock"]:
-        product_id = stock_item["product_id"]
+    if product_ids is None:
+        product_ids = list(location_stock.product_ids(location_id))
+    for product_id in product_ids:
         # Si existe el producto en el stock global, se actualiza su cantidad
         if product_id in db_stock:
-            updated_stock.append({
-                "product_id": product_id,
-                "quantity": db_stock[product_id]["quantity"]
-            })
-    # Actualizamos la lista de 'stock' de la locación
-    location["stock"] = updated_stock
+            if location_stock.get(location_id, product_id) is not None:
+                location_stock.set(location_id, product_id, db_stock[product_id]["quantity"])
+        else:
+            location_stock.remove(location_id, product_id)
+
+def location_stock_list(location_id: int) -> List[dict]:
+    return [
+        {"product_id": product_id, "quantity": quantity}
+        for product_id, quantity in location_stock.items(location_id)
+    ]
 
 # Modelos de datos
 class UserAuth(BaseModel):
@@ -102,7 +253,7 @@ class Order(BaseModel):
     order_id: int
     user_id: int
     product_ids: List[int]
-    quantity: List[int]
+    quantity: List[conint(gt=0)]
     location_id: int
 
 class Payment(BaseModel):
@@ -120,13 +271,61 @@ class stock(BaseModel):
 class location(BaseModel):
     location_id: int
     location_name: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
     stock: List[stock]
-# Base de datos simulada
-db_users = {
+
+class BasketQuery(BaseModel):
+    product_ids: List[int]
+    quantity: List[conint(gt=0)]
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+    # distance: las que surten todo, de la más cercana a la más lejana;
+    # coverage: las que surten más líneas primero. Por defecto, distance si
+    # se envían coordenadas
+    rank: Optional[str] = Field(None, pattern="^(distance|coverage)$")
+    limit: int = Field(10, ge=1, le=100)
+    max_km: Optional[float] = Field(None, gt=0)
+
+class LocationAvailability(BaseModel):
+    location_id: int
+    location_name: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    distance_km: Optional[float] = None
+    # Líneas de la canasta que la locación puede surtir, y las que no
+    fulfilled: int
+    missing: List[int]
+# Tablas de datos. Los literales son la carga inicial: con un backend
+# persistente solo se usan si la tabla está vacía (primer arranque)
+db_users = storage.table("users", {
     1: {"username": "admin", "password": "password123"},
     2: {"username": "invitado", "password": "secret"}
-}
-db_products = {
+})
+
+user_index = UserIndex()
+session_tokens = TokenStore(ttl=SESSION_TTL, client=shared_redis)
+login_limiter = RateLimiter(LOGIN_RATE, LOGIN_BURST)
+# Con usuarios inexistentes se verifica contra este hash para que la
+# respuesta tarde lo mismo y no revele qué usuarios existen
+DUMMY_PASSWORD_HASH = None
+
+@warmup.step("users", gate=False)
+def warm_users():
+    """
+    Guarda con hash las contraseñas en texto plano (datos iniciales o bases
+    anteriores) e indexa los usuarios por nombre. Cada hash cuesta decenas
+    de ms, así que no bloquea el servicio: solo el login lo espera.
+    """
+    global DUMMY_PASSWORD_HASH
+    for user_id, user_data in list(db_users.items()):
+        if not is_hashed(user_data["password"]):
+            user_data = {**user_data, "password": hash_password(user_data["password"], PASSWORD_HASH_ITERATIONS)}
+            db_users[user_id] = user_data
+        user_index.add(user_id, user_data["username"])
+    DUMMY_PASSWORD_HASH = hash_password(secrets.token_hex(16), PASSWORD_HASH_ITERATIONS)
+
+db_products = storage.table("products", {
     1: {"name": "Durex", "price": 18.0, "category": "Condoms"},
     2: {"name": "Panadol", "price": 8.0, "category": "Medicines"},
     3: {"name": "Pampers", "price": 25.0, "category": "Baby"},
@@ -147,11 +346,42 @@ db_products = {
     18: {"name": "Similac 1", "price": 45.0, "category": "Baby"},
     19: {"name": "Omeprazol", "price": 11.0, "category": "Medicines"},
     20: {"name": "Cetaphil Lotion", "price": 27.0, "category": "Personal Care"},
-}
-db_orders = {}
-db_payments = {}
-db_loyalty = {}
-db_stock = {
+})
+
+# Índice de búsqueda construido una sola vez; se actualiza en cada escritura
+# de db_products mediante product_index.add/remove
+product_index = ProductSearchIndex()
+
+@warmup.step("search")
+def build_product_index():
+    product_index.build(db_products)
+
+db_orders = storage.table("orders")
+
+# Recomendaciones (co-compra + categoría) con el top-K precalculado por
+# producto; se actualizan con cada orden nueva mediante add_order
+RECOMMENDATION_TOP_K = int(os.getenv("RECOMMENDATION_TOP_K", "20"))
+recommendation_index = RecommendationIndex(top_k=RECOMMENDATION_TOP_K)
+
+@warmup.step("recommendations")
+def build_recommendation_index():
+    recommendation_index.build(db_products, db_orders.values())
+
+db_payments = storage.table("payments")
+db_loyalty = storage.table("loyalty")
+
+# Puntos de fidelidad: ledger de movimientos por pago y saldos en memoria.
+# Con LOYALTY_LEDGER_PATH el ledger se guarda en disco y se reproduce al arrancar
+loyalty = LoyaltyEngine(
+    db_loyalty,
+    journal_path=os.getenv("LOYALTY_LEDGER_PATH"),
+    points_per_unit=float(os.getenv("LOYALTY_POINTS_PER_SOL", "1")),
+    batch_size=int(os.getenv("LOYALTY_BATCH_SIZE", "1000")),
+    # Con un STORAGE_URL persistente los workers de la cola también acumulan en db_loyalty
+    shared=storage.name != "memory",
+)
+warmup.step("loyalty")(loyalty.load)
+db_stock = storage.table("stock", {
     1: {"product_id": 1, "quantity": 100},
     2: {"product_id": 2, "quantity": 120},
     3: {"product_id": 3, "quantity": 250},
@@ -172,88 +402,253 @@ db_stock = {
     18: {"product_id": 18, "quantity": 45},
     19: {"product_id": 19, "quantity": 100},
     20: {"product_id": 20, "quantity": 70}
-}
+})
+
+db_location = storage.table("location", {
+    1: {"location_id": 1, "location_name": "Farmacia", "latitude": -12.0464, "longitude": -77.0428},
+    2: {"location_id": 2, "location_name": "Supermercado", "latitude": -12.1211, "longitude": -77.0297},
+    3: {"location_id": 3, "location_name": "Droguería", "latitude": -12.0977, "longitude": -77.0365},
+})
+
+# Índice espacial de las locaciones con coordenadas (búsqueda por cercanía)
+location_points = SpatialIndex()
+
+def index_location_point(location_id: int, location_data: Optional[dict]):
+    if location_data and location_data.get("latitude") is not None and location_data.get("longitude") is not None:
+        location_points.add(location_id, location_data["latitude"], location_data["longitude"])
+    else:
+        location_points.remove(location_id)
+
+@warmup.step("location_points")
+def build_location_points():
+    for location_id, location_data in db_location.items():
+        index_location_point(location_id, location_data)
 
-db_location = {
-    1: {"location_id": 1, "location_name": "Farmacia", "stock": [db_stock[1], db_stock[2], db_stock[4], db_stock[6], db_stock[7], db_stock[19]]},
-    2: {"location_id": 2, "location_name": "Supermercado", "stock": [db_stock[3], db_stock[5], db_stock[9], db_stock[10], db_stock[18]]},
-    3: {"location_id": 3, "location_name": "Droguería", "stock": [db_stock[8], db_stock[11], db_stock[12], db_stock[13], db_stock[14], db_stock[15], db_stock[16], db_stock[17], db_stock[20]]},
-}
+# Motor de inventario: reserva al crear la orden y descuenta al pagar
+RESERVATION_TTL = float(os.getenv("RESERVATION_TTL", "900"))
+if shared_redis is not None:
+    stock_engine = RedisStockEngine(shared_redis, db_stock, reservation_ttl=RESERVATION_TTL)
+
+    @warmup.step("stock")
+    def load_shared_stock():
+        # El primer worker carga el inventario; los demás toman las cantidades de Redis
+        stock_engine.load()
+else:
+    stock_engine = StockEngine(db_stock, reservation_ttl=RESERVATION_TTL)
+
+@warmup.step("payments")
+def load_committed_orders():
+    # Las órdenes pagadas antes de reiniciar no se pueden volver a pagar
+    stock_engine.mark_committed(db_payments)
+
+# Productos que vende cada locación
+db_location_products = storage.table("location_products", {
+    1: [1, 2, 4, 6, 7, 19],
+    2: [3, 5, 9, 10, 18],
+    3: [8, 11, 12, 13, 14, 15, 16, 17, 20],
+})
+
+# Índice (location_id, product_id) -> cantidad
+location_stock = LocationStockIndex()
+
+@warmup.step("location_stock")
+def build_location_stock():
+    for location_id, product_ids in db_location_products.items():
+        # Solo las locaciones que existen: una eliminada no debe ofrecer stock
+        if location_id not in db_location:
+            continue
+        location_stock.add_location(location_id)
+        quantities = {}
+        for product_id in product_ids:
+            # Un SKU eliminado del stock no impide arrancar: la locación deja de ofrecerlo
+            stock = db_stock.get(product_id)
+            if stock is not None:
+                quantities[product_id] = stock["quantity"]
+        location_stock.update(location_id, quantities)
+
+# Listados paginados por cursor: ?after_id=<último id recibido>&limit=N.
+# Con format=ndjson la respuesta se envía en streaming, una fila por línea.
+LIST_PAGE_SIZE = 100
+LIST_MAX_PAGE_SIZE = 1000
+LIST_FORMAT = Query("json", pattern="^(json|ndjson)$")
+
+async def list_response(table, row, after_id: Optional[int], limit: Optional[int], format: str):
+    if format == "ndjson":
+        return StreamingResponse(ndjson_lines(iter_rows(table, row, after_id, limit)), media_type="application/x-ndjson")
+    limit = min(limit or LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE)
+    return await storage.run(lambda: list(iter_rows(table, row, after_id, limit)))
 
 # Servicio de autenticación
 @app.post("/auth/login")
-def login(user: UserAuth):
-    print(user.model_dump())
-    user_found = False
-    
-    # Buscamos en db_users un usuario con username/password coincidente
-    for uid, user_data in db_users.items():
-        if user_data["username"] == user.username and user_data["password"] == user.password:
-            user_found = True
-            break
+async def login(user: UserAuth, request: Request):
+    # El limitador corta las ráfagas antes de gastar CPU en el hash
+    client_ip = request.client.host if request.client else "unknown"
+    wait = login_limiter.acquire(f"ip:{client_ip}", f"user:{user.username}")
+    if wait:
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiados intentos de login, reintente más tarde",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+    # Recién arrancado, el índice de usuarios puede estar construyéndose
+    await warmup.wait("users")
+    user_id = user_index.get(user.username)
+    user_data = await storage.run(db_users.get, user_id) if user_id is not None else None
+    encoded = user_data["password"] if user_data else DUMMY_PASSWORD_HASH
+    loop = asyncio.get_running_loop()
+    valid = await loop.run_in_executor(password_pool, verify_password, user.password, encoded)
+    if not (user_data and valid):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    if needs_rehash(encoded, PASSWORD_HASH_ITERATIONS):
+        # Se cambió el coste del hash: se actualiza con la contraseña ya verificada
+        rehashed = await loop.run_in_executor(password_pool, hash_password, user.password, PASSWORD_HASH_ITERATIONS)
+        await storage.run(db_users.__setitem__, user_id, {**user_data, "password": rehashed})
+    token = await run_in_threadpool(session_tokens.issue, user_id)
+    return {"message": "Login successful", "token": token, "token_type": "bearer", "expires_in": SESSION_TTL}
+
+async def session_user_id(authorization: Optional[str] = Header(None)) -> int:
+    """
+    user_id de la sesión del header "Authorization: Bearer <token>"; 401 si no es válida.
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    user_id = await run_in_threadpool(session_tokens.validate, token) if scheme.lower() == "bearer" and token else None
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Sesión inválida o vencida", headers={"WWW-Authenticate": "Bearer"})
+    return user_id
 
-    if user_found:
-        return {"message": "Login successful"}
-    raise HTTPException(status_code=401, detail="Invalid credentials")
+@app.get("/auth/me")
+async def get_session_user(user_id: int = Depends(session_user_id)):
+    user_data = await storage.run(db_users.get, user_id)
+    return {"user_id": user_id, "username": user_data["username"] if user_data else None}
+
+@app.post("/auth/logout")
+async def logout(user_id: int = Depends(session_user_id), authorization: Optional[str] = Header(None)):
+    await run_in_threadpool(session_tokens.revoke, authorization.partition(" ")[2])
+    return {"message": "Logout successful"}
 
 @app.get("/locations", response_model=List[location])
-def get_locations():
-    locations = []
-    for location_id, location in db_location.items():
-        locations.append({"id": location_id, **location})
-    return locations
+@cache.cached_response("locations", List[location])
+async def get_locations(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), format: str = LIST_FORMAT):
+    row = lambda location_id, location: {"id": location_id, **location, "stock": location_stock_list(location_id)}
+    return await list_response(db_location, row, after_id, limit, format)
 
 @app.get("/locations/{location_id}", response_model=location)
-def get_location(location_id: int):
-    location = db_location.get(location_id)
+@cache.cached_response("locations", location)
+async def get_location(location_id: int):
+    location = await storage.run(db_location.get, location_id)
     if not location:
         raise HTTPException(status_code=404, detail="Ubicación no encontrada")
-    return {"id": location_id, **location}
+    return {"id": location_id, **location, "stock": location_stock_list(location_id)}
 
 @app.get("/locations/{location_id}/stock", response_model=List[stock])
-def get_location_stock(location_id: int):
-    location = db_location.get(location_id)
+@cache.cached_response("locations", List[stock])
+async def get_location_stock(location_id: int):
+    location = await storage.run(db_location.get, location_id)
     if not location:
         raise HTTPException(status_code=404, detail="Ubicación no encontrada")
-    return location["stock"]
+    return location_stock_list(location_id)
 
 @app.get("/locations/{location_id}/stock/{product_id}", response_model=stock)
-def get_location_stock_product(location_id: int, product_id: int):  
-    location = db_location.get(location_id)
+@cache.cached_response("locations", stock)
+async def get_location_stock_product(location_id: int, product_id: int):  
+    location = await storage.run(db_location.get, location_id)
     if not location:
         raise HTTPException(status_code=404, detail="Ubicación no encontrada")
-    for stock in location["stock"]:
-        if stock["product_id"] == product_id:
-            return stock
+    quantity = location_stock.get(location_id, product_id)
+    if quantity is not None:
+        return {"product_id": product_id, "quantity": quantity}
     raise HTTPException(status_code=404, detail="Producto no encontrado en la ubicación")
 
 @app.get("/locations/{location_id}/stock/{product_id}/quantity", response_model=stock)
-def get_location_stock_product_quantity(location_id: int, product_id: int):
-    location = db_location.get(location_id)
+@cache.cached_response("locations", stock)
+async def get_location_stock_product_quantity(location_id: int, product_id: int):
+    location = await storage.run(db_location.get, location_id)
     if not location:
         raise HTTPException(status_code=404, detail="Ubicación no encontrada")
-    for stock in location["stock"]:
-        if stock["product_id"] == product_id:
-            return {"product_id": product_id, "quantity": stock["quantity"]}
+    quantity = location_stock.get(location_id, product_id)
+    if quantity is not None:
+        return {"product_id": product_id, "quantity": quantity}
     raise HTTPException(status_code=404, detail="Producto no encontrado en la ubicación")
 
+def rank_locations(items: Dict[int, int], latitude: Optional[float], longitude: Optional[float],
+                   rank: str, limit: int, max_km: Optional[float] = None) -> List[Tuple[int, Optional[float], int]]:
+    """
+    Locaciones para surtir la canasta como (location_id, km, líneas surtidas).
+    Los candidatos salen del índice invertido producto -> locaciones y el
+    orden por distancia del índice espacial, sin recorrer todas las
+    locaciones. Sin coordenadas, a igual cobertura se ordena por location_id.
+    """
+    located = latitude is not None and longitude is not None
+    if rank == "distance":
+        candidates = basket_coverage(location_stock, items)
+        return [(location_id, km, len(items))
+                for location_id, km in location_points.nearest(latitude, longitude, limit, candidates, max_km)]
+    # coverage: de a un nivel de cobertura (líneas surtidas), del mayor al menor
+    levels: Dict[int, List[int]] = {}
+    for location_id, fulfilled in basket_coverage(location_stock, items, complete=False).items():
+        levels.setdefault(fulfilled, []).append(location_id)
+    ranked = []
+    for fulfilled in sorted(levels, reverse=True):
+        remaining = limit - len(ranked)
+        if remaining <= 0:
+            break
+        level = levels[fulfilled]
+        if not located:
+            ranked.extend((location_id, None, fulfilled) for location_id in sorted(level)[:remaining])
+            continue
+        nearest = location_points.nearest(latitude, longitude, remaining, set(level), max_km)
+        ranked.extend((location_id, km, fulfilled) for location_id, km in nearest)
+        if max_km is None and len(nearest) < remaining:
+            # Las locaciones sin coordenadas van al final de su nivel
+            unplaced = sorted(location_id for location_id in level if location_id not in location_points)
+            ranked.extend((location_id, None, fulfilled) for location_id in unplaced[:remaining - len(nearest)])
+    return ranked
+
+@app.post("/locations/availability", response_model=List[LocationAvailability])
+def get_basket_availability(query: BasketQuery):
+    if len(query.product_ids) != len(query.quantity):
+        raise HTTPException(status_code=422, detail="product_ids y quantity deben tener la misma longitud")
+    located = query.latitude is not None and query.longitude is not None
+    rank = query.rank or ("distance" if located else "coverage")
+    if rank == "distance" and not located:
+        raise HTTPException(status_code=422, detail="Ordenar por distancia requiere latitude y longitude")
+    items = order_items(query.product_ids, query.quantity)
+    results = []
+    for location_id, km, fulfilled in rank_locations(items, query.latitude, query.longitude, rank, query.limit, query.max_km):
+        location_data = db_location.get(location_id) or {}
+        results.append({
+            "location_id": location_id,
+            "location_name": location_data.get("location_name", ""),
+            "latitude": location_data.get("latitude"),
+            "longitude": location_data.get("longitude"),
+            "distance_km": None if km is None else round(km, 3),
+            "fulfilled": fulfilled,
+            "missing": [
+                product_id for product_id, quantity in items.items()
+                if (location_stock.get(location_id, product_id) or 0) < quantity
+            ],
+        })
+    return results
+
 @app.get("/stock", response_model=List[stock])
-def get_stock():
-    stocks = []
-    for product_id, stock in db_stock.items():
-        stocks.append({"id": product_id, **stock})
-    return stocks
+@cache.cached_response("stock", List[stock])
+async def get_stock(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), format: str = LIST_FORMAT):
+    return await list_response(db_stock, lambda product_id, stock: {"id": product_id, **stock}, after_id, limit, format)
 
 @app.get("/stock/{product_id}", response_model=stock)
-def get_stock_product(product_id: int): 
-    stock = db_stock.get(product_id)
+@cache.cached_response("stock", stock)
+async def get_stock_product(product_id: int): 
+    stock = await storage.run(db_stock.get, product_id)
     if not stock:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     return {"id": product_id, **stock}
 
 @app.get("/stock/{product_id}/quantity", response_model=stock)
-def get_stock_product_quantity(product_id: int):
-    stock = db_stock.get(product_id)
+@cache.cached_response("stock", stock)
+async def get_stock_product_quantity(product_id: int):
+    stock = await storage.run(db_stock.get, product_id)
     if not stock:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     return {"product_id": product_id, "quantity": stock["quantity"]}    
@@ -261,32 +656,24 @@ def get_stock_product_quantity(product_id: int):
 
 # Servicio de productos
 @app.get("/products", response_model=List[Product])
-def get_products():
-    products = []
-    for product_id, product in db_products.items():
-        products.append({"id": product_id, **product})
-    return products
+@cache.cached_response("products", List[Product])
+async def get_products(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), format: str = LIST_FORMAT):
+    return await list_response(db_products, lambda product_id, product: {"id": product_id, **product}, after_id, limit, format)
 
 @app.get("/products/name/{name}", response_model=List[Product])
-def get_products_name(name: str):
-    products = []
-    for product_id, product in db_products.items():
-        if name.lower() in product["name"].lower():
-            products.append({"id": product_id, **product})
-    #cache.set(name, products)
-    return products
+@cache.cached_response("products", List[Product])
+def get_products_name(name: str, limit: int = Query(50, ge=1, le=1000), offset: int = Query(0, ge=0)):
+    return product_index.search_name(name, limit=limit, offset=offset)
 
 @app.get("/products/category/{category}", response_model=List[Product])
-def get_products_category(category: str):
-    products = []
-    for product_id, product in db_products.items():
-        if category.lower() in product["category"].lower():
-            products.append({"id": product_id, **product})
-    return products
+@cache.cached_response("products", List[Product])
+def get_products_category(category: str, limit: int = Query(50, ge=1, le=1000), offset: int = Query(0, ge=0)):
+    return product_index.search_category(category, limit=limit, offset=offset)
 
 @app.get("/products/category/{category}/id/{product_id}", response_model=Product)
-def get_product_in_category_by_id(category: str, product_id: int):
-    product = db_products.get(product_id)
+@cache.cached_response("products", Product)
+async def get_product_in_category_by_id(category: str, product_id: int):
+    product = await storage.run(db_products.get, product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     if category.lower() not in product["category"].lower():
@@ -294,49 +681,507 @@ def get_product_in_category_by_id(category: str, product_id: int):
     return {"id": product_id, **product}
 
 @app.get("/products/recomendations/{product_id}", response_model=List[Product])
-def get_products_same_category(product_id: int):
-    product = db_products.get(product_id)
-    if not product:
+async def get_product_recommendations(product_id: int, limit: int = Query(10, ge=1, le=RECOMMENDATION_TOP_K)):
+    # Sin caché: el índice ya responde en O(K) y siempre está al día con las órdenes
+    results = recommendation_index.recommend(product_id, limit)
+    if results is None:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
-    category = product["category"].lower()
-    results = []
-    for pid, p in db_products.items():
-        if p["category"].lower() == category:
-            results.append({"id": pid, **p})
     return results
 
+def stock_error_status(error: StockError) -> int:
+    """
+    Código HTTP para un error del motor de inventario.
+    """
+    if isinstance(error, UnknownProduct):
+        return 404
+    return 422 if isinstance(error, InvalidQuantity) else 409
+
+def apply_payment(order: dict, payment_data: dict):
+    """
+    Descuenta el stock de la orden y registra su pago. La usan tanto
+    /payments/process como el worker que consume la cola 'orders'.
+    Lanza AlreadyCommitted, InsufficientStock, InvalidQuantity o UnknownProduct sin tocar el stock.
+    """
+    # Disminuir stock global de forma atómica (todas las líneas o ninguna)
+    with hot_path.time("stock_commit"):
+        stock_engine.commit(order["order_id"], order_items(order["product_ids"], order["quantity"]))
+
+    # Actualizamos el stock en la locación asociada (observer)
+    update_location_stock(order["location_id"], order["product_ids"])
+
+    # Registrar pago y acumular los puntos de fidelidad
+    db_payments[order["order_id"]] = payment_data
+    loyalty.record_payment(order["user_id"], order["order_id"], order_amount(order))
+
+    # El stock cambió: invalidamos las vistas cacheadas y avisamos a los demás workers
+    notify_stock_change(order["product_ids"])
+
+def order_amount(order: dict) -> float:
+    """
+    Importe de una orden según los precios del catálogo (índice en memoria).
+    """
+    products = product_index.products
+    return sum(
+        products[product_id]["price"] * quantity
+        for product_id, quantity in zip(order["product_ids"], order["quantity"])
+        if product_id in products
+    )
+
+def notify_stock_change(product_ids: List[int]):
+    """
+    Invalida las vistas cacheadas de stock y locaciones y, en modo
+    multi-worker, publica las cantidades nuevas para los demás procesos.
+    """
+    versions = cache.invalidate("stock", "locations")
+    if stock_events is not None and product_ids:
+        stock_events.publish({
+            "stock": {product_id: db_stock[product_id]["quantity"] for product_id in set(product_ids)},
+            "cache_versions": versions,
+        })
+
+def on_stock_event(event: dict):
+    """
+    Aplica en este worker un cambio de stock hecho por otro proceso.
+    """
+    quantities = {int(product_id): quantity for product_id, quantity in event.get("stock", {}).items()}
+    if storage.name == "memory":
+        # Con almacenamiento compartido db_stock ya tiene el valor nuevo
+        for product_id, quantity in quantities.items():
+            db_stock[product_id] = {"product_id": product_id, "quantity": quantity}
+    for location_id in list(location_stock.locations()):
+        update_location_stock(location_id, list(quantities))
+    cache.invalidated_elsewhere(event.get("cache_versions") or dict.fromkeys(("stock", "locations")))
+
+# Un mismo order_id se crea de a una request a la vez (locks por franja de ids)
+ORDER_LOCK_STRIPES = 64
+order_locks = [threading.Lock() for _ in range(ORDER_LOCK_STRIPES)]
+
+@contextmanager
+def locked_orders(order_ids):
+    stripes = sorted({order_id % ORDER_LOCK_STRIPES for order_id in order_ids})
+    for stripe in stripes:
+        order_locks[stripe].acquire()
+    try:
+        yield
+    finally:
+        for stripe in reversed(stripes):
+            order_locks[stripe].release()
+
+def existing_order_status(order_data: dict) -> Optional[Tuple[int, str]]:
+    """
+    None si la orden es nueva. Si ya existe, (200, ...) cuando es la misma
+    orden (un reintento: no se vuelve a reservar ni a publicar) o (409, ...)
+    cuando el order_id ya se usó para otra orden.
+    """
+    existing = db_orders.get(order_data["order_id"])
+    if existing is None:
+        return None
+    if all(existing.get(field) == value for field, value in order_data.items()):
+        return 200, "Order created successfully"
+    return 409, "Ya existe otra orden con ese order_id"
+
 # Servicio de órdenes con mensajería asíncrona
 @app.post("/orders/create")
 def create_order(order: Order):
-    db_orders[order.order_id] = order.dict()
-    publish_order(order.dict())
+    with locked_orders([order.order_id]):
+        return create_order_locked(order)
+
+def create_order_locked(order: Order):
+    if len(order.product_ids) != len(order.quantity):
+        raise HTTPException(status_code=422, detail="product_ids y quantity deben tener la misma longitud")
+    order_data = order.model_dump()
+    existing = existing_order_status(order_data)
+    if existing is not None:
+        if existing[0] != 200:
+            raise HTTPException(status_code=existing[0], detail=existing[1])
+        return {"message": existing[1]}
+    # Reservamos el stock hasta que se pague la orden o venza la reserva
+    try:
+        stock_engine.reserve(order.order_id, order_items(order.product_ids, order.quantity))
+    except StockError as e:
+        raise HTTPException(status_code=stock_error_status(e), detail=str(e))
+    try:
+        publish_order(order_data)
+    except PublisherBusy:
+        stock_engine.release(order.order_id)
+        raise HTTPException(status_code=503, detail="Servicio de órdenes saturado, reintente más tarde")
+    except CodecError as e:
+        stock_engine.release(order.order_id)
+        raise HTTPException(status_code=422, detail=str(e))
+    db_orders[order.order_id] = order_data
+    recommendation_index.add_order(order_data)
+    cache.invalidate("stock", "locations")
     return {"message": "Order created successfully"}
 
 @app.get("/orders", response_model=List[Order])
-def get_orders():
-    return [Order(**o) for o in db_orders.values()]
+async def get_orders(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), format: str = LIST_FORMAT):
+    return await list_response(db_orders, lambda order_id, order: order, after_id, limit, format)
 
 @app.post("/payments/process")
 def process_payment(payment: Payment):
     if payment.order_id not in db_orders:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    order = db_orders[payment.order_id]
+    try:
+        apply_payment(db_orders[payment.order_id], payment.model_dump())
+    except StockError as e:
+        raise HTTPException(status_code=stock_error_status(e), detail=str(e))
+    return {"message": "Payment processed"}
 
-    # Disminuir stock global
-    for idx, product_id in enumerate(order["product_ids"]):
-        qty = order["quantity"][idx]
-        db_stock[product_id]["quantity"] -= qty
+# Endpoints masivos: aceptan un arreglo JSON o NDJSON (Content-Type: application/x-ndjson)
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "100000"))
 
-    # Actualizamos el stock en la locación asociada (observer)
-    update_location_stock(order["location_id"])
+async def read_bulk_payload(request: Request) -> list:
+    body = await request.body()
+    try:
+        return parse_bulk_body(body, request.headers.get("content-type"), BULK_MAX_ITEMS)
+    except BulkPayloadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # Registrar pago
-    db_payments[payment.order_id] = payment.dict()
+def bulk_response(results: List[dict]) -> dict:
+    accepted = sum(1 for r in results if r["status"] == 200)
+    return {"accepted": accepted, "rejected": len(results) - accepted, "results": results}
 
-    return {"message": "Payment processed"}
+def create_orders_bulk_sync(items: list) -> dict:
+    results = []
+    candidates = []
+    seen = set()
+    for order, error in validate_batch(Order, items):
+        if error is not None:
+            results.append({"order_id": None, "status": 422, "detail": error})
+            continue
+        result = {"order_id": order.order_id, "status": 200, "detail": "Order created successfully"}
+        results.append(result)
+        if len(order.product_ids) != len(order.quantity):
+            result.update(status=422, detail="product_ids y quantity deben tener la misma longitud")
+        elif order.order_id in seen:
+            result.update(status=409, detail="order_id repetido en el lote")
+        else:
+            seen.add(order.order_id)
+            candidates.append((order, result))
+    with locked_orders(seen):
+        return create_orders_locked(candidates, results)
+
+def create_orders_locked(candidates: list, results: List[dict]) -> dict:
+    # Las órdenes que ya existen no se vuelven a reservar ni a publicar
+    pending = []
+    for order, result in candidates:
+        existing = existing_order_status(order.model_dump())
+        if existing is None:
+            pending.append((order, result))
+        else:
+            result.update(status=existing[0], detail=existing[1])
+    candidates = pending
+
+    # Una sola pasada de reservas para todo el lote
+    errors = stock_engine.reserve_many(
+        [(order.order_id, order_items(order.product_ids, order.quantity)) for order, _ in candidates]
+    )
+    busy = False
+    created = []
+    for (order, result), error in zip(candidates, errors):
+        if error is not None:
+            result.update(status=stock_error_status(error), detail=str(error))
+            continue
+        order_data = order.model_dump()
+        if not busy:
+            try:
+                publish_order(order_data)
+            except PublisherBusy:
+                busy = True
+            except CodecError as e:
+                stock_engine.release(order.order_id)
+                result.update(status=422, detail=str(e))
+                continue
+        if busy:
+            stock_engine.release(order.order_id)
+            result.update(status=503, detail="Servicio de órdenes saturado, reintente más tarde")
+            continue
+        created.append((order.order_id, order_data))
+    # Todas las órdenes del lote en una sola escritura (una transacción en los backends SQL)
+    db_orders.put_many(created)
+    for _, order_data in created:
+        recommendation_index.add_order(order_data)
+    cache.invalidate("stock", "locations")
+    return bulk_response(results)
+
+def process_payments_bulk_sync(items: list) -> dict:
+    results = []
+    candidates = []
+    for payment, error in validate_batch(Payment, items):
+        if error is not None:
+            results.append({"order_id": None, "status": 422, "detail": error})
+            continue
+        result = {"order_id": payment.order_id, "status": 200, "detail": "Payment processed"}
+        results.append(result)
+        if payment.order_id not in db_orders:
+            result.update(status=404, detail="Order not found")
+        else:
+            candidates.append((payment, result))
+
+    # Un único descuento por SKU para todo el lote
+    orders = [db_orders[payment.order_id] for payment, _ in candidates]
+    with hot_path.time("stock_commit_many"):
+        errors = stock_engine.commit_many(
+            [(order["order_id"], order_items(order["product_ids"], order["quantity"])) for order in orders]
+        )
+    touched = {}
+    paid = []
+    for (payment, result), order, error in zip(candidates, orders, errors):
+        if error is not None:
+            result.update(status=stock_error_status(error), detail=str(error))
+            continue
+        paid.append((payment.order_id, payment.model_dump()))
+        touched.setdefault(order["location_id"], set()).update(order["product_ids"])
+    db_payments.put_many(paid)
+    loyalty.record_many([
+        (order["user_id"], order["order_id"], order_amount(order))
+        for (_, result), order in zip(candidates, orders) if result["status"] == 200
+    ])
+    for location_id, product_ids in touched.items():
+        update_location_stock(location_id, list(product_ids))
+    notify_stock_change([product_id for product_ids in touched.values() for product_id in product_ids])
+    return bulk_response(results)
+
+@app.post("/orders/bulk")
+async def create_orders_bulk(request: Request):
+    items = await read_bulk_payload(request)
+    return await run_in_threadpool(create_orders_bulk_sync, items)
+
+@app.post("/payments/bulk")
+async def process_payments_bulk(request: Request):
+    items = await read_bulk_payload(request)
+    return await run_in_threadpool(process_payments_bulk_sync, items)
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return {"entries": len(cache.local), "namespaces": cache.stats}
+
+# Métricas que ya llevan los componentes: se leen al exportar, sin coste por request
+@metrics.collector
+def publisher_metrics():
+    stats = dict(order_publisher.stats)
+    yield "rabbitmq_publish_total", "counter", "Mensajes publicados en RabbitMQ por resultado", {"result": "published"}, stats["published"]
+    yield "rabbitmq_publish_total", "counter", "Mensajes publicados en RabbitMQ por resultado", {"result": "failed"}, stats["failed"]
+    yield "rabbitmq_publish_total", "counter", "Mensajes publicados en RabbitMQ por resultado", {"result": "dropped"}, stats["dropped"]
+    yield "rabbitmq_outbox_enqueued_total", "counter", "Mensajes aceptados en la cola de salida", {}, stats["enqueued"]
+    yield "rabbitmq_outbox_rejected_total", "counter", "Mensajes rechazados con la cola de salida llena", {}, stats["rejected"]
+    yield "rabbitmq_outbox_deduplicated_total", "counter", "Mensajes descartados por message_id repetido", {}, stats["deduplicated"]
+    yield "rabbitmq_outbox_pending", "gauge", "Mensajes pendientes en la cola de salida", {}, order_publisher.pending
+
+@metrics.collector
+def cache_metrics():
+    for namespace, counters in list(cache.stats.items()):
+        labels = {"namespace": namespace}
+        for field in ("hits", "misses", "invalidations"):
+            yield f"cache_{field}_total", "counter", f"Caché de lectura: {field}", labels, counters[field]
+        lookups = counters["hits"] + counters["misses"]
+        yield "cache_hit_ratio", "gauge", "Proporción de aciertos de la caché de lectura", labels, counters["hits"] / lookups if lookups else 0.0
+    yield "cache_entries", "gauge", "Entradas en la caché en memoria", {}, len(cache.local)
+
+@metrics.collector
+def startup_metrics():
+    yield "rabbitmq_connected", "gauge", "Hilos del publicador conectados a RabbitMQ", {}, order_publisher.connected
+    yield "rabbitmq_connect_errors_total", "counter", "Intentos de conexión a RabbitMQ fallidos", {}, order_publisher.stats["connect_errors"]
+    for name, status in warmup.status().items():
+        yield "subsystem_ready", "gauge", "1 si el subsistema terminó de inicializarse", {"subsystem": name}, int(status["state"] == "ready")
+
+@metrics.collector
+def log_metrics():
+    yield "log_records_suppressed_total", "counter", "Registros de log descartados por el muestreo", {}, log_sampler.suppressed
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+# Sondas de salud: liveness solo confirma que el proceso atiende; readiness
+# responde 503 hasta que los subsistemas que bloquean el servicio estén listos
+@app.get("/health/live")
+async def liveness():
+    return {"status": "alive", "uptime_seconds": round(time.time() - STARTED_AT, 3)}
+
+@app.get("/health/ready")
+async def readiness():
+    subsystems = warmup.status()
+    # Sin broker las órdenes esperan en la cola de salida: no bloquea el servicio
+    subsystems["rabbitmq"] = {
+        "state": "ready" if order_publisher.connected else "connecting",
+        "required": False,
+        "pending_messages": order_publisher.pending,
+    }
+    ready = warmup.ready
+    return JSONResponse(
+        {"status": "ready" if ready else "starting", "subsystems": subsystems},
+        status_code=200 if ready else 503,
+    )
 
 # Servicio de fidelidad
 @app.get("/loyalty/{user_id}", response_model=LoyaltyPoints)
-def get_loyalty_points(user_id: int):
-    return {"user_id": user_id, "points": db_loyalty.get(user_id, 0)}
+async def get_loyalty_points(user_id: int):
+    # Con saldos compartidos se lee db_loyalty, que también acumulan los workers
+    points = await storage.run(loyalty.balance, user_id) if loyalty.shared else loyalty.balance(user_id)
+    return {"user_id": user_id, "points": points}
+
+@app.post("/loyalty/rebuild")
+def rebuild_loyalty_points():
+    # Recalcula todos los saldos reproduciendo el ledger
+    loyalty.flush()
+    return {"users": loyalty.rebuild(), "entries": len(loyalty.ledger)}
+
+# Importación y exportación masiva (ver dataio.py). Solo para los usuarios de ADMIN_USER_IDS
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "1").split(",") if user_id.strip()}
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "10000"))
+# El cuerpo se guarda en memoria hasta este tamaño y después en un archivo temporal
+IMPORT_SPOOL_SIZE = int(os.getenv("IMPORT_SPOOL_SIZE", str(8 * 2**20)))
+# Los índices se actualizan por clave si la importación toca menos de esta
+# fracción de la tabla; si no, se reconstruyen completos
+INDEX_REBUILD_RATIO = 0.1
+import_lock = threading.Lock()
+
+def dataset_table(dataset: str):
+    return {
+        "products": db_products,
+        "stock": db_stock,
+        "locations": db_location,
+        "location_products": db_location_products,
+    }[dataset]
+
+def refresh_products(product_ids: set):
+    if len(product_ids) > INDEX_REBUILD_RATIO * max(1, len(product_index)):
+        product_index.build(db_products)
+        recommendation_index.build(db_products, db_orders.values())
+        return
+    for product_id in product_ids:
+        product = db_products.get(product_id)
+        if product is None:
+            product_index.remove(product_id)
+            recommendation_index.remove_product(product_id)
+        else:
+            product_index.add(product_id, product)
+            recommendation_index.add_product(product_id, product)
+
+def refresh_stock(product_ids: set):
+    if isinstance(stock_engine, RedisStockEngine):
+        stock_engine.load(overwrite=True, product_ids=product_ids)
+    # Con muchos SKUs es más barato recorrer el surtido de cada locación
+    only = list(product_ids) if len(product_ids) <= INDEX_REBUILD_RATIO * max(1, len(db_stock)) else None
+    for location_id in list(location_stock.locations()):
+        update_location_stock(location_id, only)
+    present = [product_id for product_id in product_ids if product_id in db_stock]
+    for start in range(0, len(present), 10_000):
+        notify_stock_change(present[start:start + 10_000])
+
+def refresh_location_products(location_ids: set):
+    for location_id in location_ids:
+        product_ids = db_location_products.get(location_id)
+        location_stock.remove_location(location_id)
+        if not product_ids or location_id not in db_location:
+            continue
+        location_stock.add_location(location_id)
+        quantities = {}
+        for product_id in product_ids:
+            stock = db_stock.get(product_id)
+            if stock is not None:
+                quantities[product_id] = stock["quantity"]
+        location_stock.update(location_id, quantities)
+
+def import_dataset(dataset: str, rows, mode: str = "delta", chunk_size: int = IMPORT_CHUNK_SIZE) -> dict:
+    """
+    Importa filas (ver dataio.import_rows) y actualiza una sola vez, al
+    final, los índices en memoria y la caché que dependen de la tabla.
+    Las importaciones se ejecutan de a una.
+    """
+    with import_lock:
+        report, touched = import_rows(dataset, dataset_table(dataset), rows, mode, chunk_size, tables=dataset_table)
+        start = time.perf_counter()
+        if dataset == "products":
+            refresh_products(touched)
+            cache.invalidate("products")
+        elif dataset == "stock":
+            refresh_stock(touched)
+            cache.invalidate("stock", "locations")
+        elif dataset == "location_products":
+            refresh_location_products(touched)
+            cache.invalidate("locations")
+        else:
+            changed = set()
+            for location_id in touched:
+                location_data = db_location.get(location_id)
+                index_location_point(location_id, location_data)
+                # Una locación eliminada deja de ofrecer stock y una que vuelve lo recupera
+                if (location_data is None) == (location_id in location_stock):
+                    changed.add(location_id)
+            refresh_location_products(changed)
+            cache.invalidate("locations")
+        report["index_seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+async def admin_user_id(user_id: int = Depends(session_user_id)) -> int:
+    if user_id not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Se requieren permisos de administrador")
+    return user_id
+
+def request_format(format: Optional[str], content_type: Optional[str]) -> str:
+    if format:
+        return format
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type == "text/csv":
+        return "csv"
+    if media_type in NDJSON_CONTENT_TYPES:
+        return "ndjson"
+    raise HTTPException(status_code=415, detail="Use Content-Type text/csv o application/x-ndjson, o indique ?format=")
+
+@app.post("/admin/import/{dataset}")
+async def import_data(
+    dataset: str,
+    request: Request,
+    mode: str = Query("delta", pattern="^(delta|full|delete)$"),
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    user_id: int = Depends(admin_user_id),
+):
+    if dataset not in DATASETS:
+        raise HTTPException(status_code=404, detail="Dataset desconocido")
+    fmt = request_format(format, request.headers.get("content-type"))
+    # El cuerpo se recibe por partes y se lee por bloques: la memoria no depende del tamaño del archivo
+    spool = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE)
+    try:
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.seek(0)
+        stream = gzip.GzipFile(fileobj=spool) if request.headers.get("content-encoding") == "gzip" else spool
+        return await run_in_threadpool(import_dataset, dataset, read_rows(stream, fmt), mode)
+    except (DataFormatError, UnicodeDecodeError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"Archivo inválido: {e}")
+    finally:
+        spool.close()
+
+@app.get("/admin/export/{dataset}")
+async def export_data(
+    dataset: str,
+    format: str = Query("ndjson", pattern="^(csv|ndjson)$"),
+    user_id: int = Depends(admin_user_id),
+):
+    if dataset not in DATASETS:
+        raise HTTPException(status_code=404, detail="Dataset desconocido")
+    rows = export_rows(dataset, dataset_table(dataset))
+    return StreamingResponse(
+        encode_rows(rows, format, DATASETS[dataset].columns),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{dataset}.{format}"'},
+    )
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Con más de un worker hace falta SHARED_STATE_URL (inventario) y un
+    # STORAGE_URL persistente (órdenes); si no, cada proceso tiene su copia de los db_*
+    if int(os.getenv("WEB_WORKERS", "1")) > 1 and (shared_redis is None or storage.name == "memory"):
+        logging.warning("WEB_WORKERS > 1 sin SHARED_STATE_URL y STORAGE_URL persistente: los workers no comparten estado")
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_WORKERS", "1")),
+        limit_concurrency=int(os.getenv("UVICORN_LIMIT_CONCURRENCY", "0")) or None,
+        backlog=int(os.getenv("UVICORN_BACKLOG", "2048")),
+    )
@@ -0,0 +1,344 @@
+"""
+Métricas en el formato de texto de Prometheus, sin dependencias externas.
+
+- Counter / Gauge / Histogram con etiquetas, registrados en un MetricsRegistry.
+- Colectores: funciones que se evalúan al exportar (p. ej. los contadores
+  que ya llevan el publicador o la caché), así que no cuestan nada en el
+  camino caliente.
+- MetricsMiddleware: latencia por ruta y requests en curso.
+- SampledLogFilter / configure_logging: muestreo de logs repetidos y,
+  opcionalmente, escritura de logs en un hilo aparte.
+"""
+import bisect
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Segundos: de 0.5 ms a 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Para operaciones internas, que suelen durar microsegundos
+OPERATION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.1)
+
+# (nombre, tipo, ayuda, etiquetas, valor)
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Valor que solo crece, uno por combinación de etiquetas.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+
+class Gauge(Counter):
+    """
+    Valor que sube y baja (p. ej. requests en curso).
+    """
+
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: "Histogram", labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Histogram:
+    """
+    Distribución de valores en cubetas fijas. Cada observación incrementa
+    una sola cubeta (búsqueda binaria); las cuentas acumuladas que pide
+    Prometheus se calculan al exportar.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # etiquetas -> [cuentas por cubeta (la última es +Inf), suma]
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labels) -> _Timer:
+        """
+        Context manager que observa la duración del bloque en segundos.
+        """
+        return _Timer(self, labels)
+
+    def timed(self, *labels):
+        """
+        Decorador que observa la duración de cada llamada a la función.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labels)
+            return wrapper
+        return decorator
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in series:
+            base = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket", {**base, "le": _format_value(float(bound))}, cumulative
+            yield self.name + "_sum", base, total
+            yield self.name + "_count", base, cumulative
+
+
+class MetricsRegistry:
+    """
+    Métricas registradas y colectores; `render` las exporta en formato de
+    texto de Prometheus con el prefijo común `prefix`.
+    """
+
+    def __init__(self, prefix: str = "inkafarma_"):
+        self.prefix = prefix
+        self._metrics: List = []
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def _register(self, metric):
+        metric.name = self.prefix + metric.name
+        # Registrar dos veces el mismo nombre (p. ej. al reconstruir la pila
+        # de middlewares) devuelve la métrica existente
+        for existing in self._metrics:
+            if existing.name == metric.name:
+                return existing
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, func: Callable[[], Iterable[Sample]]):
+        """
+        Registra una función que devuelve muestras (nombre, tipo, ayuda,
+        etiquetas, valor) al exportar. Se puede usar como decorador.
+        """
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        families: Dict[str, list] = {}
+        for metric in self._metrics:
+            family = families.setdefault(metric.name, [metric.kind, metric.help, []])
+            family[2].extend(metric.samples())
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                # Un colector roto no debe impedir exportar el resto
+                logging.error("Error en el colector de métricas %s: %s", getattr(collector, "__name__", collector), e)
+                continue
+            for name, kind, help, labels, value in samples:
+                name = self.prefix + name
+                families.setdefault(name, [kind, help, []])[2].append((name, labels, value))
+        lines = []
+        for name, (kind, help, samples) in families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI que mide la latencia de cada request por método, ruta
+    (la plantilla, p. ej. /stock/{product_id}, para no crear una serie por
+    id) y código de estado, y cuenta las requests en curso.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry):
+        self.app = app
+        self.latency = registry.histogram(
+            "http_request_duration_seconds", "Latencia de las requests HTTP", ("method", "route", "status"),
+        )
+        self.in_flight = registry.gauge("http_requests_in_flight", "Requests HTTP en curso")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.in_flight.dec()
+            # El router deja la ruta elegida en el scope
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            self.latency.observe(elapsed, scope["method"], route, str(status))
+
+
+class SampledLogFilter(logging.Filter):
+    """
+    Deja pasar a lo sumo `per_second` registros por segundo de cada mensaje
+    (misma plantilla y logger); el resto se descarta y se cuenta en
+    `suppressed`. Evita que un error repetido en el camino caliente (p. ej.
+    un reintento por orden) cueste un write por request. Con per_second <= 0
+    no se muestrea.
+    """
+
+    def __init__(self, per_second: float = 10):
+        super().__init__()
+        self.per_second = per_second
+        self.suppressed = 0
+        self._windows: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.per_second <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= 1:
+                self._windows[key] = [now, 1]
+                return True
+            if window[1] < self.per_second:
+                window[1] += 1
+                return True
+            self.suppressed += 1
+            return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que no bloquea ni falla si la cola está llena: descarta el
+    registro y lo cuenta en `dropped`.
+    """
+
+    def __init__(self, log_queue: "queue.Queue"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(sampler: SampledLogFilter, async_queue_size: int = 0,
+                      logger: Optional[logging.Logger] = None) -> Optional[logging.handlers.QueueListener]:
+    """
+    Aplica el muestreo a los handlers del logger (root por defecto). Con
+    `async_queue_size` > 0 esos handlers pasan a un hilo de fondo
+    (QueueListener) y el logger solo encola: quien loguea no espera la
+    escritura. Devuelve el listener para detenerlo al salir.
+    """
+    logger = logger or logging.getLogger()
+    if async_queue_size <= 0:
+        for handler in logger.handlers:
+            handler.addFilter(sampler)
+        return None
+    handlers = list(logger.handlers)
+    queue_handler = DroppingQueueHandler(queue.Queue(async_queue_size))
+    # El filtro va en el QueueHandler: lo descartado ni se formatea ni se encola
+    queue_handler.addFilter(sampler)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,45 @@
+import asyncio
+import json
+
+
+class ConcurrencyLimitMiddleware:
+    """
+    Middleware ASGI que limita las requests HTTP en curso. Si el límite está
+    lleno, la request espera hasta `queue_timeout` segundos a que se libere un
+    cupo y, si no, responde 503 en lugar de encolarse sin límite.
+    """
+
+    def __init__(self, app, limit: int, queue_timeout: float = 0.0):
+        self.app = app
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self._semaphore = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.limit <= 0:
+            await self.app(scope, receive, send)
+            return
+        if self._semaphore is None:
+            # Se crea dentro del event loop que atiende las requests
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if self._semaphore.locked() and not self.queue_timeout:
+            await self._reject(send)
+            return
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout or None)
+        except asyncio.TimeoutError:
+            await self._reject(send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._semaphore.release()
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": "Servidor saturado, reintente más tarde"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1")],
+        })
+        await send({"type": "http.response.body", "body": body})
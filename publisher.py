@@ -0,0 +1,292 @@
+import logging
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+
+class PublisherBusy(Exception):
+    """
+    La cola de salida está llena: el broker no da abasto y se rechaza el mensaje.
+    """
+
+
+class OrderPublisher:
+    """
+    Publicador asíncrono de órdenes hacia RabbitMQ.
+
+    Los handlers solo encolan el mensaje en una cola en memoria acotada
+    (outbox) y vuelven de inmediato. Un pool de hilos de fondo, cada uno con
+    su propia conexión y canal (pika no es thread-safe), vacía la cola en
+    lotes. Cada lote se publica dentro de una transacción del canal y el
+    broker lo confirma entero con un solo round trip (tx_commit); si falla,
+    el lote completo se vuelve a publicar tras reconectar. Con
+    confirm_delivery, el BlockingChannel de pika esperaría el ack de cada
+    mensaje. Si la cola se llena, `publish` falla rápido con PublisherBusy
+    (o espera `block_timeout` segundos).
+
+    Cada hilo se conecta apenas arranca, sin esperar al primer mensaje, y si
+    el broker no responde reintenta con backoff exponencial (con jitter, para
+    que varios procesos no reintenten a la vez) hasta `max_backoff`. Mientras
+    tanto los mensajes esperan en la cola de salida: `start` no bloquea y el
+    servicio atiende requests aunque RabbitMQ esté caído. `connected` indica
+    cuántos hilos tienen conexión.
+
+    Un mensaje con `message_id` se acepta una sola vez: si el mismo id ya
+    se encoló entre los últimos `dedup_window`, se descarta. Los consumidores
+    deduplican con el mismo id las copias que el broker pueda entregar de
+    más (p. ej. tras perder un ack).
+    """
+
+    def __init__(
+        self,
+        connection_factory: Callable,
+        queue_name: str = "orders",
+        max_queue: int = 10_000,
+        batch_size: int = 100,
+        flush_interval: float = 0.05,
+        channels: int = 2,
+        block_timeout: float = 0.0,
+        max_backoff: float = 5.0,
+        dedup_window: int = 100_000,
+    ):
+        self.connection_factory = connection_factory
+        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.channels = channels
+        self.block_timeout = block_timeout
+        self.max_backoff = max_backoff
+        self.dedup_window = dedup_window
+        self.stats = {
+            "enqueued": 0, "published": 0, "failed": 0, "rejected": 0, "dropped": 0, "deduplicated": 0,
+            "connect_errors": 0,
+        }
+        self.connected = 0
+        self._message_ids: "OrderedDict[str, None]" = OrderedDict()
+        self._ids_lock = threading.Lock()
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=max_queue)
+        self._stats_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def _count(self, field: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[field] += amount
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def publish(self, body: bytes, properties=None, message_id: Optional[str] = None) -> bool:
+        """
+        Encola un mensaje para su publicación. Devuelve False si `message_id`
+        ya se había encolado. Lanza PublisherBusy si la cola está llena.
+        """
+        if message_id is not None:
+            with self._ids_lock:
+                duplicate = message_id in self._message_ids
+                if not duplicate:
+                    self._message_ids[message_id] = None
+                    while len(self._message_ids) > self.dedup_window:
+                        self._message_ids.popitem(last=False)
+            if duplicate:
+                self._count("deduplicated")
+                return False
+        try:
+            if self.block_timeout > 0:
+                self._queue.put((body, properties), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((body, properties))
+        except queue.Full:
+            if message_id is not None:
+                with self._ids_lock:
+                    self._message_ids.pop(message_id, None)
+            self._count("rejected")
+            raise PublisherBusy("La cola de publicación está llena")
+        self._count("enqueued")
+        return True
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        for i in range(self.channels):
+            thread = threading.Thread(target=self._run, name=f"order-publisher-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Detiene los hilos tras intentar vaciar los mensajes pendientes.
+        """
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _connect(self):
+        connection = self.connection_factory()
+        channel = connection.channel()
+        channel.queue_declare(queue=self.queue_name)
+        channel.tx_select()
+        return connection, channel
+
+    def _next_batch(self) -> list:
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _close(self, connection):
+        try:
+            if connection is not None:
+                connection.close()
+        except Exception:
+            pass
+
+    def _drop_pending(self, batch: list):
+        # Al detener sin conexión: lo que queda en la cola de salida se pierde
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            logging.error("Se descartan %d mensajes al detener el publicador", len(batch))
+            self._count("dropped", len(batch))
+
+    def _run(self):
+        connection = channel = None
+        backoff = 0.1
+        batch: list = []
+        while not (self._stopping.is_set() and self._queue.empty() and not batch):
+            if channel is None:
+                try:
+                    connection, channel = self._connect()
+                except Exception as e:
+                    self._count("connect_errors")
+                    self._close(connection)
+                    connection = None
+                    if self._stopping.is_set():
+                        self._drop_pending(batch)
+                        return
+                    delay = random.uniform(backoff / 2, backoff)
+                    logging.warning("Sin conexión a RabbitMQ, reintento en %.2f s: %s", delay, e)
+                    self._stopping.wait(delay)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                self._count_connected(1)
+                logging.info("Conexión a RabbitMQ establecida (%s)", threading.current_thread().name)
+            if not batch:
+                batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                # Las publicaciones no esperan respuesta; tx_commit confirma el lote entero
+                for body, properties in batch:
+                    channel.basic_publish(exchange="", routing_key=self.queue_name, body=body, properties=properties)
+                channel.tx_commit()
+                self._count("published", len(batch))
+                batch = []
+                backoff = 0.1
+            except Exception as e:
+                logging.error("Error publicando en RabbitMQ: %s", e)
+                self._count("failed")
+                self._close(connection)
+                connection = channel = None
+                self._count_connected(-1)
+                if self._stopping.is_set():
+                    logging.error("Se descartan %d mensajes al detener el publicador", len(batch))
+                    self._count("dropped", len(batch))
+                    batch = []
+                    continue
+                self._stopping.wait(random.uniform(backoff / 2, backoff))
+                backoff = min(backoff * 2, self.max_backoff)
+        if channel is not None:
+            self._count_connected(-1)
+        self._close(connection)
+
+    def _count_connected(self, amount: int):
+        with self._stats_lock:
+            self.connected += amount
+
+
+class FakeBroker:
+    """
+    Broker en memoria que imita la API de pika.BlockingConnection, para
+    pruebas y benchmarks sin RabbitMQ. `latency` simula el round trip de
+    cada publicación fuera de una transacción y de cada tx_commit.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.queues = {}
+        self.acked = []
+        self.commits = 0
+        self._lock = threading.Lock()
+
+    def connection(self):
+        return _FakeConnection(self)
+
+
+class _FakeConnection:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self):
+        return _FakeChannel(self.broker)
+
+    def close(self):
+        self.is_open = False
+
+
+class _FakeChannel:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+        # Mensajes de la transacción en curso (None fuera de tx_select)
+        self._transaction: Optional[list] = None
+
+    def queue_declare(self, queue: str, **kwargs):
+        with self.broker._lock:
+            self.broker.queues.setdefault(queue, [])
+
+    def confirm_delivery(self):
+        pass
+
+    def tx_select(self):
+        self._transaction = []
+
+    def tx_commit(self):
+        if self.broker.latency:
+            time.sleep(self.broker.latency)
+        with self.broker._lock:
+            for routing_key, body, properties in self._transaction:
+                self.broker.queues.setdefault(routing_key, []).append((body, properties))
+            self.broker.commits += 1
+        self._transaction = []
+
+    def basic_qos(self, prefetch_count: int = 0):
+        pass
+
+    def basic_ack(self, delivery_tag: int):
+        with self.broker._lock:
+            self.broker.acked.append(delivery_tag)
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties: Optional[object] = None):
+        if self._transaction is not None:
+            self._transaction.append((routing_key, body, properties))
+            return
+        if self.broker.latency:
+            time.sleep(self.broker.latency)
+        with self.broker._lock:
+            self.broker.queues.setdefault(routing_key, []).append((body, properties))
@@ -0,0 +1,201 @@
+"""
+Índice de recomendaciones para /products/recomendations.
+"""
+import heapq
+import threading
+from itertools import combinations
+from typing import Dict, Iterable, List, Optional, Set
+
+from search import normalize
+
+
+class TopK:
+    """
+    Los `size` ids con mayor puntaje, ordenados de mayor a menor (a igual
+    puntaje, menor id primero). Los puntajes solo crecen, así que basta con
+    comparar contra el último para saber si un id entra: los que quedan fuera
+    nunca superan al mínimo de la lista. Si un id se elimina hay que
+    reconstruir con `rebuild`.
+    """
+
+    __slots__ = ("size", "entries")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: List[list] = []
+
+    def rebuild(self, scores: Dict[int, int]):
+        self.entries = [[score, item_id] for item_id, score in
+                        heapq.nsmallest(self.size, scores.items(), key=lambda kv: (-kv[1], kv[0]))]
+
+    def update(self, item_id: int, score: int):
+        entries = self.entries
+        for entry in entries:
+            if entry[1] == item_id:
+                entry[0] = score
+                break
+        else:
+            if len(entries) < self.size:
+                entries.append([score, item_id])
+            elif (-score, item_id) < (-entries[-1][0], entries[-1][1]):
+                entries[-1] = [score, item_id]
+            else:
+                return
+        entries.sort(key=lambda entry: (-entry[0], entry[1]))
+
+    def ids(self) -> Iterable[int]:
+        return (item_id for _, item_id in self.entries)
+
+
+class RecommendationIndex:
+    """
+    Recomendaciones por producto a partir de dos índices incrementales:
+
+    - Co-compra: cuántas órdenes incluyen a la vez cada par de productos.
+    - Categoría: productos de cada categoría por popularidad (órdenes en
+      las que aparecen).
+
+    Por producto se mantiene el top-K de co-compra y por categoría el top
+    por popularidad; ambos se actualizan con cada orden, así que una
+    consulta solo mezcla dos listas ya ordenadas: O(K).
+    Resultado: primero lo que se compra junto con el producto y después lo
+    más vendido de su categoría, sin repetir ni incluir el propio producto.
+    """
+
+    def __init__(self, products: Optional[Dict[int, dict]] = None, orders: Optional[Iterable[dict]] = None, top_k: int = 20):
+        self.top_k = top_k
+        self.products: Dict[int, dict] = {}
+        self._categories: Dict[str, Set[int]] = {}
+        self._popularity: Dict[int, int] = {}
+        self._pairs: Dict[int, Dict[int, int]] = {}
+        self._co_top: Dict[int, TopK] = {}
+        self._category_top: Dict[str, TopK] = {}
+        self._lock = threading.Lock()
+        if products is not None:
+            self.build(products, orders or ())
+
+    def build(self, products: Dict[int, dict], orders: Iterable[dict]):
+        """
+        Reconstruye el índice: primero se cuentan todas las órdenes y luego
+        se calcula cada top una sola vez.
+        """
+        with self._lock:
+            self.products = dict(products)
+            self._categories = {}
+            for product_id, product in self.products.items():
+                self._categories.setdefault(normalize(product.get("category")), set()).add(product_id)
+            popularity: Dict[int, int] = {}
+            pairs: Dict[int, Dict[int, int]] = {}
+            for order in orders:
+                product_ids = sorted(set(order["product_ids"]))
+                for product_id in product_ids:
+                    popularity[product_id] = popularity.get(product_id, 0) + 1
+                for a, b in combinations(product_ids, 2):
+                    counts = pairs.setdefault(a, {})
+                    counts[b] = counts.get(b, 0) + 1
+                    counts = pairs.setdefault(b, {})
+                    counts[a] = counts.get(a, 0) + 1
+            self._popularity = popularity
+            self._pairs = pairs
+            self._co_top = {}
+            for product_id, counts in pairs.items():
+                top = TopK(self.top_k)
+                top.rebuild(counts)
+                self._co_top[product_id] = top
+            self._category_top = {}
+            for category in self._categories:
+                self._rebuild_category(category)
+
+    def _category_size(self) -> int:
+        # Con K + 1 candidatos extra siempre se completan K tras descartar
+        # el propio producto y los que ya vienen por co-compra
+        return 2 * self.top_k + 1
+
+    def _rebuild_category(self, category: str):
+        ids = self._categories.get(category)
+        if not ids:
+            self._category_top.pop(category, None)
+            return
+        top = TopK(self._category_size())
+        top.rebuild({product_id: self._popularity.get(product_id, 0) for product_id in ids})
+        self._category_top[category] = top
+
+    def add_product(self, product_id: int, product: dict):
+        """
+        Indexa (o reindexa) un producto del catálogo.
+        """
+        with self._lock:
+            old = self.products.get(product_id)
+            self.products[product_id] = product
+            category = normalize(product.get("category"))
+            if old is not None and normalize(old.get("category")) != category:
+                old_category = normalize(old.get("category"))
+                self._categories[old_category].discard(product_id)
+                self._rebuild_category(old_category)
+            self._categories.setdefault(category, set()).add(product_id)
+            top = self._category_top.setdefault(category, TopK(self._category_size()))
+            top.update(product_id, self._popularity.get(product_id, 0))
+
+    def remove_product(self, product_id: int):
+        """
+        Quita un producto del catálogo y de las recomendaciones de los demás.
+        """
+        with self._lock:
+            product = self.products.pop(product_id, None)
+            if product is None:
+                return
+            category = normalize(product.get("category"))
+            self._categories[category].discard(product_id)
+            self._rebuild_category(category)
+            self._co_top.pop(product_id, None)
+            for other in self._pairs.pop(product_id, {}):
+                counts = self._pairs.get(other, {})
+                counts.pop(product_id, None)
+                self._co_top[other].rebuild(counts)
+
+    def add_order(self, order: dict):
+        """
+        Suma una orden a los índices de co-compra y popularidad.
+        """
+        product_ids = sorted(set(order["product_ids"]))
+        with self._lock:
+            for product_id in product_ids:
+                popularity = self._popularity.get(product_id, 0) + 1
+                self._popularity[product_id] = popularity
+                product = self.products.get(product_id)
+                if product is not None:
+                    top = self._category_top.get(normalize(product.get("category")))
+                    if top is not None:
+                        top.update(product_id, popularity)
+            for a, b in combinations(product_ids, 2):
+                for x, y in ((a, b), (b, a)):
+                    counts = self._pairs.setdefault(x, {})
+                    count = counts.get(y, 0) + 1
+                    counts[y] = count
+                    top = self._co_top.get(x)
+                    if top is None:
+                        top = self._co_top[x] = TopK(self.top_k)
+                    top.update(y, count)
+
+    def recommend(self, product_id: int, limit: Optional[int] = None) -> Optional[List[dict]]:
+        """
+        Hasta `limit` (como máximo top_k) productos recomendados, o None si
+        el producto no existe.
+        """
+        limit = self.top_k if limit is None else min(limit, self.top_k)
+        with self._lock:
+            product = self.products.get(product_id)
+            if product is None:
+                return None
+            results = []
+            seen = {product_id}
+            co_top = self._co_top.get(product_id)
+            category_top = self._category_top.get(normalize(product.get("category")))
+            for candidates in (co_top.ids() if co_top else (), category_top.ids() if category_top else ()):
+                for candidate in candidates:
+                    if len(results) >= limit:
+                        return results
+                    if candidate not in seen and candidate in self.products:
+                        seen.add(candidate)
+                        results.append({"id": candidate, **self.products[candidate]})
+            return results
@@ -1,8 +1,14 @@
+import random
+import threading
+import time
+
 import pytest
 from fastapi.testclient import TestClient
-from main import app, db_orders, db_payments, db_loyalty, db_stock
+from main import app, db_orders, db_payments, db_loyalty, db_stock, warmup
 
 client = TestClient(app)
+# Varias pruebas usan los índices directamente: se construyen ya, como tras /health/ready
+warmup.run()
 
 def test_login_ok():
     data = {"username": "admin", "password": "password123", "user_id": 1}
@@ -19,6 +25,34 @@ def test_login_fail():
     print("Respuesta:", response.status_code, response.json())
     assert response.status_code == 401
 
+def test_login_session_token():
+    from main import db_users
+    print("Probando el token de sesión del login")
+    assert db_users[1]["password"].startswith("pbkdf2_sha256$")
+    response = client.post("/auth/login", json={"username": "invitado", "password": "secret", "user_id": 2})
+    token = response.json()["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/auth/me", headers=headers).json() == {"user_id": 2, "username": "invitado"}
+    assert client.post("/auth/logout", headers=headers).status_code == 200
+    assert client.get("/auth/me", headers=headers).status_code == 401
+    assert client.get("/auth/me").status_code == 401
+
+def test_login_rate_limited(monkeypatch):
+    import main
+    from auth import RateLimiter
+    print("Probando el limitador de intentos de login")
+    limiter = RateLimiter(rate=0.01, burst=3)
+    monkeypatch.setattr(main, "login_limiter", limiter)
+    data = {"username": "admin", "password": "incorrecta", "user_id": 1}
+    codes = [client.post("/auth/login", json=data).status_code for _ in range(5)]
+    assert codes == [401, 401, 401, 429, 429]
+    response = client.post("/auth/login", json={**data, "password": "password123"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    # Las fichas se recuperan con el tiempo y cada clave tiene su propio bucket
+    assert limiter.acquire("ip:otra", now=time.monotonic()) == 0
+    assert limiter.acquire("ip:testclient", "user:admin", now=time.monotonic() + 100) == 0
+
 def test_get_products():
     print("Probando /products")
     response = client.get("/products")
@@ -47,6 +81,30 @@ def test_get_products_by_category():
     for p in data:
         assert category.lower() in p["category"].lower()
 
+def test_get_products_by_name_ranked_and_paginated():
+    name = "ensure"
+    print(f"Probando /products/name/{name} con paginación")
+    response = client.get(f"/products/name/{name}")
+    data = response.json()
+    print("Respuesta:", response.status_code, data)
+    assert response.status_code == 200
+    # La coincidencia exacta va primero que las coincidencias por prefijo
+    assert [p["name"] for p in data] == ["Ensure", "Ensure Plus"]
+    response = client.get(f"/products/name/{name}?limit=1&offset=1")
+    assert [p["name"] for p in response.json()] == ["Ensure Plus"]
+
+def test_product_index_updates():
+    from main import product_index
+    print("Probando actualización incremental del índice de productos")
+    product_index.add(999, {"name": "Panadol Forte", "price": 12.0, "category": "Medicines"})
+    try:
+        names = [p["name"] for p in product_index.search_name("panadol")]
+        assert names == ["Panadol", "Panadol Forte"]
+    finally:
+        product_index.remove(999)
+    assert [p["name"] for p in product_index.search_name("panadol")] == ["Panadol"]
+    assert all(p["id"] != 999 for p in product_index.search_category("medicines"))
+
 def test_get_product_in_category_by_id():
     category = "Medicines"
     product_id = 2  # Panadol
@@ -67,6 +125,35 @@ def test_get_products_recomendations():
     assert isinstance(data, list)
     for p in data:
         assert "medicines" in p["category"].lower()
+    assert product_id not in [p["id"] for p in data]
+    assert len(client.get(f"/products/recomendations/{product_id}?limit=2").json()) == 2
+    assert client.get("/products/recomendations/404").status_code == 404
+
+def test_recommendation_index_ranking_and_updates():
+    from recommend import RecommendationIndex
+    print("Probando el índice de recomendaciones")
+    products = {pid: {"name": f"P{pid}", "price": 1.0, "category": "A" if pid <= 5 else "B"} for pid in range(1, 9)}
+    rng = random.Random(3)
+    orders = [{"product_ids": rng.sample(range(1, 9), rng.randint(1, 4))} for _ in range(300)]
+    orders += [{"product_ids": [1, 7, 7]}] * 200
+
+    incremental = RecommendationIndex(products, [], top_k=4)
+    for order in orders:
+        incremental.add_order(order)
+    rebuilt = RecommendationIndex(products, orders, top_k=4)
+    for pid in products:
+        assert incremental.recommend(pid) == rebuilt.recommend(pid)
+
+    # El más comprado junto con 1 es el 7 (otra categoría); luego lo más vendido de la categoría
+    ids = [p["id"] for p in rebuilt.recommend(1, limit=10)]
+    assert ids[0] == 7 and 1 not in ids and len(ids) == 4
+    assert len(rebuilt.recommend(1, limit=2)) == 2
+    assert rebuilt.recommend(99) is None
+
+    rebuilt.remove_product(7)
+    assert 7 not in [p["id"] for p in rebuilt.recommend(1)]
+    rebuilt.add_product(9, {"name": "P9", "price": 1.0, "category": "A"})
+    assert len(rebuilt.recommend(9)) == 4
 
 def test_create_order():
     new_order = {
@@ -89,6 +176,186 @@ def test_create_order():
     assert order["quantity"] == [5, 2]
     assert order["location_id"] == 1
 
+def test_order_publisher_batches_to_broker():
+    from publisher import FakeBroker, OrderPublisher
+    print("Probando publicación en lotes contra un broker simulado")
+    broker = FakeBroker()
+    publisher = OrderPublisher(broker.connection, batch_size=10, channels=2)
+    publisher.start()
+    for i in range(50):
+        publisher.publish(str(i).encode("utf-8"))
+    publisher.stop()
+    print("Estadísticas del publicador:", publisher.stats)
+    assert len(broker.queues["orders"]) == 50
+    assert publisher.stats["published"] == 50
+    assert publisher.pending == 0
+    # Un round trip de confirmación por lote, no por mensaje
+    assert 5 <= broker.commits < 50
+
+def test_order_publisher_republishes_failed_batch(monkeypatch):
+    from publisher import FakeBroker, OrderPublisher, _FakeChannel
+    print("Probando que un lote no confirmado se publique de nuevo completo")
+    broker = FakeBroker()
+    failures = []
+    commit = _FakeChannel.tx_commit
+
+    def failing_commit(channel):
+        if not failures:
+            failures.append(len(channel._transaction))
+            raise ConnectionError("el broker rechazó la transacción")
+        commit(channel)
+
+    monkeypatch.setattr(_FakeChannel, "tx_commit", failing_commit)
+    publisher = OrderPublisher(broker.connection, batch_size=10, channels=1)
+    for i in range(10):
+        publisher.publish(str(i).encode("utf-8"))
+    publisher.start()
+    deadline = time.monotonic() + 5
+    while publisher.stats["published"] < 10 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    publisher.stop()
+    assert failures == [10]
+    assert [body for body, _ in broker.queues["orders"]] == [str(i).encode("utf-8") for i in range(10)]
+    assert publisher.stats["published"] == 10 and publisher.stats["failed"] == 1
+    assert publisher.stats["dropped"] == 0
+
+def test_order_publisher_connects_in_background():
+    from publisher import FakeBroker, OrderPublisher
+    print("Probando la conexión en segundo plano con reintentos")
+    broker = FakeBroker()
+    attempts = []
+
+    def flaky_connection():
+        attempts.append(time.monotonic())
+        if len(attempts) <= 2:
+            raise ConnectionError("broker no disponible")
+        return broker.connection()
+
+    publisher = OrderPublisher(flaky_connection, channels=1)
+    start = time.perf_counter()
+    publisher.start()
+    # start no espera al broker y los mensajes se aceptan sin conexión
+    assert time.perf_counter() - start < 0.05
+    publisher.publish(b"orden")
+    deadline = time.monotonic() + 5
+    while publisher.stats["published"] < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert publisher.connected == 1
+    publisher.stop()
+    assert broker.queues["orders"] and publisher.connected == 0
+    assert publisher.stats["connect_errors"] == 2
+    # Backoff exponencial con jitter: la segunda espera es mayor o igual a 0.1 s
+    assert attempts[2] - attempts[1] >= 0.1
+
+def test_order_codecs_round_trip():
+    from codec import BINARY_CONTENT_TYPE, decode_order, encode_order
+    print("Probando codificación JSON y binaria de órdenes")
+    order = {"order_id": 7, "user_id": 1, "product_ids": [2, 4, 19], "quantity": [5, 2, 1], "location_id": 3}
+    for codec in ("json", "binary"):
+        body, content_type = encode_order(order, codec)
+        print(f"{codec}: {len(body)} bytes ({content_type})")
+        assert decode_order(body, content_type) == order
+    body, content_type = encode_order(order, "binary")
+    assert content_type == BINARY_CONTENT_TYPE
+    assert len(body) < len(str(order))
+    # Mensajes antiguos sin content_type
+    assert decode_order(str(order).encode("utf-8")) == order
+
+def test_published_order_carries_content_type(monkeypatch):
+    import main
+    from codec import decode_order
+    from publisher import OrderPublisher
+    print("Probando cabeceras del mensaje publicado")
+    publisher = OrderPublisher(lambda: None)
+    monkeypatch.setattr(main, "order_publisher", publisher)
+    order = {"order_id": 3001, "user_id": 1, "product_ids": [1], "quantity": [2], "location_id": 1}
+    main.publish_order(order)
+    body, properties = publisher._queue.get_nowait()
+    assert properties.headers["x-schema-version"] == 1
+    assert decode_order(body, properties.content_type) == order
+
+def test_unencodable_order_releases_reservation(monkeypatch):
+    import main
+    from codec import CodecError, encode_order
+    print("Probando que una orden que no se puede codificar libera su reserva")
+    order = {"order_id": 3002, "user_id": 2 ** 64, "product_ids": [7], "quantity": [2], "location_id": 1}
+    try:
+        encode_order(order, "binary")
+        assert False, "debió fallar: user_id no entra en 64 bits"
+    except CodecError:
+        pass
+    monkeypatch.setattr(main, "ORDER_CODEC", "binary")
+    available = main.stock_engine.available(7)
+    response = client.post("/orders/create", json=order)
+    assert response.status_code == 422 and "codificar" in response.json()["detail"]
+    response = client.post("/orders/bulk", json=[{**order, "order_id": 3003}])
+    assert response.json()["results"][0]["status"] == 422
+    assert main.stock_engine.available(7) == available
+    assert 3002 not in db_orders and 3003 not in db_orders
+
+def test_worker_processes_and_dead_letters_orders():
+    from types import SimpleNamespace
+    from codec import encode_order
+    from publisher import FakeBroker
+    from worker import OrderConsumer, process_order
+    print("Probando el consumidor de la cola 'orders'")
+    broker = FakeBroker()
+    channel = broker.connection().channel()
+    consumer = OrderConsumer(process_order, max_retries=1)
+    consumer.setup(channel, prefetch=10)
+
+    def deliver(tag, order, headers=None):
+        body, content_type = encode_order(order, "binary")
+        properties = SimpleNamespace(content_type=content_type, headers=headers)
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=tag), properties, body)
+
+    initial_stock = db_stock[7]["quantity"]
+    deliver(1, {"order_id": 4001, "user_id": 2, "product_ids": [7], "quantity": [4], "location_id": 1})
+    assert db_stock[7]["quantity"] == initial_stock - 4
+    assert db_payments[4001]["status"] == "Paid"
+    # Reentrega de una orden ya pagada: no vuelve a descontar stock
+    deliver(2, {"order_id": 4001, "user_id": 2, "product_ids": [7], "quantity": [4], "location_id": 1})
+    assert db_stock[7]["quantity"] == initial_stock - 4
+    # Producto inexistente: directo a la cola de mensajes muertos
+    deliver(3, {"order_id": 4002, "user_id": 2, "product_ids": [9999], "quantity": [1], "location_id": 1})
+    assert len(broker.queues["orders.dead"]) == 1
+    assert broker.acked == [1, 2, 3]
+    print("Estadísticas del consumidor:", consumer.stats)
+    assert consumer.stats == {"processed": 2, "retried": 0, "dead_lettered": 1, "duplicates": 0}
+
+def test_worker_retries_then_dead_letters():
+    from types import SimpleNamespace
+    from codec import encode_order
+    from publisher import FakeBroker
+    from worker import OrderConsumer
+
+    def failing_handler(order):
+        raise RuntimeError("base de datos no disponible")
+
+    broker = FakeBroker()
+    channel = broker.connection().channel()
+    consumer = OrderConsumer(failing_handler, max_retries=1)
+    body, content_type = encode_order({"order_id": 1, "user_id": 1, "product_ids": [1], "quantity": [1], "location_id": 1})
+    consumer.on_message(channel, SimpleNamespace(delivery_tag=1), SimpleNamespace(content_type=content_type, headers=None), body)
+    retried_body, retried_properties = broker.queues["orders"][0]
+    assert retried_properties.headers["x-retries"] == 1
+    consumer.on_message(channel, SimpleNamespace(delivery_tag=2), retried_properties, retried_body)
+    assert len(broker.queues["orders.dead"]) == 1
+    assert consumer.stats == {"processed": 0, "retried": 1, "dead_lettered": 1, "duplicates": 0}
+
+def test_create_order_rejected_when_outbox_full(monkeypatch):
+    import main
+    from publisher import OrderPublisher
+    print("Probando /orders/create con la cola de salida llena")
+    # Publicador sin iniciar y con capacidad 1: la segunda orden no cabe
+    monkeypatch.setattr(main, "order_publisher", OrderPublisher(lambda: None, max_queue=1))
+    order = {"order_id": 2001, "user_id": 1, "product_ids": [1], "quantity": [1], "location_id": 1}
+    assert client.post("/orders/create", json=order).status_code == 200
+    response = client.post("/orders/create", json={**order, "order_id": 2002})
+    print("Respuesta /orders/create:", response.status_code, response.json())
+    assert response.status_code == 503
+    assert 2002 not in db_orders
+
 def test_get_orders():
     print("Probando /orders")
     response = client.get("/orders")
@@ -109,6 +376,197 @@ def test_get_orders():
     assert order_999["quantity"] == [5, 2]
     assert order_999["location_id"] == 1
 
+def test_get_orders_paginated_and_streamed():
+    import json
+    print("Probando /orders con cursor y NDJSON")
+    ids = sorted(db_orders)
+    response = client.get("/orders?limit=1")
+    assert [o["order_id"] for o in response.json()] == ids[:1]
+    response = client.get(f"/orders?after_id={ids[0]}&limit=2")
+    assert [o["order_id"] for o in response.json()] == ids[1:3]
+    response = client.get("/orders?format=ndjson")
+    print("Respuesta /orders (ndjson):", response.status_code, response.headers["content-type"])
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["order_id"] for line in response.text.splitlines()] == ids
+
+def test_get_products_streamed_after_cursor():
+    import json
+    response = client.get("/products?format=ndjson&after_id=18")
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [19, 20]
+    assert client.get("/products?format=xml").status_code == 422
+
+def test_admin_import_and_export():
+    import json
+    print("Probando /admin/import y /admin/export")
+    token = client.post("/auth/login", json={"username": "admin", "password": "password123", "user_id": 1}).json()["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    body = "id,name,price,category\n30,Paracetamol 1g,6.5,Medicines\n31,sin precio,,Baby\n"
+    response = client.post("/admin/import/products", content=body.encode(), headers={**headers, "Content-Type": "text/csv"})
+    report = response.json()
+    print("Respuesta /admin/import/products:", response.status_code, report)
+    assert response.status_code == 200
+    assert report["imported"] == 1 and report["rejected"] == 1 and report["errors"][0]["row"] == 2
+    assert [p["id"] for p in client.get("/products/name/paracetamol 1").json()] == [30]
+    response = client.get("/admin/export/products?format=ndjson", headers=headers)
+    assert {"id": 30, "name": "Paracetamol 1g", "price": 6.5, "category": "Medicines"} in [
+        json.loads(line) for line in response.text.splitlines()
+    ]
+    response = client.post("/admin/import/products?mode=delete&format=ndjson", content=b'{"id": 30}\n', headers=headers)
+    assert response.json()["deleted"] == 1
+    assert client.get("/products/name/paracetamol 1").json() == []
+    # Solo los administradores importan o exportan
+    token = client.post("/auth/login", json={"username": "invitado", "password": "secret", "user_id": 2}).json()["token"]
+    assert client.get("/admin/export/stock", headers={"Authorization": f"Bearer {token}"}).status_code == 403
+    assert client.get("/admin/export/stock").status_code == 401
+    assert client.post("/admin/import/stock", content=b"", headers=headers).status_code == 415
+
+def test_deleted_location_leaves_availability():
+    from main import import_dataset, location_stock
+    print("Probando que una locación eliminada deja de ofrecer stock")
+    import_dataset("locations", [{"location_id": 40, "location_name": "Botica", "latitude": -12.05, "longitude": -77.04}])
+    import_dataset("location_products", [{"location_id": 40, "product_id": 1}])
+    query = {"product_ids": [1], "quantity": [1], "limit": 100}
+
+    def available():
+        return {row["location_id"]: row["location_name"] for row in client.post("/locations/availability", json=query).json()}
+
+    assert available()[40] == "Botica"
+    import_dataset("locations", [{"location_id": 40}], mode="delete")
+    assert 40 not in available() and 40 not in location_stock
+    assert client.get("/locations/40/stock/1").status_code == 404
+    # Si vuelve, recupera los productos que tenía asignados
+    import_dataset("locations", [{"location_id": 40, "location_name": "Botica"}])
+    assert available()[40] == "Botica"
+    import_dataset("location_products", [{"location_id": 40, "product_id": 1}], mode="delete")
+    import_dataset("locations", [{"location_id": 40}], mode="delete")
+    assert 40 not in location_stock
+
+def test_location_products_reject_unknown_sku():
+    from main import build_location_stock, db_location_products, import_dataset, location_stock, refresh_location_products
+    print("Probando que location_products rechaza SKUs sin stock")
+    before = list(db_location_products[1])
+    report = import_dataset("location_products", [{"location_id": 1, "product_id": 999}, {"location_id": 1, "product_id": 3}])
+    assert (report["imported"], report["rejected"]) == (1, 1)
+    assert report["errors"] == [{"row": 1, "detail": "product_id: 999 no existe en stock"}]
+    assert 999 not in db_location_products[1] and location_stock.get(1, 3) is not None
+    # Una base que ya tiene el SKU (p. ej. borrado del stock después) sigue arrancando
+    db_location_products[1] = db_location_products[1] + [999]
+    build_location_stock()
+    assert location_stock.get(1, 999) is None and location_stock.get(1, 3) is not None
+    db_location_products[1] = before
+    refresh_location_products({1})
+    assert location_stock.get(1, 3) is None
+
+def test_import_rows_modes():
+    from dataio import import_rows, read_rows
+    from pagination import KeysetTable
+    import io
+    print("Probando los modos delta, full y delete del importador")
+    table = KeysetTable({1: {"product_id": 1, "quantity": 5}, 2: {"product_id": 2, "quantity": 7}})
+    rows = read_rows(io.BytesIO(b"product_id,quantity\n2,9\n3,1\n4,x\n"), "csv")
+    report, touched = import_rows("stock", table, rows, chunk_size=2)
+    assert (report["imported"], report["rejected"], touched) == (2, 1, {2, 3})
+    assert table[2]["quantity"] == 9 and table.page_keys() == [1, 2, 3]
+    report, touched = import_rows("stock", table, [{"product_id": 3, "quantity": 4}], mode="full")
+    assert report["deleted"] == 2 and table.page_keys() == [3] and touched == {1, 2, 3}
+    report, _ = import_rows("stock", table, [{"product_id": 3}], mode="delete")
+    assert report["deleted"] == 1 and len(table) == 0
+    # Una línea con columnas de más o de menos se rechaza con su número
+    rows = read_rows(io.BytesIO(b"product_id,quantity\n5,1,9\n\n6\n7,2\n"), "csv")
+    report, touched = import_rows("stock", table, rows)
+    assert (report["imported"], report["rejected"], touched) == (1, 2, {7})
+    assert [error["detail"] for error in report["errors"]] == [
+        "línea 2: 3 columnas, se esperaban 2", "línea 4: 1 columnas, se esperaban 2"]
+
+def test_import_grouped_rows_streams_groups():
+    from dataio import import_rows
+    from pagination import KeysetTable
+    print("Probando que los datasets agrupados se escriben por bloque")
+
+    class RecordingTable(KeysetTable):
+        def put_many(self, items):
+            items = list(items)
+            writes.append([key for key, _ in items])
+            super().put_many(items)
+
+    table = RecordingTable({1: [10], 9: [90]})
+    writes = []
+    rows = [{"location_id": location_id, "product_id": product_id}
+            for location_id, product_id in [(1, 11), (1, 12), (2, 20), (2, 21), (3, 30), (1, 13)]]
+    report, touched = import_rows("location_products", table, rows, mode="full", chunk_size=2)
+    # Cada grupo se escribe al cerrarse; el 1 reaparece y se agrega a lo importado
+    assert writes == [[1], [2, 3], [1]]
+    assert dict(table.items()) == {1: [11, 12, 13], 2: [20, 21], 3: [30]}
+    assert (report["imported"], report["deleted"], touched) == (6, 1, {1, 2, 3, 9})
+    report, _ = import_rows("location_products", table, [{"location_id": 2, "product_id": 20}], mode="delete")
+    assert table[2] == [21] and report["deleted"] == 1
+
+def test_keyset_table():
+    from pagination import KeysetTable, iter_rows
+    print("Probando KeysetTable")
+    table = KeysetTable({5: "e", 1: "a"})
+    table[3] = "c"
+    table.setdefault(9, "i")
+    del table[5]
+    assert table.page_keys() == [1, 3, 9]
+    assert table.page_keys(after_id=1, limit=1) == [3]
+    assert table.pop(3) == "c" and table.page_keys() == [1, 9]
+    rows = list(iter_rows(table, lambda k, v: (k, v), chunk=1))
+    assert rows == [(1, "a"), (9, "i")]
+
+def test_sqlite_storage_persists_tables(tmp_path):
+    from pagination import iter_rows
+    from storage import SQLiteStorage
+    print("Probando el backend SQLite")
+    path = str(tmp_path / "inkafarma.db")
+    storage = SQLiteStorage(path, pool_size=2)
+    orders = storage.table("orders")
+    stock = storage.table("stock", {1: {"product_id": 1, "quantity": 10}})
+    orders.put_many(
+        (order_id, {"order_id": order_id, "user_id": 1, "product_ids": [2, 1, 2], "quantity": [1, 2, 3], "location_id": 1})
+        for order_id in range(1, 6)
+    )
+    stock[1] = {**stock[1], "quantity": 7}
+    storage.table("loyalty")[1] = 40
+    assert orders.page_keys(after_id=2, limit=2) == [3, 4]
+    assert [row["order_id"] for row in iter_rows(orders, lambda k, v: v, chunk=2)] == [1, 2, 3, 4, 5]
+    with storage.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode")
+        assert cursor.fetchone()[0] == "wal"
+    storage.close()
+
+    # Al reabrir, los datos siguen ahí y la carga inicial no los pisa
+    reopened = SQLiteStorage(path)
+    assert reopened.table("orders")[3]["product_ids"] == [2, 1, 2]
+    assert reopened.table("stock", {1: {"product_id": 1, "quantity": 10}})[1]["quantity"] == 7
+    assert reopened.table("loyalty").get(1) == 40
+    del reopened.table("orders")[3]
+    assert 3 not in reopened.table("orders") and len(reopened.table("orders")) == 4
+    reopened.close()
+
+def test_generic_sql_storage_with_dbapi_driver(tmp_path):
+    import sqlite3
+    from inventory import StockEngine
+    from storage import SQLStorage
+    print("Probando el backend SQL genérico con un driver DB-API")
+    path = str(tmp_path / "generic.db")
+    storage = SQLStorage(lambda: sqlite3.connect(path, check_same_thread=False), paramstyle="qmark", pool_size=4)
+    stock = storage.table("stock", {pid: {"product_id": pid, "quantity": 100} for pid in range(1, 4)})
+    engine = StockEngine(stock)
+    engine.commit(1, {1: 5, 2: 10})
+    assert stock[1]["quantity"] == 95 and stock[2]["quantity"] == 90
+    locations = storage.table("location_products", {1: [3, 1], 2: [2]})
+    assert dict(locations.items()) == {1: [1, 3], 2: [2]}
+    assert 2 in locations and 9 not in locations
+    # Páginas por locación y recorridos por bloques de filas (keyset por location_id, product_id)
+    locations.put_many((location_id, list(range(location_id, location_id + 5))) for location_id in range(3, 9))
+    assert locations.page_items(after_id=2, limit=2) == [(3, [3, 4, 5, 6, 7]), (4, [4, 5, 6, 7, 8])]
+    assert locations.page_keys(after_id=7) == [8] and locations.page_items(after_id=8) == []
+    assert list(locations.iter_items(chunk=3)) == list(locations.iter_items()) == [
+        (1, [1, 3]), (2, [2]), *((location_id, list(range(location_id, location_id + 5))) for location_id in range(3, 9))
+    ]
+    storage.close()
+
 def test_process_payment():
     print("Probando /payments/process para orden 999")
     # Tomamos el stock inicial de productos
@@ -139,6 +597,593 @@ def test_process_payment():
     print("Orden asociada al pago:", order)
     assert order["user_id"] == 1
 
+RESTART_PAYMENT_SCRIPT = """
+import json, sys
+from fastapi.testclient import TestClient
+import main
+with TestClient(main.app) as client:
+    if sys.argv[1] == "create":
+        order = {"order_id": 7001, "user_id": 3, "product_ids": [5], "quantity": [2], "location_id": 2}
+        assert client.post("/orders/create", json=order).status_code == 200
+    status = client.post("/payments/process", json={"order_id": 7001, "status": "Paid"}).status_code
+    print(json.dumps([status, main.db_stock[5]["quantity"], main.loyalty.balance(3)]))
+"""
+
+def test_payment_not_repeated_after_restart(tmp_path):
+    import json
+    import os
+    import subprocess
+    import sys
+    print("Probando que una orden pagada no se vuelve a pagar tras reiniciar con SQLite")
+    script = tmp_path / "pay.py"
+    script.write_text(RESTART_PAYMENT_SCRIPT)
+    env = {**os.environ, "STORAGE_URL": f"sqlite:///{tmp_path / 'inkafarma.db'}", "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))}
+    env.pop("REDIS_URL", None)
+    env.pop("SHARED_STATE_URL", None)
+
+    def run(step):
+        result = subprocess.run([sys.executable, str(script), step], env=env, capture_output=True, text=True, timeout=120)
+        assert result.returncode == 0, result.stderr
+        return json.loads(result.stdout.splitlines()[-1])
+
+    status, stock_after, points = run("create")
+    assert status == 200 and points > 0
+    # Otro proceso sobre la misma base: el pago repetido se rechaza sin tocar stock ni puntos
+    assert run("pay") == [409, stock_after, points]
+
+def test_stock_engine_marks_committed_orders():
+    import fakeredis
+    from inventory import AlreadyCommitted, RedisStockEngine, StockEngine
+    print("Probando que el motor respeta las órdenes pagadas antes de reiniciar")
+    for make_engine in (StockEngine, lambda stock: RedisStockEngine(fakeredis.FakeRedis(), stock)):
+        stock = {1: {"product_id": 1, "quantity": 10}}
+        engine = make_engine(stock)
+        if isinstance(engine, RedisStockEngine):
+            engine.load()
+        engine.mark_committed(iter([7, 8]))
+        assert engine.is_committed(7) and engine.is_committed(8)
+        errors = engine.commit_many([(7, {1: 2}), (9, {1: 3})])
+        assert isinstance(errors[0], AlreadyCommitted) and errors[1] is None
+        assert stock[1]["quantity"] == 7
+
+def test_stock_cache_invalidated_after_payment():
+    print("Probando invalidación de caché de stock tras un pago")
+    before = client.get("/stock/6/quantity").json()["quantity"]
+    before_location = client.get("/locations/1/stock/6/quantity").json()["quantity"]
+    # Segunda lectura: debe salir de la caché
+    assert client.get("/stock/6/quantity").json()["quantity"] == before
+    new_order = {"order_id": 1000, "user_id": 2, "product_ids": [6], "quantity": [3], "location_id": 1}
+    assert client.post("/orders/create", json=new_order).status_code == 200
+    assert client.post("/payments/process", json={"order_id": 1000, "status": "Paid"}).status_code == 200
+    assert client.get("/stock/6/quantity").json()["quantity"] == before - 3
+    assert client.get("/locations/1/stock/6/quantity").json()["quantity"] == before_location - 3
+    stats = client.get("/cache/stats").json()
+    print("Estadísticas de caché:", stats)
+    assert stats["namespaces"]["stock"]["hits"] >= 1
+    assert stats["namespaces"]["stock"]["invalidations"] >= 1
+
+def test_cache_layer_with_redis_tier():
+    from cache import CacheLayer, FakeRedis, MemoryCache, RedisCache
+    print("Probando caché en dos niveles con un Redis simulado")
+    remote = RedisCache(FakeRedis())
+    layer = CacheLayer(local=MemoryCache(max_entries=2), remote=remote)
+    layer.set("products", "a", [{"id": 1}])
+    layer.local.clear()
+    # Fallo en memoria, acierto en Redis
+    assert layer.get("products", "a") == [{"id": 1}]
+    layer.invalidate("products")
+    assert layer.get("products", "a") is None
+    assert layer.stats["products"] == {"hits": 1, "misses": 1, "invalidations": 1}
+    # LRU: al superar max_entries se expulsa la entrada menos usada
+    layer.local.set("x", 1)
+    layer.local.set("y", 2)
+    layer.local.get("x")
+    layer.local.set("z", 3)
+    assert layer.local.get("y") is None and layer.local.get("x") == 1
+
+def test_cache_versions_shared_between_processes():
+    from cache import CacheLayer, FakeRedis, MemoryCache, RedisCache
+    print("Probando que dos procesos no reutilicen claves de Redis con datos distintos")
+    redis = FakeRedis()
+    first = CacheLayer(local=MemoryCache(), remote=RedisCache(redis))
+    second = CacheLayer(local=MemoryCache(), remote=RedisCache(redis))
+    first.invalidate("stock")
+    first.set("stock", "q", {"quantity": 90})
+    # El otro proceso cambia el stock: su versión no puede coincidir con la del primero
+    second.invalidate("stock")
+    assert second.get("stock", "q") is None
+    second.set("stock", "q", {"quantity": 80})
+    # Un proceso recién reiniciado toma la versión compartida
+    restarted = CacheLayer(local=MemoryCache(), remote=RedisCache(redis))
+    assert restarted.get("stock", "q") == {"quantity": 80}
+    # Tras un fallo en memoria, el primero también adopta la versión nueva
+    first.local.clear()
+    assert first.get("stock", "q") == {"quantity": 80}
+
+def test_conditional_get_with_etag():
+    print("Probando ETag / If-None-Match en /stock/{id}")
+    response = client.get("/stock/9")
+    etag = response.headers["etag"]
+    assert response.json() == {"product_id": 9, "quantity": db_stock[9]["quantity"]}
+    response = client.get("/stock/9", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.content == b""
+    assert client.get("/stock/9", headers={"If-None-Match": '"otro"'}).status_code == 200
+    # Un pago cambia el stock: la versión cacheada deja de valer y cambia el ETag
+    new_order = {"order_id": 1002, "user_id": 2, "product_ids": [9], "quantity": [1], "location_id": 2}
+    assert client.post("/orders/create", json=new_order).status_code == 200
+    assert client.post("/payments/process", json={"order_id": 1002, "status": "Paid"}).status_code == 200
+    response = client.get("/stock/9", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["etag"] != etag
+
+def test_metrics_endpoint():
+    print("Probando /metrics en formato Prometheus")
+    client.get("/stock/3/quantity")
+    client.get("/stock/3/quantity")
+    new_order = {"order_id": 1001, "user_id": 2, "product_ids": [3], "quantity": [1], "location_id": 2}
+    assert client.post("/orders/create", json=new_order).status_code == 200
+    assert client.post("/payments/process", json={"order_id": 1001, "status": "Paid"}).status_code == 200
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    assert "# TYPE inkafarma_http_request_duration_seconds histogram" in text
+    assert 'inkafarma_http_request_duration_seconds_count{method="GET",route="/stock/{product_id}/quantity",status="200"}' in text
+    for operation in ("publish_order", "update_location_stock", "stock_commit"):
+        assert f'inkafarma_operation_duration_seconds_count{{operation="{operation}"}}' in text
+    assert 'inkafarma_rabbitmq_publish_total{result="failed"}' in text
+    assert 'inkafarma_cache_hit_ratio{namespace="stock"}' in text
+
+def test_sampled_log_filter():
+    import logging
+    from metrics import SampledLogFilter
+    print("Probando el muestreo de logs repetidos")
+    sampler = SampledLogFilter(per_second=3)
+    record = lambda msg: logging.LogRecord("worker", logging.WARNING, __file__, 0, msg, (1,), None)
+    assert [sampler.filter(record("Reintentando orden %s")) for _ in range(5)] == [True, True, True, False, False]
+    # Otro mensaje tiene su propio cupo
+    assert sampler.filter(record("Orden enviada a %s"))
+    assert sampler.suppressed == 2
+
+def test_lifespan_flushes_async_log_queue(monkeypatch):
+    import asyncio
+    import logging
+    import logging.handlers
+    import queue
+    import main
+    from publisher import OrderPublisher
+    print("Probando que el apagado escriba los logs que quedan en la cola")
+    written = []
+
+    class SlowHandler(logging.Handler):
+        def emit(self, record):
+            time.sleep(0.01)
+            written.append(record.getMessage())
+
+    log_queue = queue.Queue()
+    logger = logging.getLogger("inkafarma.test.lifespan")
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    logger.addHandler(queue_handler)
+    monkeypatch.setattr(logger, "propagate", False)
+    monkeypatch.setattr(main, "logging_configured", True)
+    monkeypatch.setattr(main, "log_listener", logging.handlers.QueueListener(log_queue, SlowHandler()))
+    monkeypatch.setattr(main, "log_listener_running", False)
+    monkeypatch.setattr(main, "order_publisher", OrderPublisher(lambda: None, channels=1))
+
+    async def serve():
+        async with main.lifespan(main.app):
+            assert main.log_listener_running
+            for i in range(20):
+                logger.warning("registro %d", i)
+
+    try:
+        asyncio.run(serve())
+    finally:
+        logger.removeHandler(queue_handler)
+    assert written == [f"registro {i}" for i in range(20)]
+    assert not main.log_listener_running
+
+def test_payment_rejected_for_already_paid_order():
+    print("Probando doble pago de la orden 999")
+    quantity = db_stock[2]["quantity"]
+    response = client.post("/payments/process", json={"order_id": 999, "status": "Paid"})
+    print("Respuesta /payments/process:", response.status_code, response.json())
+    assert response.status_code == 409
+    assert db_stock[2]["quantity"] == quantity
+
+def test_create_order_rejected_without_stock():
+    from main import stock_engine
+    print("Probando /orders/create sin stock suficiente")
+    available = db_stock[15]["quantity"]
+    available_1 = stock_engine.available(1)
+    order = {"order_id": 5001, "user_id": 1, "product_ids": [15, 1], "quantity": [available + 1, 1], "location_id": 3}
+    response = client.post("/orders/create", json=order)
+    print("Respuesta /orders/create:", response.status_code, response.json())
+    assert response.status_code == 409
+    assert 5001 not in db_orders
+    # Todo o nada: tampoco quedó reservado el producto 1
+    assert stock_engine.available(1) == available_1
+    assert client.post("/orders/create", json={**order, "product_ids": [404], "quantity": [1]}).status_code == 404
+
+def test_non_positive_quantities_rejected():
+    fakeredis = pytest.importorskip("fakeredis")
+    from inventory import InvalidQuantity, RedisStockEngine, StockEngine
+    print("Probando que las cantidades negativas o nulas no sumen stock")
+    order = {"order_id": 5002, "user_id": 1, "product_ids": [2], "quantity": [-1000], "location_id": 1}
+    assert client.post("/orders/create", json=order).status_code == 422
+    assert client.post("/orders/create", json={**order, "quantity": [0]}).status_code == 422
+    assert 5002 not in db_orders
+    response = client.post("/orders/bulk", json=[order])
+    assert response.json()["results"][0]["status"] == 422
+    assert client.post("/locations/availability", json={"product_ids": [2], "quantity": [-1]}).status_code == 422
+
+    # Llamadas directas al motor (lotes, worker): tampoco pueden sumar stock
+    for make_engine in (StockEngine, lambda stock: RedisStockEngine(fakeredis.FakeRedis(), stock)):
+        stock = {2: {"product_id": 2, "quantity": 120}}
+        engine = make_engine(stock)
+        if isinstance(engine, RedisStockEngine):
+            engine.load()
+        errors = engine.reserve_many([(1, {2: -1000}), (2, {2: 0}), (3, {2: 5})])
+        assert [type(error) for error in errors] == [InvalidQuantity, InvalidQuantity, type(None)]
+        errors = engine.commit_many([(4, {2: -1000}), (3, {2: 5})])
+        assert isinstance(errors[0], InvalidQuantity) and errors[1] is None
+        assert stock[2]["quantity"] == 115 and engine.available(2) == 115
+        assert not engine.is_committed(4)
+
+def test_commit_many_keeps_other_reservations():
+    import fakeredis
+    from inventory import InsufficientStock, RedisStockEngine, StockEngine
+    print("Probando un lote de pagos con órdenes reservadas y sin reservar sobre el mismo SKU")
+    for make_engine in (StockEngine, lambda stock: RedisStockEngine(fakeredis.FakeRedis(), stock)):
+        stock = {1: {"product_id": 1, "quantity": 10}}
+        engine = make_engine(stock)
+        if isinstance(engine, RedisStockEngine):
+            engine.load()
+        engine.reserve(100, {1: 5})
+        engine.reserve(200, {1: 5})
+        # La orden 1 no reservó: no puede tomar lo reservado por 100 y 200
+        errors = engine.commit_many([(1, {1: 5}), (100, {1: 5})])
+        assert isinstance(errors[0], InsufficientStock) and errors[1] is None
+        assert stock[1]["quantity"] == 5 and engine.available(1) == 0
+        engine.commit(200, {1: 5})
+        assert stock[1]["quantity"] == 0 and engine.available(1) == 0
+
+def test_stock_engine_reservation_expires():
+    from inventory import InsufficientStock, StockEngine
+    print("Probando vencimiento de reservas")
+    stock = {1: {"product_id": 1, "quantity": 5}}
+    engine = StockEngine(stock, reservation_ttl=60)
+    engine.reserve(1, {1: 5})
+    try:
+        engine.reserve(2, {1: 1})
+        assert False, "debió fallar por falta de stock"
+    except InsufficientStock:
+        pass
+    assert engine.expire(now=time.monotonic() + 61) == 1
+    engine.reserve(2, {1: 1})
+    engine.commit(2, {1: 1})
+    assert stock[1]["quantity"] == 4
+    assert engine.available(1) == 4
+
+def test_stock_engine_concurrent_stress():
+    from concurrent.futures import ThreadPoolExecutor
+    from inventory import AlreadyCommitted, InsufficientStock, StockEngine
+    print("Probando el motor de inventario con 300 clientes concurrentes")
+    initial = 500
+    stock = {pid: {"product_id": pid, "quantity": initial} for pid in range(1, 11)}
+    engine = StockEngine(stock, shards=8)
+    sold = {pid: 0 for pid in stock}
+    sold_lock = threading.Lock()
+
+    def client_session(i):
+        rng = random.Random(i)
+        for n in range(20):
+            order_id = i * 1000 + n
+            items = {pid: rng.randint(1, 5) for pid in rng.sample(sorted(stock), rng.randint(1, 4))}
+            try:
+                engine.reserve(order_id, items)
+            except InsufficientStock:
+                continue
+            if rng.random() < 0.3:
+                engine.release(order_id)
+                continue
+            # Dos pagos simultáneos de la misma orden: solo uno debe descontar
+            results = []
+            for _ in range(2):
+                try:
+                    engine.commit(order_id, items)
+                    results.append(True)
+                except AlreadyCommitted:
+                    results.append(False)
+            assert results.count(True) == 1
+            with sold_lock:
+                for pid, qty in items.items():
+                    sold[pid] += qty
+
+    with ThreadPoolExecutor(300) as pool:
+        list(pool.map(client_session, range(300)))
+    for pid, entry in stock.items():
+        assert entry["quantity"] >= 0
+        assert entry["quantity"] == initial - sold[pid]
+    assert engine._reserved == {}
+
+def test_concurrent_payments_of_same_order():
+    from concurrent.futures import ThreadPoolExecutor
+    print("Probando 50 pagos concurrentes de la misma orden")
+    order = {"order_id": 5002, "user_id": 1, "product_ids": [11], "quantity": [2], "location_id": 3}
+    assert client.post("/orders/create", json=order).status_code == 200
+    before = db_stock[11]["quantity"]
+    with ThreadPoolExecutor(50) as pool:
+        codes = list(pool.map(lambda _: client.post("/payments/process", json={"order_id": 5002, "status": "Paid"}).status_code, range(50)))
+    assert codes.count(200) == 1
+    assert codes.count(409) == 49
+    assert db_stock[11]["quantity"] == before - 2
+
+def test_health_endpoints():
+    print("Probando /health/live y /health/ready")
+    assert client.get("/health/live").json()["status"] == "alive"
+    response = client.get("/health/ready")
+    data = response.json()
+    assert response.status_code == 200 and data["status"] == "ready"
+    assert data["subsystems"]["search"]["state"] == "ready"
+    assert data["subsystems"]["rabbitmq"]["required"] is False
+    assert "inkafarma_subsystem_ready{subsystem=\"search\"} 1" in client.get("/metrics").text
+
+def test_warmup_runs_steps_once_and_gates_requests():
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi import FastAPI
+    from startup import Warmup, WarmupMiddleware
+    print("Probando la inicialización diferida")
+    warmup = Warmup()
+    runs = {"index": 0, "hashes": 0}
+    broken = [True]
+
+    @warmup.step("index")
+    def build_index():
+        time.sleep(0.05)
+        runs["index"] += 1
+
+    @warmup.step("flaky")
+    def flaky():
+        if broken[0]:
+            raise RuntimeError("sin conexión")
+
+    warmup.step("hashes", gate=False)(lambda: runs.__setitem__("hashes", runs["hashes"] + 1))
+
+    demo = FastAPI()
+    demo.add_middleware(WarmupMiddleware, warmup=warmup, exempt=("/live",))
+    demo.get("/live")(lambda: {"ok": True})
+    demo.get("/data")(lambda: {"index": runs["index"]})
+    demo_client = TestClient(demo)
+
+    assert not warmup.ready and demo_client.get("/live").status_code == 200
+    # El paso que falla responde 503 y se reintenta en la siguiente request
+    with ThreadPoolExecutor(8) as pool:
+        statuses = list(pool.map(lambda _: demo_client.get("/data").status_code, range(8)))
+    assert statuses == [503] * 8 and runs["index"] == 1
+    assert warmup.status()["flaky"]["state"] == "failed"
+    broken[0] = False
+    assert demo_client.get("/data").json() == {"index": 1}
+    # Los pasos que no bloquean no cuentan para ready
+    assert warmup.ready and runs["hashes"] == 0
+    warmup.run()
+    warmup.run()
+    assert runs == {"index": 1, "hashes": 1}
+
+def test_idempotent_retries_under_concurrency():
+    import main
+    from concurrent.futures import ThreadPoolExecutor
+    print("Probando reintentos concurrentes con Idempotency-Key")
+    order = {"order_id": 8001, "user_id": 2, "product_ids": [12], "quantity": [2], "location_id": 3}
+    stock_before, points_before = db_stock[12]["quantity"], main.loyalty.balance(2)
+    enqueued = main.order_publisher.stats["enqueued"]
+
+    def retry(path, body, key):
+        response = client.post(path, json=body, headers={"Idempotency-Key": key})
+        return response.status_code, response.content, response.headers.get("idempotent-replayed")
+
+    with ThreadPoolExecutor(30) as pool:
+        created = list(pool.map(lambda _: retry("/orders/create", order, "crear-8001"), range(30)))
+        paid = list(pool.map(lambda _: retry("/payments/process", {"order_id": 8001, "status": "Paid"}, "pagar-8001"), range(30)))
+    for responses in (created, paid):
+        assert {(status, body) for status, body, _ in responses} == {(200, responses[0][1])}
+        assert [replayed for _, _, replayed in responses].count(None) == 1
+    # Una sola publicación, un solo descuento de stock y una sola acumulación de puntos
+    assert main.order_publisher.stats["enqueued"] == enqueued + 1
+    assert db_stock[12]["quantity"] == stock_before - 2
+    assert main.loyalty.balance(2) == points_before + 15
+    # La misma clave con otro cuerpo se rechaza
+    other = {**order, "quantity": [3]}
+    assert client.post("/orders/create", json=other, headers={"Idempotency-Key": "crear-8001"}).status_code == 422
+    # Sin clave, el order_id deduplica: reintento idéntico aceptado sin republicar, otra orden con el mismo id rechazada
+    assert client.post("/orders/create", json=order).status_code == 200
+    assert client.post("/orders/create", json=other).status_code == 409
+    assert main.order_publisher.stats["enqueued"] == enqueued + 1
+
+def test_worker_skips_duplicate_messages():
+    from types import SimpleNamespace
+    from codec import encode_order
+    from idempotency import MemoryIdempotencyStore
+    from publisher import FakeBroker
+    from worker import OrderConsumer
+    print("Probando la deduplicación por message_id en el worker")
+    handled = []
+    consumer = OrderConsumer(handled.append, dedup=MemoryIdempotencyStore())
+    channel = FakeBroker().connection().channel()
+    body, content_type = encode_order({"order_id": 8100, "user_id": 1, "product_ids": [1], "quantity": [1], "location_id": 1}, "json")
+    for tag in (1, 2, 3):
+        properties = SimpleNamespace(content_type=content_type, headers=None, message_id="order-8100")
+        consumer.on_message(channel, SimpleNamespace(delivery_tag=tag), properties, body)
+    assert len(handled) == 1 and consumer.stats["duplicates"] == 2
+
+def _shared_stock_worker(port, worker, orders, sold):
+    import redis
+    from inventory import RedisStockEngine, StockError
+    rng = random.Random(worker)
+    engine = RedisStockEngine(redis.Redis(port=port), {})
+    totals = {}
+    for i in range(orders):
+        order_id = worker * orders + i
+        items = {pid: rng.randint(1, 3) for pid in rng.sample(range(1, 6), 2)}
+        try:
+            engine.reserve(order_id, items)
+            if rng.random() < 0.2:
+                engine.release(order_id)
+                continue
+            engine.commit(order_id, items)
+        except StockError:
+            continue
+        for pid, qty in items.items():
+            totals[pid] = totals.get(pid, 0) + qty
+    sold.put(totals)
+
+def test_shared_stock_no_oversell_across_processes():
+    import multiprocessing
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    import redis
+    from inventory import RedisStockEngine
+    print("Probando el inventario compartido en Redis con 4 procesos")
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    try:
+        initial = 150
+        stock = {pid: {"product_id": pid, "quantity": initial} for pid in range(1, 6)}
+        engine = RedisStockEngine(redis.Redis(port=port), stock)
+        engine.load()
+        sold = multiprocessing.get_context("fork").Queue()
+        workers = [multiprocessing.get_context("fork").Process(target=_shared_stock_worker, args=(port, w, 100, sold))
+                   for w in range(4)]
+        for process in workers:
+            process.start()
+        totals = {pid: 0 for pid in stock}
+        for _ in workers:
+            for pid, qty in sold.get(timeout=60).items():
+                totals[pid] += qty
+        for process in workers:
+            process.join(timeout=10)
+        # La demanda (~1600 unidades por SKU) supera el stock: se vende todo y nada de más
+        quantities = engine.sync()
+        for pid in stock:
+            assert quantities[pid] >= 0
+            assert quantities[pid] == initial - totals[pid]
+            assert engine.available(pid) == quantities[pid]
+        assert sum(totals.values()) > 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_stock_events_update_other_workers():
+    fakeredis = pytest.importorskip("fakeredis")
+    import main
+    from events import EventBus
+    from main import location_stock
+    print("Probando los avisos de stock entre workers")
+    redis_server = fakeredis.FakeServer()
+    received = []
+    listener = EventBus(fakeredis.FakeRedis(server=redis_server), poll_interval=0.05)
+    sender = EventBus(fakeredis.FakeRedis(server=redis_server))
+    listener.start(received.append)
+    try:
+        sender.publish({"stock": {"3": 7}})
+        listener.publish({"stock": {"3": 8}})
+        deadline = time.monotonic() + 5
+        while not received and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        listener.stop()
+    # Los eventos propios se descartan
+    assert [event["stock"] for event in received] == [{"3": 7}]
+
+    original = db_stock[1]["quantity"]
+    try:
+        main.on_stock_event({"stock": {"1": original - 5}})
+        assert db_stock[1]["quantity"] == original - 5
+        assert location_stock.get(1, 1) == original - 5
+        assert location_stock.get(2, 1) is None
+        assert client.get("/stock/1/quantity").json()["quantity"] == original - 5
+    finally:
+        main.on_stock_event({"stock": {"1": original}})
+
+def test_stock_event_adopts_shared_cache_version():
+    from cache import CacheLayer, FakeRedis, MemoryCache, RedisCache
+    print("Probando que el aviso de stock invalide con la versión compartida")
+    redis = FakeRedis()
+    writer = CacheLayer(local=MemoryCache(), remote=RedisCache(redis))
+    peer = CacheLayer(local=MemoryCache(), remote=RedisCache(redis))
+    peer.set("stock", "q", {"quantity": 90})
+    assert peer.get("stock", "q") == {"quantity": 90}
+    versions = writer.invalidate("stock")
+    writer.set("stock", "q", {"quantity": 80})
+    # El peer no vuelve a incrementar: lee lo que el otro guardó con la versión nueva
+    peer.invalidated_elsewhere(versions)
+    assert peer.get("stock", "q") == {"quantity": 80}
+    assert RedisCache(redis).version("stock") == versions["stock"]
+    # Sin Redis cada proceso incrementa su propia versión
+    local_only = CacheLayer(local=MemoryCache())
+    local_only.set("stock", "q", {"quantity": 90})
+    local_only.invalidated_elsewhere({"stock": 0})
+    assert local_only.get("stock", "q") is None
+
+def test_bulk_orders_and_payments():
+    import json
+    print("Probando /orders/bulk y /payments/bulk")
+    before = db_stock[12]["quantity"]
+    orders = [
+        {"order_id": 6001, "user_id": 1, "product_ids": [12], "quantity": [2], "location_id": 3},
+        {"order_id": 6002, "user_id": 2, "product_ids": [12, 13], "quantity": [1, 1], "location_id": 3},
+        {"order_id": 6001, "user_id": 1, "product_ids": [12], "quantity": [2], "location_id": 3},
+        {"order_id": 6003, "user_id": 1, "product_ids": [12], "quantity": [before], "location_id": 3},
+        {"order_id": "x"},
+    ]
+    response = client.post("/orders/bulk", json=orders)
+    data = response.json()
+    print("Respuesta /orders/bulk:", response.status_code, data)
+    assert response.status_code == 200
+    assert [r["status"] for r in data["results"]] == [200, 200, 409, 409, 422]
+    assert data["accepted"] == 2
+
+    # NDJSON: una línea por pago
+    body = "\n".join(json.dumps({"order_id": oid, "status": "Paid"}) for oid in (6001, 6002, 6001, 6999))
+    response = client.post("/payments/bulk", content=body, headers={"Content-Type": "application/x-ndjson"})
+    data = response.json()
+    print("Respuesta /payments/bulk:", response.status_code, data)
+    assert [r["status"] for r in data["results"]] == [200, 200, 409, 404]
+    assert db_stock[12]["quantity"] == before - 3
+    assert client.get("/locations/3/stock/12/quantity").json()["quantity"] == before - 3
+    assert client.post("/orders/bulk", content=b"{no es json", headers={"Content-Type": "application/json"}).status_code == 400
+
+def test_concurrency_limit_middleware():
+    import asyncio
+    import httpx
+    from fastapi import FastAPI
+    from middleware import ConcurrencyLimitMiddleware
+    print("Probando el límite de requests en curso")
+    limited = FastAPI()
+
+    @limited.get("/slow")
+    async def slow():
+        await asyncio.sleep(0.05)
+        return {"ok": True}
+
+    limited.add_middleware(ConcurrencyLimitMiddleware, limit=2, queue_timeout=0)
+
+    async def burst():
+        transport = httpx.ASGITransport(app=limited)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            responses = await asyncio.gather(*(http.get("/slow") for _ in range(5)))
+        return sorted(r.status_code for r in responses)
+
+    codes = asyncio.run(burst())
+    print("Códigos:", codes)
+    assert codes == [200, 200, 503, 503, 503]
+
+def test_hot_get_endpoints_are_async():
+    import inspect
+    import main
+    for handler in (main.get_stock_product_quantity, main.get_location_stock_product_quantity, main.get_loyalty_points):
+        assert inspect.iscoroutinefunction(handler)
+
 def test_loyalty_points():
     user_id = 101
     print(f"Probando /loyalty/{user_id}")
@@ -149,6 +1194,80 @@ def test_loyalty_points():
     assert data["user_id"] == user_id
     assert isinstance(data["points"], int)
 
+def test_payment_accrues_loyalty_points():
+    print("Probando la acumulación de puntos al pagar")
+    before = client.get("/loyalty/7").json()["points"]
+    order = {"order_id": 7001, "user_id": 7, "product_ids": [1, 7], "quantity": [2, 1], "location_id": 1}
+    assert client.post("/orders/create", json=order).status_code == 200
+    assert client.post("/payments/process", json={"order_id": 7001, "status": "Paid"}).status_code == 200
+    # Durex 18.0 x 2 + Curitas 6.0 x 1 = 42 puntos
+    assert client.get("/loyalty/7").json()["points"] == before + 42
+    # Un pago repetido no vuelve a sumar
+    assert client.post("/payments/process", json={"order_id": 7001, "status": "Paid"}).status_code == 409
+    response = client.post("/loyalty/rebuild")
+    assert response.status_code == 200
+    assert client.get("/loyalty/7").json()["points"] == before + 42
+    assert db_loyalty[7] == before + 42
+
+def test_loyalty_ledger_batches_and_replays(tmp_path):
+    from loyalty import LoyaltyEngine
+    from pagination import KeysetTable
+    print("Probando el ledger de fidelidad")
+    journal = str(tmp_path / "loyalty.ledger")
+    balances = KeysetTable()
+    engine = LoyaltyEngine(balances, journal_path=journal, batch_size=3)
+    engine.load()
+    assert engine.record_many([(1, 10, 5.5), (2, 11, 3.0)]) == [5, 3]
+    assert engine.balance(1) == 5 and len(balances) == 0
+    engine.record_payment(1, 12, 4.0)
+    # Al juntar batch_size movimientos se escriben en lote
+    assert balances == {1: 9, 2: 3}
+    engine.record_payment(3, 13, 0.5)
+    engine.record_payment(3, 14, 7.0)
+    engine.stop()
+    assert balances[3] == 7
+
+    with open(journal, "ab") as f:
+        f.write(b"registro cortado")
+    replayed = LoyaltyEngine(KeysetTable(), journal_path=journal)
+    replayed.load()
+    assert len(replayed.ledger) == 4
+    assert {user_id: replayed.balance(user_id) for user_id in (1, 2, 3)} == {1: 9, 2: 3, 3: 7}
+    assert replayed.rebuild() == 3
+
+def test_shared_loyalty_balances(tmp_path):
+    from loyalty import LoyaltyEngine
+    from storage import SQLiteStorage
+    print("Probando saldos de fidelidad compartidos entre la API y un worker")
+    storage = SQLiteStorage(str(tmp_path / "inkafarma.db"), pool_size=2)
+    storage.table("loyalty")[1] = 10
+    api = LoyaltyEngine(storage.table("loyalty"), shared=True)
+    worker = LoyaltyEngine(storage.table("loyalty"), shared=True)
+    for engine in (api, worker):
+        engine.load()
+    api.record_payment(1, 20, 5.0)
+    worker.record_payment(1, 21, 7.0)
+    # Lo que un proceso no escribió todavía solo lo ve él
+    assert (api.balance(1), worker.balance(1)) == (15, 17)
+    worker.stop()
+    api.flush()
+    assert api.balance(1) == worker.balance(1) == storage.table("loyalty")[1] == 22
+    storage.close()
+
+def test_worker_payment_accrues_loyalty_points():
+    import main
+    from worker import process_order
+    print("Probando que un pago del worker acumula puntos visibles en /loyalty")
+    before = client.get("/loyalty/8").json()["points"]
+    process_order({"order_id": 7101, "user_id": 8, "product_ids": [3], "quantity": [2], "location_id": 2})
+    expected = before + main.loyalty.points_for(main.order_amount(main.db_orders[7101]))
+    assert expected > before and client.get("/loyalty/8").json()["points"] == expected
+    # El hilo de flush quedó en marcha y al detenerlo se escribe el saldo
+    assert main.loyalty._thread is not None
+    main.loyalty.stop()
+    assert db_loyalty[8] == expected
+    main.loyalty.start()
+
 def test_get_locations():
     print("Probando /locations")
     response = client.get("/locations")
@@ -196,6 +1315,100 @@ def test_get_location_stock_product_quantity():
     assert response.status_code == 200
     assert "quantity" in data
 
+def test_location_stock_index():
+    from inventory import LocationStockIndex
+    print("Probando el índice de stock por locación")
+    index = LocationStockIndex()
+    index.set(1, 10, 5)
+    index.set(2, 20, 7)
+    assert index.get(1, 10) == 5
+    assert index.get(1, 20) is None
+    assert index.get(3, 10) is None
+    index.update(1, {10: 0, 30: -2})
+    assert list(index.items(1)) == [(10, 0), (30, -2)]
+    index.remove(1, 10)
+    assert list(index.product_ids(1)) == [30]
+    # Índice invertido producto -> locaciones
+    index.set(2, 30, 4)
+    assert index.carriers(30) == {1, 2} and index.carriers(10) == set()
+    index.remove_location(1)
+    assert index.carriers(30) == {2}
+
+def test_location_stock_index_memory_follows_assortment():
+    import tracemalloc
+    from inventory import LocationStockIndex
+    print("Probando que la memoria del índice siga al surtido y no al catálogo")
+    rng = random.Random(6)
+    tracemalloc.start()
+    index = LocationStockIndex()
+    for location_id in range(200):
+        index.update(location_id, dict.fromkeys(rng.sample(range(1_000_000), 50), 7))
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # 16 bytes por SKU vendido; filas densas por columna del catálogo ocuparían cientos de MB
+    assert index.nbytes == 200 * 50 * 16
+    assert used < 8 * 2**20
+    location_id, product_id = 17, next(iter(index.product_ids(17)))
+    assert index.get(location_id, product_id) == 7 and location_id in index.carriers(product_id)
+    # Las cantidades admiten lo mismo que db_stock (enteros de 64 bits)
+    index.set(location_id, product_id, 2**40)
+    index.update(location_id, {product_id + 1: 2**62})
+    assert index.get(location_id, product_id) == 2**40 and index.get(location_id, product_id + 1) == 2**62
+
+def test_spatial_index_nearest():
+    from geo import SpatialIndex, haversine_km
+    print("Probando el índice espacial de locaciones")
+    rng = random.Random(4)
+    points = {key: (rng.uniform(-13, -11), rng.uniform(-78, -76)) for key in range(500)}
+    index = SpatialIndex(cell_degrees=0.1)
+    for key, (lat, lon) in points.items():
+        index.add(key, lat, lon)
+    index.remove(0)
+    for lat, lon in [(-12.05, -77.04), (-20.0, -70.0)]:
+        accept = set(range(0, 500, 2))
+        expected = sorted((haversine_km(lat, lon, *points[key]), key) for key in accept if key != 0)[:5]
+        assert [key for key, _ in index.nearest(lat, lon, 5, accept)] == [key for _, key in expected]
+    assert all(km <= 20 for _, km in index.nearest(-12.05, -77.04, 50, max_km=20))
+
+def test_update_location_stock_touches_only_order_skus():
+    from main import location_stock, update_location_stock
+    print("Probando actualización incremental del stock de una locación")
+    original = db_stock[1]["quantity"]
+    db_stock[1] = {"product_id": 1, "quantity": original - 10}
+    try:
+        update_location_stock(1, [2])
+        assert location_stock.get(1, 1) == original
+        assert location_stock.get(1, 2) == db_stock[2]["quantity"]
+        update_location_stock(1)
+        assert location_stock.get(1, 1) == original - 10
+    finally:
+        db_stock[1] = {"product_id": 1, "quantity": original}
+        update_location_stock(1, [1])
+    # Un producto que la locación no vende sigue sin aparecer
+    update_location_stock(1, [3])
+    assert location_stock.get(1, 3) is None
+
+def test_basket_availability():
+    print("Probando /locations/availability")
+    # Los productos 1 y 2 solo los vende la locación 1
+    response = client.post("/locations/availability", json={
+        "product_ids": [1, 2], "quantity": [1, 1], "latitude": -12.1, "longitude": -77.03,
+    })
+    data = response.json()
+    print("Respuesta /locations/availability:", response.status_code, data)
+    assert response.status_code == 200
+    assert [row["location_id"] for row in data] == [1] and data[0]["missing"] == []
+    assert 0 < data[0]["distance_km"] < 10
+    # Ninguna surte la canasta completa: por cobertura, la más cercana primero
+    response = client.post("/locations/availability", json={
+        "product_ids": [1, 3, 8], "quantity": [1, 1, 1], "latitude": -12.1, "longitude": -77.03, "rank": "coverage",
+    })
+    assert [(row["location_id"], row["fulfilled"]) for row in response.json()] == [(3, 1), (2, 1), (1, 1)]
+    response = client.post("/locations/availability", json={"product_ids": [1], "quantity": [10**6]})
+    assert response.json() == []
+    response = client.post("/locations/availability", json={"product_ids": [1], "quantity": [1], "rank": "distance"})
+    assert response.status_code == 422
+
 def test_get_stock():
     print("Probando /stock")
     response = client.get("/stock")
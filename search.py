@@ -0,0 +1,154 @@
+import heapq
+from itertools import chain, islice
+from typing import Dict, List, Optional, Set, Tuple
+
+# Longitud máxima de los n-gramas indexados. Las consultas más largas se
+# resuelven intersectando los trigramas de la consulta y verificando el
+# resultado contra el nombre normalizado.
+NGRAM_SIZE = 3
+
+
+def normalize(text: Optional[str]) -> str:
+    """
+    Normaliza un texto para búsqueda (misma semántica que el antiguo .lower()).
+    """
+    return (text or "").lower()
+
+
+def ngrams(text: str, n: int) -> Set[str]:
+    """
+    Devuelve el conjunto de n-gramas de longitud exacta n de un texto.
+    """
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class ProductSearchIndex:
+    """
+    Índice de búsqueda de productos construido una sola vez a partir de
+    db_products y mantenido al día con add/remove en cada escritura.
+
+    - Nombres: índice invertido de n-gramas (1..NGRAM_SIZE) para búsqueda
+      por subcadena y por prefijo.
+    - Categorías: mapa exacto categoría normalizada -> ids (en orden de
+      inserción, para paginar sin ordenar).
+    """
+
+    def __init__(self, products: Optional[Dict[int, dict]] = None):
+        self.products: Dict[int, dict] = {}
+        self._names: Dict[int, str] = {}
+        self._grams: Dict[str, Set[int]] = {}
+        self._categories: Dict[str, Dict[int, None]] = {}
+        if products:
+            self.build(products)
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def build(self, products: Dict[int, dict]):
+        """
+        Reconstruye el índice completo a partir de un diccionario de productos.
+        """
+        self.products = {}
+        self._names = {}
+        self._grams = {}
+        self._categories = {}
+        for product_id, product in products.items():
+            self.add(product_id, product)
+
+    def add(self, product_id: int, product: dict):
+        """
+        Indexa (o reindexa) un producto.
+        """
+        if product_id in self.products:
+            self.remove(product_id)
+        name = normalize(product.get("name"))
+        self.products[product_id] = product
+        self._names[product_id] = name
+        for n in range(1, NGRAM_SIZE + 1):
+            for gram in ngrams(name, n):
+                self._grams.setdefault(gram, set()).add(product_id)
+        category = normalize(product.get("category"))
+        self._categories.setdefault(category, {})[product_id] = None
+
+    def remove(self, product_id: int):
+        """
+        Elimina un producto del índice. No hace nada si no existe.
+        """
+        product = self.products.pop(product_id, None)
+        if product is None:
+            return
+        name = self._names.pop(product_id)
+        for n in range(1, NGRAM_SIZE + 1):
+            for gram in ngrams(name, n):
+                ids = self._grams.get(gram)
+                if ids is not None:
+                    ids.discard(product_id)
+                    if not ids:
+                        del self._grams[gram]
+        category = normalize(product.get("category"))
+        ids = self._categories.get(category)
+        if ids is not None:
+            ids.pop(product_id, None)
+            if not ids:
+                del self._categories[category]
+
+    def _name_candidates(self, query: str) -> Set[int]:
+        if not query:
+            return set(self.products)
+        if len(query) <= NGRAM_SIZE:
+            return self._grams.get(query, set())
+        # Intersectamos empezando por la lista de postings más pequeña
+        postings = sorted(
+            (self._grams.get(gram, set()) for gram in ngrams(query, NGRAM_SIZE)),
+            key=len,
+        )
+        candidates = set(postings[0])
+        for ids in postings[1:]:
+            candidates &= ids
+            if not candidates:
+                break
+        return candidates
+
+    def _rank(self, query: str, product_id: int) -> Tuple[int, int, int, int]:
+        name = self._names[product_id]
+        position = name.find(query)
+        if name == query:
+            tier = 0
+        elif position == 0:
+            tier = 1
+        elif name[position - 1] == " ":
+            tier = 2
+        else:
+            tier = 3
+        return (tier, position, len(name), product_id)
+
+    def search_name(self, name: str, limit: Optional[int] = None, offset: int = 0) -> List[dict]:
+        """
+        Busca productos cuyo nombre contenga `name`, ordenados por relevancia:
+        coincidencia exacta, prefijo, inicio de palabra y luego subcadena.
+        """
+        query = normalize(name)
+        scored = []
+        for product_id in self._name_candidates(query):
+            # Los n-gramas solo filtran candidatos; confirmamos la subcadena
+            if query in self._names[product_id]:
+                scored.append((self._rank(query, product_id), product_id))
+        if limit is None:
+            scored.sort()
+            page = scored[offset:]
+        else:
+            page = heapq.nsmallest(offset + limit, scored)[offset:]
+        return [{"id": pid, **self.products[pid]} for _, pid in page]
+
+    def search_category(self, category: str, limit: Optional[int] = None, offset: int = 0) -> List[dict]:
+        """
+        Busca productos cuya categoría contenga `category`. Solo se recorren
+        las categorías distintas, nunca el catálogo completo.
+        """
+        query = normalize(category)
+        buckets = [self._categories.get(query, {})]
+        # Primero la categoría exacta, luego las coincidencias parciales
+        buckets.extend(ids for key, ids in self._categories.items() if key != query and query in key)
+        end = None if limit is None else offset + limit
+        page = islice(chain.from_iterable(buckets), offset, end)
+        return [{"id": pid, **self.products[pid]} for pid in page]
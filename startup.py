@@ -0,0 +1,178 @@
+"""
+Arranque diferido: los subsistemas costosos (índices en memoria, saldos de
+fidelidad, hashes de contraseñas) se registran como pasos de calentamiento
+en lugar de construirse al importar main.py.
+
+- Warmup: registro de pasos con nombre. `start` los ejecuta en un hilo de
+  fondo; `ensure` ejecuta (o espera, si otro hilo ya lo está haciendo) los
+  que todavía no terminaron, así que cada paso corre una sola vez.
+- WarmupMiddleware: retiene las requests hasta que los pasos que bloquean
+  (`gate=True`) estén listos. Las sondas de salud no esperan.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import anyio.to_thread
+
+PENDING = "pending"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+
+class WarmupError(RuntimeError):
+    """
+    Falló un paso de calentamiento; se reintenta en el siguiente `ensure`.
+    """
+
+    def __init__(self, step: str, error: Exception):
+        super().__init__(f"No se pudo inicializar {step}: {error}")
+        self.step = step
+
+
+class _Step:
+    __slots__ = ("name", "func", "gate", "state", "seconds", "error", "lock")
+
+    def __init__(self, name: str, func: Callable[[], None], gate: bool):
+        self.name = name
+        self.func = func
+        self.gate = gate
+        self.state = PENDING
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+        self.lock = threading.Lock()
+
+
+class Warmup:
+    """
+    Pasos de calentamiento en orden de registro. `ready` pasa a True cuando
+    terminaron todos los que bloquean el servicio; los demás (gate=False)
+    solo los espera quien los necesita, con `ensure(nombre)` o `wait(nombre)`.
+    """
+
+    def __init__(self):
+        self._steps: Dict[str, _Step] = {}
+        self._thread: Optional[threading.Thread] = None
+        self.ready = True
+
+    def step(self, name: str, gate: bool = True):
+        """
+        Decorador que registra la función como el paso `name`.
+        """
+        def register(func):
+            self._steps[name] = _Step(name, func, gate)
+            if gate:
+                self.ready = False
+            return func
+        return register
+
+    def _selected(self, names: Iterable[str]) -> List[_Step]:
+        names = list(names)
+        if not names:
+            return [step for step in self._steps.values() if step.gate]
+        return [self._steps[name] for name in names]
+
+    def _run_step(self, step: _Step):
+        if step.state == READY:
+            return
+        with step.lock:
+            # Otro hilo pudo terminarlo mientras se esperaba el lock
+            if step.state == READY:
+                return
+            step.state = WARMING
+            start = time.perf_counter()
+            try:
+                step.func()
+            except Exception as e:
+                step.state, step.error = FAILED, str(e)
+                logging.error("Falló la inicialización de %s: %s", step.name, e)
+                raise WarmupError(step.name, e) from e
+            step.seconds = time.perf_counter() - start
+            step.state, step.error = READY, None
+        if step.gate:
+            self.ready = all(other.state == READY for other in self._steps.values() if other.gate)
+
+    def ensure(self, *names: str):
+        """
+        Ejecuta en el hilo actual los pasos indicados (por defecto, los que
+        bloquean el servicio) que aún no están listos. Lanza WarmupError.
+        """
+        for step in self._selected(names):
+            self._run_step(step)
+
+    def run(self):
+        """
+        Ejecuta todos los pasos, incluidos los que no bloquean.
+        """
+        self.ensure(*self._steps)
+
+    async def wait(self, *names: str):
+        """
+        Versión para el event loop: el trabajo (o la espera) va a un hilo.
+        """
+        if all(step.state == READY for step in self._selected(names)):
+            return
+        await anyio.to_thread.run_sync(self.ensure, *names)
+
+    def start(self):
+        """
+        Calienta todos los pasos en un hilo de fondo; quien llega antes a
+        un paso lo ejecuta él mismo y el hilo lo encuentra listo.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        def run():
+            # Primero lo que bloquea el servicio; lo demás (p. ej. los hashes) después
+            for name in sorted(self._steps, key=lambda name: not self._steps[name].gate):
+                try:
+                    self.ensure(name)
+                except WarmupError:
+                    # Queda como fallido; la próxima request lo reintenta
+                    pass
+
+        self._thread = threading.Thread(target=run, name="warmup", daemon=True)
+        self._thread.start()
+
+    def status(self) -> Dict[str, dict]:
+        return {
+            step.name: {
+                "state": step.state,
+                "required": step.gate,
+                "seconds": None if step.seconds is None else round(step.seconds, 4),
+                **({"error": step.error} if step.error else {}),
+            }
+            for step in self._steps.values()
+        }
+
+
+class WarmupMiddleware:
+    """
+    Middleware ASGI que, mientras el servicio no está listo, hace esperar a
+    cada request (salvo las rutas de `exempt`) a que terminen los pasos que
+    bloquean, ejecutándolos si nadie lo hizo todavía. Si un paso falla
+    responde 503 con Retry-After. Una vez listo, el costo es leer un atributo.
+    """
+
+    def __init__(self, app, warmup: Warmup, exempt: Iterable[str] = ()):
+        self.app = app
+        self.warmup = warmup
+        self.exempt = frozenset(exempt)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not self.warmup.ready and scope["path"] not in self.exempt:
+            try:
+                await self.warmup.wait()
+            except WarmupError as e:
+                body = json.dumps({"detail": str(e)}).encode("utf-8")
+                await send({
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1")],
+                })
+                await send({"type": "http.response.body", "body": body})
+                return
+        await self.app(scope, receive, send)
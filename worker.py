@@ -0,0 +1,218 @@
+"""
+Worker que consume la cola 'orders' y procesa las órdenes fuera del request.
+
+Uso:
+    python worker.py --processes 4 --prefetch 50
+
+Cada proceso abre su propia conexión a RabbitMQ y recibe como máximo
+`prefetch` mensajes sin confirmar. Por cada orden se reserva el stock y se
+registra el pago; si el handler falla, el mensaje se reintenta hasta
+`max_retries` veces y después se envía a la cola de mensajes muertos. Las
+copias repetidas de un mensaje (mismo message_id) se confirman sin volver a
+procesarlas; con SHARED_STATE_URL la deduplicación se comparte en Redis.
+"""
+import argparse
+import importlib
+import logging
+import multiprocessing
+import os
+import sys
+from typing import Callable
+
+import pika
+
+from codec import CodecError, decode_order
+from idempotency import MemoryIdempotencyStore, RedisIdempotencyStore
+from metrics import SampledLogFilter, configure_logging
+
+RETRY_HEADER = "x-retries"
+ERROR_HEADER = "x-error"
+
+
+class OrderRejected(Exception):
+    """
+    La orden no se puede procesar nunca (p. ej. producto inexistente):
+    va directo a la cola de mensajes muertos, sin reintentos.
+    """
+
+
+class OrderConsumer:
+    """
+    Lógica de ack/reintento/dead-letter para cada mensaje de la cola.
+    `on_message` tiene la firma de los callbacks de pika. Con `dedup` (un
+    almacén de idempotency.py) cada message_id se procesa una sola vez.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict], None],
+        queue_name: str = "orders",
+        dead_letter_queue: str = "orders.dead",
+        max_retries: int = 3,
+        dedup=None,
+    ):
+        self.handler = handler
+        self.queue_name = queue_name
+        self.dead_letter_queue = dead_letter_queue
+        self.max_retries = max_retries
+        self.dedup = dedup
+        self.stats = {"processed": 0, "retried": 0, "dead_lettered": 0, "duplicates": 0}
+
+    def setup(self, channel, prefetch: int):
+        channel.queue_declare(queue=self.queue_name)
+        channel.queue_declare(queue=self.dead_letter_queue)
+        channel.basic_qos(prefetch_count=prefetch)
+
+    def _republish(self, channel, queue: str, body: bytes, properties, headers: dict):
+        properties = pika.BasicProperties(
+            content_type=getattr(properties, "content_type", None),
+            message_id=getattr(properties, "message_id", None),
+            headers={**(getattr(properties, "headers", None) or {}), **headers},
+        )
+        channel.basic_publish(exchange="", routing_key=queue, body=body, properties=properties)
+
+    def _dead_letter(self, channel, method, body, properties, error: Exception):
+        logging.error("Orden enviada a %s: %s", self.dead_letter_queue, error)
+        self._republish(channel, self.dead_letter_queue, body, properties, {ERROR_HEADER: str(error)})
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        self.stats["dead_lettered"] += 1
+
+    def on_message(self, channel, method, properties, body: bytes):
+        try:
+            order = decode_order(body, getattr(properties, "content_type", None))
+        except (CodecError, ValueError, SyntaxError) as e:
+            self._dead_letter(channel, method, body, properties, e)
+            return
+        message_id = getattr(properties, "message_id", None) if self.dedup is not None else None
+        if message_id is not None and self.dedup.claim(message_id, "") is not None:
+            # Otra copia ya se procesó (o la está procesando otro worker)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            self.stats["duplicates"] += 1
+            return
+        try:
+            self.handler(order)
+        except OrderRejected as e:
+            self._dead_letter(channel, method, body, properties, e)
+            if message_id is not None:
+                self.dedup.complete(message_id, "")
+            return
+        except Exception as e:
+            retries = (getattr(properties, "headers", None) or {}).get(RETRY_HEADER, 0)
+            if retries >= self.max_retries:
+                self._dead_letter(channel, method, body, properties, e)
+                if message_id is not None:
+                    self.dedup.complete(message_id, "")
+                return
+            logging.warning("Reintentando orden %s (%d/%d): %s", order.get("order_id"), retries + 1, self.max_retries, e)
+            # La copia reencolada conserva el message_id y debe volver a procesarse
+            if message_id is not None:
+                self.dedup.release(message_id)
+            # Se vuelve a publicar al final de la cola con el contador de reintentos
+            self._republish(channel, self.queue_name, body, properties, {RETRY_HEADER: retries + 1})
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            self.stats["retried"] += 1
+            return
+        if message_id is not None:
+            self.dedup.complete(message_id, "")
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        self.stats["processed"] += 1
+
+
+def process_order(order: dict):
+    """
+    Handler por defecto: registra la orden, reserva el stock y registra el pago
+    usando el mismo código que /payments/process. Las órdenes ya pagadas se ignoran.
+    """
+    import main
+    from inventory import AlreadyCommitted, InsufficientStock, InvalidQuantity, UnknownProduct
+
+    # main.py construye sus índices de forma diferida; solo la primera orden espera
+    main.warmup.ensure()
+    # Los puntos se escriben en db_loyalty cada flush_interval; run_worker los vacía al salir
+    main.loyalty.start()
+    if order["location_id"] not in main.db_location:
+        raise OrderRejected(f"Ubicación {order['location_id']} no existe")
+    if order["order_id"] not in main.db_orders:
+        main.db_orders[order["order_id"]] = order
+        main.recommendation_index.add_order(order)
+    try:
+        main.apply_payment(order, {"order_id": order["order_id"], "status": "Paid"})
+    except AlreadyCommitted:
+        return
+    except (InsufficientStock, InvalidQuantity, UnknownProduct) as e:
+        raise OrderRejected(str(e))
+
+
+def load_handler(path: str) -> Callable[[dict], None]:
+    """
+    Carga un handler a partir de "modulo:funcion".
+    """
+    module_name, _, func_name = path.partition(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def dedup_store():
+    """
+    Almacén de message_id ya procesados: en Redis si hay SHARED_STATE_URL
+    (compartido entre procesos y con la API), si no en memoria del proceso.
+    """
+    ttl = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+    shared_state_url = os.getenv("SHARED_STATE_URL")
+    if shared_state_url:
+        import redis
+        return RedisIdempotencyStore(redis.Redis.from_url(shared_state_url), ttl=ttl, prefix="inkafarma:messages:")
+    return MemoryIdempotencyStore(ttl=ttl)
+
+
+def run_worker(host: str, prefetch: int, handler_path: str, max_retries: int):
+    logging.basicConfig(level=logging.INFO, format=f"[worker {os.getpid()}] %(levelname)s %(message)s")
+    # Los avisos por orden (reintentos, mensajes muertos) se muestrean
+    configure_logging(SampledLogFilter(float(os.getenv("LOG_SAMPLE_PER_SECOND", "10"))))
+    consumer = OrderConsumer(load_handler(handler_path), max_retries=max_retries, dedup=dedup_store())
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host))
+    channel = connection.channel()
+    consumer.setup(channel, prefetch)
+    channel.basic_consume(queue=consumer.queue_name, on_message_callback=consumer.on_message)
+    logging.info("Consumiendo '%s' con prefetch=%d", consumer.queue_name, prefetch)
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        channel.stop_consuming()
+    finally:
+        connection.close()
+        # El handler por defecto acumula puntos de fidelidad en main.loyalty: no se pierden al salir
+        app = sys.modules.get("main")
+        if app is not None:
+            app.loyalty.stop()
+        logging.info("Worker detenido: %s", consumer.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--prefetch", type=int, default=50)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--handler", default="worker:process_order", help="handler como modulo:funcion")
+    parser.add_argument("--max-retries", type=int, default=3)
+    args = parser.parse_args()
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(args.host, args.prefetch, args.handler, args.max_retries),
+            name=f"order-worker-{i}",
+        )
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()